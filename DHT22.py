@@ -4,9 +4,80 @@
 
 import time
 import atexit
+import threading
+import collections
 
 import pigpio
 
+# Status of a reading returned by sensor.read().
+OK = "ok"                         # Message received with a good checksum.
+BAD_CHECKSUM = "bad checksum"     # 40 bits received but the checksum failed.
+SHORT_MESSAGE = "short"           # Some but not all of the 40 bits received.
+MISSING_MESSAGE = "missing"       # No message (or too few bits) received.
+RECOVERING = "recovering"         # Not triggered, the sensor is being power cycled.
+
+# Power cycle states.
+POWERED = "powered"
+POWERING_OFF = "powering off"
+SETTLING = "settling"
+
+POWER_OFF_TIME = 2.0  # Seconds the sensor is left unpowered.
+SETTLE_TIME = 2.0     # Seconds allowed for the sensor to start up.
+
+# A message is 84 edges long: host release, 2 edges of sensor response
+# and a falling edge to start the first bit, then 40 high/low pairs.
+MESSAGE_EDGES = 84
+
+# Result of sensor.read().  temperature and humidity are None unless
+# status is OK.  tov is the time of the reading.
+reading = collections.namedtuple(
+   "reading", ["status", "temperature", "humidity", "tov"])
+
+def decode(edges):
+   """
+   Decode one message in a single pass.
+
+   edges is a list of (level, tick) tuples starting with the rising
+   edge at which the host released the line.  Returns a tuple of
+   (status, humidity, temperature).  humidity and temperature are None
+   unless status is OK.
+   """
+   # The length of each high pulse determines if the bit is 1 or 0.
+   highs = [(fall[1] - rise[1]) & 0xffffffff
+            for rise, fall in zip(edges, edges[1:])
+            if rise[0] == 1 and fall[0] == 0]
+
+   # The first two high pulses are the host release and the sensor
+   # response, the data bits follow.
+   highs = highs[2:42]
+
+   if len(highs) < 8:
+      return MISSING_MESSAGE, None, None
+   if len(highs) < 40:
+      return SHORT_MESSAGE, None, None
+   if max(highs) >= 200:  # Bad bit.
+      return BAD_CHECKSUM, None, None
+
+   value = 0
+   for diff in highs:
+      value = (value << 1) | (diff >= 50)
+
+   return _unpack(value >> 32, (value >> 24) & 255, (value >> 16) & 255,
+                  (value >> 8) & 255, value & 255)
+
+def _unpack(hH, hL, tH, tL, CS):
+   if ((hH + hL + tH + tL) & 255) != CS:
+      return BAD_CHECKSUM, None, None
+
+   rhum = ((hH << 8) + hL) * 0.1
+
+   if tH & 128:  # Negative temperature.
+      temp = (((tH & 127) << 8) + tL) * -0.1
+   else:
+      temp = ((tH << 8) + tL) * 0.1
+
+   return OK, rhum, temp
+
 class sensor:
    """
    A class to read relative humidity and temperature from the
@@ -32,7 +103,7 @@ class sensor:
    gpio ------------+
    """
 
-   def __init__(self, pi, gpio, LED=None, power=None):
+   def __init__(self, pi, gpio, LED=None, power=None, bulk=False):
       """
       Instantiate with the Pi and gpio to which the DHT22 output
       pin is connected.
@@ -44,6 +115,11 @@ class sensor:
       This gpio will be set high to power the sensor.  If the sensor
       locks it will be power cycled to restart the readings.
 
+      If bulk is True the callback only records the edges of a message
+      and the 40 bits are decoded in one pass once the message is
+      complete, see decode().  Each callback is shorter but a reading
+      takes longer in all, see bench_dht_decode.py.
+
       Taking readings more often than about once every two seconds will
       eventually cause the DHT22 to hang.  A 3 second interval seems OK.
       """
@@ -59,6 +135,13 @@ class sensor:
 
       self.powered = True
 
+      # Power cycle state machine, driven by timers so that _cb never sleeps.
+      self.state = POWERED
+      self.state_timer = None
+      self.recovery_start = None
+      self.recovery_total = 0.0  # Seconds spent power cycling.
+      self.rejected_triggers = 0  # Triggers made while power cycling.
+
       self.cb = None
 
       atexit.register(self.cancel)
@@ -80,11 +163,21 @@ class sensor:
       self.high_tick = 0
       self.bit = 40
 
+      self.edges = None  # Edges of the current message in bulk mode.
+
+      # Used by read() to wait for the end of the message.
+      self.read_lock = threading.Lock()
+      self.read_done = threading.Event()
+      self.result = None
+
       pi.set_pull_up_down(gpio, pigpio.PUD_OFF)
 
       pi.set_watchdog(gpio, 0)  # Kill any watchdogs.
 
-      self.cb = pi.callback(gpio, pigpio.EITHER_EDGE, self._cb)
+      if bulk:
+         self.cb = pi.callback(gpio, pigpio.EITHER_EDGE, self._cb_bulk)
+      else:
+         self.cb = pi.callback(gpio, pigpio.EITHER_EDGE, self._cb)
 
    def _cb(self, gpio, level, tick):
       """
@@ -137,10 +230,14 @@ class sensor:
                   if self.LED is not None:
                      self.pi.write(self.LED, 0)
 
+                  self._finish(OK)
+
                else:
 
                   self.bad_CS += 1
 
+                  self._finish(BAD_CHECKSUM)
+
          elif self.bit >= 24:  # in temp low byte
             self.tL = (self.tL << 1) + val
 
@@ -171,25 +268,109 @@ class sensor:
       else:  # level == pigpio.TIMEOUT:
          self.pi.set_watchdog(self.gpio, 0)
          if self.bit < 8:       # Too few data bits received.
-            self.bad_MM += 1    # Bump missing message count.
-            self.no_response += 1
-            if self.no_response > self.MAX_NO_RESPONSE:
-               self.no_response = 0
-               self.bad_SR += 1  # Bump sensor reset count.
-               if self.power is not None:
-                  self.powered = False
-                  self.pi.write(self.power, 0)
-                  time.sleep(2)
-                  self.pi.write(self.power, 1)
-                  time.sleep(2)
-                  self.powered = True
-         elif self.bit < 39:    # Short message receieved.
+            self._missing()
+         elif self.bit < 40:    # Short message receieved.
             self.bad_SM += 1    # Bump short message count.
+            self._finish(SHORT_MESSAGE)
             self.no_response = 0
 
          else:                  # Full message received.
             self.no_response = 0
 
+   def _cb_bulk(self, gpio, level, tick):
+      """
+      Record the edges of a message, decode it once it is complete.
+      """
+      if level == 1:
+         if ((tick - self.high_tick) & 0xffffffff) > 250000:
+            self.edges = []  # Start of a new message.
+         self.high_tick = tick
+
+      elif level == pigpio.TIMEOUT:
+         self.pi.set_watchdog(self.gpio, 0)
+         if self.edges is not None:
+            self._decode_edges()
+         else:
+            self._missing()
+         return
+
+      if self.edges is not None:
+         self.edges.append((level, tick))
+         if len(self.edges) == MESSAGE_EDGES:
+            self.pi.set_watchdog(self.gpio, 0)
+            self._decode_edges()
+
+   def _decode_edges(self):
+      status, rhum, temp = decode(self.edges)
+      self.edges = None
+
+      if status == MISSING_MESSAGE:
+         self._missing()
+         return
+
+      self.no_response = 0
+
+      if status == OK:
+         self.rhum = rhum
+         self.temp = temp
+         self.tov = time.time()
+         if self.LED is not None:
+            self.pi.write(self.LED, 0)
+      elif status == BAD_CHECKSUM:
+         self.bad_CS += 1
+      else:
+         self.bad_SM += 1
+
+      self._finish(status)
+
+   def _missing(self):
+      """Count a missing message, power cycle the sensor if it has hung."""
+      self.bad_MM += 1    # Bump missing message count.
+      self._finish(MISSING_MESSAGE)
+      self.no_response += 1
+      if self.no_response > self.MAX_NO_RESPONSE:
+         self.no_response = 0
+         self.bad_SR += 1  # Bump sensor reset count.
+         if self.power is not None:
+            self._power_off()
+
+   def _power_off(self):
+      """
+      Start a power cycle.  The rest of the cycle is run by timers,
+      POWERING_OFF -> SETTLING -> POWERED, the sensor is powered again
+      when it starts settling.
+      """
+      self.state = POWERING_OFF
+      self.powered = False
+      self.recovery_start = time.time()
+      self.pi.write(self.power, 0)
+      self._next_state(POWER_OFF_TIME, self._power_on)
+
+   def _power_on(self):
+      self.pi.write(self.power, 1)
+      self.state = SETTLING
+      self._next_state(SETTLE_TIME, self._settled)
+
+   def _settled(self):
+      self.state_timer = None
+      self.recovery_total += time.time() - self.recovery_start
+      self.recovery_start = None
+      self.state = POWERED
+      self.powered = True
+
+   def _next_state(self, delay, func):
+      self.state_timer = threading.Timer(delay, func)
+      self.state_timer.daemon = True
+      self.state_timer.start()
+
+   def _finish(self, status):
+      """Record the result of a message and wake up read()."""
+      if status == OK:
+         self.result = reading(status, self.temp, self.rhum, self.tov)
+      else:
+         self.result = reading(status, None, None, time.time())
+      self.read_done.set()
+
    def temperature(self):
       """Return current temperature."""
       return self.temp
@@ -221,22 +402,68 @@ class sensor:
       """Return count of power cycles because of sensor hangs."""
       return self.bad_SR
 
+   def recovery_time(self):
+      """Return seconds spent power cycling, including any cycle in progress."""
+      if self.recovery_start is not None:
+         return self.recovery_total + time.time() - self.recovery_start
+      return self.recovery_total
+
+   def recovering(self):
+      """Return True while the sensor is being power cycled."""
+      return self.state != POWERED
+
    def trigger(self):
-      """Trigger a new relative humidity and temperature reading."""
-      if self.powered:
-         if self.LED is not None:
-            self.pi.write(self.LED, 1)
+      """
+      Trigger a new relative humidity and temperature reading.
+
+      Returns False, and does nothing, if the sensor is being power
+      cycled.
+      """
+      if not self.powered:
+         self.rejected_triggers += 1
+         return False
+
+      if self.LED is not None:
+         self.pi.write(self.LED, 1)
+
+      self.pi.write(self.gpio, pigpio.LOW)
+      time.sleep(0.017)  # 17 ms
+      self.pi.set_mode(self.gpio, pigpio.INPUT)
+      self.pi.set_watchdog(self.gpio, 200)
+      return True
+
+   def read(self, timeout=0.5):
+      """
+      Trigger a reading and wait for it to complete.
 
-         self.pi.write(self.gpio, pigpio.LOW)
-         time.sleep(0.017)  # 17 ms
-         self.pi.set_mode(self.gpio, pigpio.INPUT)
-         self.pi.set_watchdog(self.gpio, 200)
+      Returns a reading whose status is OK, BAD_CHECKSUM, SHORT_MESSAGE,
+      MISSING_MESSAGE or RECOVERING.  Returns as soon as the 40th bit arrives
+      (about 5 ms after the trigger) or the watchdog fires, rather than
+      after a fixed delay.
+
+      timeout is a safety net in case no callback arrives at all.
+      """
+      with self.read_lock:
+         self.read_done.clear()
+         self.result = None
+
+         if not self.trigger():
+            return reading(RECOVERING, None, None, time.time())
+
+         if not self.read_done.wait(timeout):
+            return reading(MISSING_MESSAGE, None, None, time.time())
+
+         return self.result
 
    def cancel(self):
       """Cancel the DHT22 sensor."""
 
       self.pi.set_watchdog(self.gpio, 0)
 
+      if self.state_timer is not None:
+         self.state_timer.cancel()
+         self.state_timer = None
+
       if self.cb is not None:
          self.cb.cancel()
          self.cb = None
@@ -264,14 +491,12 @@ if __name__ == "__main__":
 
       r += 1
 
-      s.trigger()
-
-      time.sleep(0.2)
+      result = s.read()
 
-      print("{} {} {} {:3.2f} {} {} {} {}".format(
-         r, s.humidity(), s.temperature(), s.staleness(),
+      print("{} {} {} {} {:3.2f} {} {} {} {} {:3.1f}".format(
+         r, result.status, s.humidity(), s.temperature(), s.staleness(),
          s.bad_checksum(), s.short_message(), s.missing_message(),
-         s.sensor_resets()))
+         s.sensor_resets(), s.recovery_time()))
 
       next_reading += INTERVAL
 
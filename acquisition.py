@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+acquisition.py
+
+1. WHAT IT DOES
+Runs the environment sampling (DHT22s and MCP3008) on a background thread so
+that the Tk main loop never has to wait for the sensor.  Every reading is
+time stamped and published through a thread safe queue.  The GUI picks the
+readings up with a cheap root.after() poll.
+
+Also contains StallMonitor, which measures how late the Tk main loop runs
+its after() callbacks.  The worst case lateness is the longest time the
+touchscreen was frozen.
+'''
+
+import collections
+import queue
+import threading
+import time
+
+from adc import LightCalibration
+
+# One environment reading.  timestamp is time.time() at the moment the
+# reading was completed.  temperature, humidity and status are those of the
+# first DHT22 in the group (see dht_group.sensor_state), sensors holds the
+# sensor_state of every DHT22.
+Reading = collections.namedtuple("Reading",
+                                 ["timestamp", "temperature", "humidity", "light", "status",
+                                  "sensors"])
+
+
+class AcquisitionEngine(threading.Thread):
+    """
+    Background thread that owns the DHT22 sensors and the MCP3008 reads.
+
+    The DHT22s are read on their own staggered schedule (see
+    dht_group.SensorGroup), a Reading is published every interval.
+
+    Readings are put on self.readings (a queue.Queue).  If the GUI does not
+    collect them fast enough the oldest reading is dropped, the queue never
+    grows beyond maxsize.
+    """
+
+    def __init__(self, sensors, adc, interval=10.0, maxsize=16,
+                 light_channel=0, calibration=None):
+        """
+        Instantiate with a dht_group.SensorGroup and an adc.ADCSampler.
+
+        interval is the time in seconds between two published readings.
+        The LDR is on light_channel of the ADC, calibration is the
+        adc.LightCalibration used to convert it to a light level.
+        """
+        threading.Thread.__init__(self, name="AcquisitionEngine", daemon=True)
+
+        self.sensors = sensors
+        self.adc = adc
+        self.light_channel = light_channel
+        self.calibration = calibration or LightCalibration()
+        self.interval = interval
+
+        self.readings = queue.Queue(maxsize=maxsize)
+        self.dropped = 0  # Readings discarded because the queue was full.
+
+        self._stop_event = threading.Event()
+
+    def run(self):
+        # Let the first DHT22 reading arrive before the first publish.
+        next_reading = time.monotonic() + 1.0
+
+        while not self._stop_event.is_set():
+            self.sensors.service()
+
+            now = time.monotonic()
+            if now >= next_reading:
+                self.publish(self.sample())
+                next_reading += self.interval
+                if next_reading < now:  # Fell behind, don't try to catch up.
+                    next_reading = now + self.interval
+
+            delay = min(next_reading, self.sensors.next_due()) - time.monotonic()
+            self._stop_event.wait(max(0, delay))
+
+    def sample(self):
+        """Take one reading from all the environment sensors."""
+        sensors = self.sensors.snapshot()
+        light = self.read_light()
+
+        if sensors:
+            first = sensors[0]
+            return Reading(time.time(), first.temperature, first.humidity, light,
+                           first.status, sensors)
+        return Reading(time.time(), None, None, light, None, sensors)
+
+    def read_light(self):
+        """Return the light level in percent from the LDR, None before the first ADC sweep."""
+        raw = self.adc.raw(self.light_channel)
+        if raw is None:
+            return None
+        return self.calibration(raw)
+
+    def publish(self, reading):
+        """Put a reading on the queue, dropping the oldest one if it is full."""
+        while True:
+            try:
+                self.readings.put_nowait(reading)
+                return
+            except queue.Full:
+                try:
+                    self.readings.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def latest(self):
+        """
+        Return the newest queued reading, or None if there is none.
+
+        Older queued readings are discarded.  Safe to call from the GUI
+        thread, it never blocks.
+        """
+        reading = None
+        while True:
+            try:
+                reading = self.readings.get_nowait()
+            except queue.Empty:
+                return reading
+
+    def stop(self, timeout=None):
+        """Stop the thread and wait for it to finish."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+class StallMonitor:
+    """
+    Measure how long the Tk main loop is unable to service events.
+
+    A callback is scheduled every period_ms with root.after().  The amount
+    by which it runs late is the time the main loop was blocked.
+    """
+
+    def __init__(self, root, period_ms=50):
+        self.root = root
+        self.period_ms = period_ms
+
+        self.worst_stall = 0.0  # Longest stall seen, in seconds.
+        self.last_stall = 0.0
+        self.total_stall = 0.0
+        self.samples = 0
+
+        self._expected = None
+        self._after_id = None
+
+    def start(self):
+        self._expected = time.monotonic() + self.period_ms / 1000.
+        self._after_id = self.root.after(self.period_ms, self._tick)
+
+    def _tick(self):
+        now = time.monotonic()
+        stall = max(0.0, now - self._expected)
+
+        self.last_stall = stall
+        self.total_stall += stall
+        self.samples += 1
+        if stall > self.worst_stall:
+            self.worst_stall = stall
+
+        self._expected = now + self.period_ms / 1000.
+        self._after_id = self.root.after(self.period_ms, self._tick)
+
+    def mean_stall(self):
+        """Return the mean stall in seconds."""
+        if self.samples == 0:
+            return 0.0
+        return self.total_stall / self.samples
+
+    def reset(self):
+        """Forget the stalls measured so far."""
+        self.worst_stall = 0.0
+        self.last_stall = 0.0
+        self.total_stall = 0.0
+        self.samples = 0
+
+    def stop(self):
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
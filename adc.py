@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+adc.py
+
+1. WHAT IT DOES
+Keeps the MCP3008 open for the life of the program and samples all of its
+channels on a background thread.  Every sweep each channel is read several
+times and averaged (oversampling), the averages go into a per channel ring
+buffer.  The filtered value of a channel is the mean of its ring buffer,
+kept as a running sum so reading it is O(1).
+
+LightCalibration converts a raw LDR reading into a light level through a
+lookup table computed once at start up.
+'''
+
+import array
+import threading
+import time
+
+import metrics
+
+ADC_CHANNELS = 8
+ADC_MAX = 1023  # The MCP3008 is a 10 bit converter.
+
+SWEEP_SECONDS = metrics.REGISTRY.histogram("bench_adc_sweep_seconds", "Time to read every MCP3008 channel once.")
+
+
+class LightCalibration:
+    """
+    Raw MCP3008 value to light level (%) lookup table.
+
+    points is a list of (raw value, light level) pairs, the table is filled
+    in by linear interpolation between them.  The default is the straight
+    line the bench computer has always used, light = 100 - value * 100.
+    """
+
+    def __init__(self, points=((0, 100.0), (ADC_MAX, 0.0))):
+        points = sorted(points)
+        self.table = array.array('d', [0.0] * (ADC_MAX + 1))
+
+        for raw in range(ADC_MAX + 1):
+            if raw <= points[0][0]:
+                level = points[0][1]
+            elif raw >= points[-1][0]:
+                level = points[-1][1]
+            else:
+                for (x0, y0), (x1, y1) in zip(points, points[1:]):
+                    if x0 <= raw <= x1:
+                        level = y0 + (y1 - y0) * (raw - x0) / (x1 - x0)
+                        break
+            self.table[raw] = round(level, 2)
+
+    def __call__(self, raw):
+        """Return the light level for a raw reading (int or float)."""
+        return self.table[min(ADC_MAX, max(0, int(raw + 0.5)))]
+
+
+class ADCSampler(threading.Thread):
+    """
+    Background sampler for the MCP3008.
+
+    The bus is opened once.  rate is the number of sweeps a second,
+    oversample the number of reads averaged for one sample and window the
+    number of samples in the ring buffer of each channel.
+    """
+
+    def __init__(self, clock_pin=18, mosi_pin=24, miso_pin=23, select_pin=25,
+                 channels=range(ADC_CHANNELS), rate=10, oversample=4, window=16):
+        threading.Thread.__init__(self, name="ADCSampler", daemon=True)
+
+        self.channels = list(channels)
+        self.rate = rate
+        self.oversample = oversample
+        self.window = window
+
+        from gpiozero import MCP3008  # Slow to import, and only needed by the sampler.
+
+        self.devices = {}
+        for channel in self.channels:
+            self.devices[channel] = MCP3008(channel=channel, clock_pin=clock_pin,
+                                            mosi_pin=mosi_pin, miso_pin=miso_pin,
+                                            select_pin=select_pin)
+
+        # Ring buffers of raw samples, with a running sum and count for each channel.
+        self.rings = {channel: array.array('d', [0.0] * window) for channel in self.channels}
+        self.sums = {channel: 0.0 for channel in self.channels}
+        self.counts = {channel: 0 for channel in self.channels}
+        self.position = 0
+
+        self.sweeps = 0
+        self.sweep_time = 0.0  # Duration of the last sweep, in seconds.
+
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        next_sweep = time.monotonic()
+
+        while not self._stop_event.is_set():
+            self.sweep()
+
+            next_sweep += 1. / self.rate
+            delay = next_sweep - time.monotonic()
+            if delay < 0:  # Fell behind, don't try to catch up.
+                next_sweep = time.monotonic()
+                delay = 0
+            self._stop_event.wait(delay)
+
+    def sweep(self):
+        """Read every channel once, oversampled, into the ring buffers."""
+        start = time.monotonic()
+
+        samples = {}
+        for channel, device in self.devices.items():
+            total = 0
+            for _ in range(self.oversample):
+                total += device.raw_value
+            samples[channel] = total / self.oversample
+
+        with self.lock:
+            position = self.position
+            for channel, sample in samples.items():
+                ring = self.rings[channel]
+                if self.counts[channel] == self.window:
+                    self.sums[channel] -= ring[position]
+                else:
+                    self.counts[channel] += 1
+                ring[position] = sample
+                self.sums[channel] += sample
+            self.position = (position + 1) % self.window
+            self.sweeps += 1
+
+        self.sweep_time = time.monotonic() - start
+        SWEEP_SECONDS.observe(self.sweep_time)
+
+    def raw(self, channel):
+        """Return the filtered raw value (0 to 1023) of a channel, None before the first sweep."""
+        with self.lock:
+            if self.counts[channel] == 0:
+                return None
+            return self.sums[channel] / self.counts[channel]
+
+    def value(self, channel):
+        """Return the filtered value of a channel scaled to 0 to 1, like MCP3008.value."""
+        raw = self.raw(channel)
+        if raw is None:
+            return None
+        return raw / ADC_MAX
+
+    def stop(self, timeout=None):
+        """Stop sampling and close the bus."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        for device in self.devices.values():
+            device.close()
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+assembler.py
+
+1. WHAT IT DOES
+Turns an interval series (an Interval_* directory) into a video on the
+Raspberry Pi itself:
+
+    python3 assembler.py ../images/Interval_March_16_21_09_00_00 [width=1280] [framerate=25] [deflicker=9]
+
+The frames are taken in order from timing.csv (or the file names), with a
+frame left out as unchanged (see change_detect.py) shown as the stored
+frame which stands for it.  A pool of processes, one per core, decodes
+each photo (in draft mode, at the smallest scale the JPEG decoder can do
+above the output size), resizes it and corrects its brightness.  The raw
+frames are piped in order to ffmpeg, with at most window frames in flight
+at any time, so the memory used doesn't depend on the length of the
+series.
+
+With deflicker the mean brightness of every frame is measured first (on
+a 1/8 scale decode), and each frame is brought to the mean of the
+deflicker frames around it, which evens out the flicker of auto exposure
+without hiding a real change of light.
+
+The video is encoded in parts of part_frames frames, which are joined at
+the end without encoding them again.  The finished parts are recorded in
+timelapse_parts/progress.json, so an interrupted run starts again from
+the first part which wasn't finished.  progress.json also holds the
+frames done and the frames per second, for the GUI.
+'''
+
+import collections
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+PARTS_DIRECTORY = "timelapse_parts"
+PROGRESS_FILE = "progress.json"
+OUTPUT_FILE = "timelapse.mp4"
+
+
+def series_frames(directory):
+    """The path of the photo of each frame of the series in directory, in order."""
+    frames = []
+    timing = os.path.join(directory, "timing.csv")
+    if os.path.exists(timing):
+        with open(timing) as f:
+            next(f, None)
+            for line in f:
+                fields = line.strip().split(",")
+                if len(fields) >= 6 and fields[5]:
+                    frames.append(os.path.join(directory, fields[5]))
+        return frames
+
+    # A series without timing.csv, the .ref files hold the name of their stored frame.
+    for name in sorted(os.listdir(directory)):
+        stem, extension = os.path.splitext(name)
+        if not stem.isdigit():
+            continue
+        if extension == ".jpg":
+            frames.append(os.path.join(directory, name))
+        elif extension == ".ref":
+            with open(os.path.join(directory, name)) as f:
+                frames.append(os.path.join(directory, f.read().strip()))
+    return frames
+
+
+def read_progress(directory):
+    """The progress of the video of the series in directory, a dict, or None if it was never started."""
+    try:
+        with open(os.path.join(directory, PARTS_DIRECTORY, PROGRESS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# The pool workers.  They are niced so the GUI and the camera come first.
+
+def _start_worker():
+    os.nice(10)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent stops the pool
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # Not the parent's handler, Pool.terminate() uses it
+
+
+def _brightness(path):
+    from PIL import Image, ImageStat
+
+    try:
+        image = Image.open(path)
+        image.draft("L", (image.width // 8, image.height // 8))
+        return ImageStat.Stat(image.convert("L")).mean[0]
+    except OSError:
+        return None
+
+
+def _render(path, size, gain):
+    """The raw RGB bytes of the photo at path resized to size, with its brightness times gain."""
+    from PIL import Image
+
+    image = Image.open(path)
+    image.draft("RGB", size)  # Decoded at 1/2, 1/4 or 1/8 scale if that is still above size
+    image = image.convert("RGB")
+    if image.size != size:
+        image = image.resize(size, Image.BILINEAR)
+    if gain != 1.0:
+        image = image.point([min(255, int(v * gain + 0.5)) for v in range(256)] * 3)
+    return image.tobytes()
+
+
+class TimelapseAssembler:
+    """
+    Makes the video of the series in directory.  run() blocks until it is
+    done, stop() makes it return at the next frame.  on_progress(done,
+    total, fps) is called after each part.
+    """
+
+    def __init__(self, directory, output=None, width=1280, framerate=25, deflicker=0, workers=None,
+                 window=None, part_frames=250, crf=23, on_progress=None):
+        self.directory = directory
+        self.output = output or os.path.join(directory, OUTPUT_FILE)
+        self.width = width
+        self.framerate = framerate
+        self.deflicker = deflicker  # Frames averaged around each frame, 0 for none
+        self.workers = workers or os.cpu_count() or 1
+        self.window = window or self.workers * 2  # Frames in flight, decoded or being decoded
+        self.part_frames = part_frames
+        self.crf = crf
+        self.on_progress = on_progress
+        self.ffmpeg = shutil.which("ffmpeg")
+        self.parts = os.path.join(directory, PARTS_DIRECTORY)
+
+        self.total = 0
+        self.done = 0  # Frames in the finished parts, of this run and the earlier ones
+        self.rendered = 0  # Frames rendered by this run
+        self.missing = 0  # Frames whose photo could not be read, the frame before is repeated
+        self.resumed = False
+        self.started = None
+        self._stopping = False
+        self._progress = None
+
+    def fps(self):
+        """Frames rendered per second by this run."""
+        if self.started is None:
+            return 0.0
+        return self.rendered / max(time.monotonic() - self.started, 1e-6)
+
+    def stop(self):
+        self._stopping = True
+
+    def _settings(self, size):
+        return {"size": list(size), "framerate": self.framerate, "deflicker": self.deflicker,
+                "part_frames": self.part_frames, "crf": self.crf}
+
+    def _save_progress(self):
+        self._progress.update(done=self.done, total=self.total, fps=round(self.fps(), 2), updated=time.time())
+        path = os.path.join(self.parts, PROGRESS_FILE)
+        with open(path + ".part", "w") as f:
+            json.dump(self._progress, f)
+        os.replace(path + ".part", path)
+
+    def _size(self, path):
+        from PIL import Image
+
+        with Image.open(path) as image:
+            width, height = image.size
+        height = int(round(height * self.width / width / 2)) * 2  # Even, for yuv420p
+        return self.width, height
+
+    def run(self):
+        """Make the video, return its path, or None if stopped."""
+        if self.ffmpeg is None:
+            raise RuntimeError("ffmpeg is needed to encode the video")
+        frames = series_frames(self.directory)
+        if not frames:
+            raise RuntimeError("No frames in {}".format(self.directory))
+        self.total = len(frames)
+        size = self._size(frames[0])
+        self.started = time.monotonic()
+
+        os.makedirs(self.parts, exist_ok=True)
+        self._progress = read_progress(self.directory)
+        if self._progress is None or self._progress.get("settings") != self._settings(size):
+            self._progress = {"settings": self._settings(size), "parts": {}, "brightness": {}}
+        else:
+            self.resumed = bool(self._progress["parts"])
+
+        pool = multiprocessing.Pool(self.workers, initializer=_start_worker)
+        try:
+            gains = self._gains(pool, frames)
+            if gains is None:
+                return None
+            parts = []
+            for first in range(0, len(frames), self.part_frames):
+                name = "part_{:05d}.mp4".format(first // self.part_frames)
+                path = os.path.join(self.parts, name)
+                count = min(self.part_frames, len(frames) - first)
+                # A part is done again if the series has grown since, only the last one can have.
+                if self._progress["parts"].get(name) != count or not os.path.exists(path):
+                    if not self._encode(pool, frames[first:first + count], gains[first:first + count], size,
+                                        path):
+                        return None
+                    self._progress["parts"][name] = count
+                self.done += count
+                self._save_progress()
+                parts.append(path)
+                if self.on_progress is not None:
+                    self.on_progress(self.done, self.total, self.fps())
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self._join(parts)
+        shutil.rmtree(self.parts, ignore_errors=True)
+        return self.output
+
+    def _gains(self, pool, frames):
+        # The brightness correction of each frame, all 1.0 without deflicker.
+        if not self.deflicker:
+            return [1.0] * len(frames)
+        known = self._progress["brightness"]
+        names = sorted(set(os.path.basename(path) for path in frames) - set(known))
+        for name, value in zip(names, pool.imap(_brightness, [os.path.join(self.directory, name)
+                                                              for name in names], chunksize=8)):
+            if self._stopping:
+                return None
+            known[name] = value
+        self._save_progress()
+
+        values = [known.get(os.path.basename(path)) for path in frames]
+        half = self.deflicker // 2
+        gains = []
+        for i, value in enumerate(values):
+            around = [v for v in values[max(0, i - half):i + half + 1] if v]
+            if not value or not around:
+                gains.append(1.0)
+                continue
+            gains.append(max(0.5, min(2.0, sum(around) / len(around) / value)))
+        return gains
+
+    def _encode(self, pool, frames, gains, size, path):
+        # Encode frames into the part at path, return False if stopped.
+        partial = path + ".part.mp4"
+        encoder = subprocess.Popen([self.ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+                                    "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "{}x{}".format(*size),
+                                    "-framerate", str(self.framerate), "-i", "-",
+                                    "-c:v", "libx264", "-preset", "veryfast", "-crf", str(self.crf),
+                                    "-pix_fmt", "yuv420p", partial],
+                                   stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   preexec_fn=lambda: os.nice(10))
+        pending = collections.deque()
+        previous = None
+        try:
+            for frame, gain in zip(frames, gains):
+                if len(pending) >= self.window:
+                    previous = self._write(encoder, pending.popleft(), previous)
+                if self._stopping:
+                    break
+                pending.append(pool.apply_async(_render, (frame, size, gain)))
+            else:
+                while pending:
+                    previous = self._write(encoder, pending.popleft(), previous)
+                encoder.stdin.close()
+                error = encoder.stderr.read().decode(errors="replace").strip()
+                if encoder.wait():
+                    raise RuntimeError("ffmpeg failed: {}".format(error))
+                os.replace(partial, path)
+                return True
+        except BaseException:
+            self._discard(encoder, partial)
+            raise
+        self._discard(encoder, partial)
+        return False
+
+    def _discard(self, encoder, partial):
+        encoder.kill()
+        encoder.wait()
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    def _write(self, encoder, result, previous):
+        try:
+            data = result.get()
+        except OSError:
+            # The photo is gone (removed to stay within the disk quota), repeat the frame before.
+            self.missing += 1
+            data = previous
+        if data is not None:
+            encoder.stdin.write(data)
+        self.rendered += 1
+        return data
+
+    def _join(self, parts):
+        # Join the parts into the output without encoding them again.
+        listing = os.path.join(self.parts, "parts.txt")
+        with open(listing, "w") as f:
+            for path in parts:
+                f.write("file '{}'\n".format(os.path.abspath(path)))
+        partial = self.output + ".part.mp4"
+        result = subprocess.run([self.ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+                                 "-f", "concat", "-safe", "0", "-i", listing,
+                                 "-c", "copy", "-movflags", "+faststart", partial],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise RuntimeError("ffmpeg failed: {}".format(result.stderr.decode(errors="replace").strip()))
+        os.replace(partial, self.output)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("usage: assembler.py DIRECTORY [width=1280] [framerate=25] [deflicker=9] [workers=4] "
+              "[output=PATH]")
+        sys.exit(2)
+
+    options = dict(arg.split("=", 1) for arg in sys.argv[2:])
+    for name in ("width", "framerate", "deflicker", "workers", "window", "part_frames", "crf"):
+        if name in options:
+            options[name] = int(options[name])
+    assembler = TimelapseAssembler(
+        sys.argv[1], on_progress=lambda done, total, fps: print("{}/{} frames, {:.1f} fps".format(done, total, fps),
+                                                                flush=True),
+        **options)
+    # Stopped by the GUI with SIGTERM, or with Ctrl-C: the finished parts are kept.
+    signal.signal(signal.SIGTERM, lambda signum, frame: assembler.stop())
+    try:
+        output = assembler.run()
+    except KeyboardInterrupt:
+        output = None
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    if output is None:
+        print("Stopped at {}/{} frames, run again to resume".format(assembler.done, assembler.total))
+        sys.exit(3)
+    print("{} ({} frames, {:.1f} fps{}{})".format(
+        output, assembler.total, assembler.fps(), ", resumed" if assembler.resumed else "",
+        ", {} missing".format(assembler.missing) if assembler.missing else ""))
@@ -27,31 +27,124 @@ Modification and additional code by Richard Inniss
 
 '''
 
+# Imported first, to measure the start up from here
+from startup_profile import PROFILE
+PROFILE.watch_imports()
+
 from tkinter import *
 from tkinter.ttk import *
 from tkinter import messagebox
+import collections
+import os
+import subprocess
+import sys
+
+# Run without the Raspberry Pi hardware: BENCH_SIMULATION=1 python3 bench_computer_keystudio_relay.py
+if os.environ.get("BENCH_SIMULATION"):
+    import simulation
+    simulation.install()
 
-# Used with the camera functions
-import picamera
-import PIL
-from PIL import ImageTk
-from PIL import Image
+# The camera (picamera, PIL) and the sensors (gpiozero) are imported when they are first set up,
+# see openCamera and startEnvironment.
+ImageTk = None  # PIL.ImageTk, imported by openCamera on its background thread
 import datetime  # used to create a unique file name for each image
-import os
+import time
 
 # Used with the environment functions
 import pigpio
-import DHT22
-import Adafruit_DHT
-from time import sleep, strftime
-from gpiozero import MCP3008
+from acquisition import AcquisitionEngine, StallMonitor
+from timeseries import TimeSeriesStore
+from sparkline import Sparkline
+import telemetry
+from relays import RelayBank, RelayChannel
+from preview import LivePreview
+from storage import StorageWriter
+from catalog import CaptureIndex
+import catalog
+import assembler
+from gallery import Gallery, GalleryItem, ThumbnailCache, ThumbnailLoader
+import relay_scheduler
+from eventlog import EventLog
+from control_server import ControlServer, StateBridge, relay_command
+import metrics
+from subsystem import Subsystem
+
+PROFILE.stop_imports()
 
 PROGRAM_NAME = "AIoT Consulting Bench Computer"
 IMAGE_FILE_LOCATION = "../photos"
 VIDEO_FILE_LOCATION = "../videos"
+TELEMETRY_LOCATION = "../telemetry"  # Binary log of readings, relay changes and camera events
+CATALOG_LOCATION = "../catalog.db"  # SQLite catalog of the photos and videos, see catalog.py
+LOG_LOCATION = "../logs"  # Rotating text log, the same messages as the log panel
+LOG_LINES = 200  # Lines kept in the log panel, the older ones are only in the log file.
+LOG_FLUSH_FREQUENCY = 250  # How often new log lines are added to the log panel, in ms.
+# HTTP and WebSocket control API, use "0.0.0.0" to reach it from other computers.
+CONTROL_HOST = "127.0.0.1"
+CONTROL_PORT = 8080
+COMMAND_POLL_FREQUENCY = 50  # How often the GUI runs the commands from the control API, in ms.
+METRICS_HOST = "127.0.0.1"  # Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_PORT = 9110
 DHT_SENSOR_PIN = 3
+# All the DHT22 sensors on the bench, (name, gpio).  The first one is shown in large type.
+# Add more, for example ("Enclosure", 5), ("DUT", 13), they share one pigpio connection.
+DHT_SENSORS = [("Ambient", DHT_SENSOR_PIN)]
 DHT_SENSOR_TYPE = 2302
 DHT_FREQUENCY = 10000
+ADC_PINS = dict(clock_pin=18, mosi_pin=24, miso_pin=23, select_pin=25)  # MCP3008, bit-banged SPI
+LDR_CHANNEL = 0
+# Raw MCP3008 value to light level (%) of the LDR, add points to calibrate it.
+LDR_CALIBRATION = [(0, 100.0), (1023, 0.0)]
+READING_POLL_FREQUENCY = 250  # How often the GUI looks for new readings, in ms.
+CAPTURE_POLL_FREQUENCY = 50  # How often the GUI looks for finished photos, in ms.
+SUBSECOND_INTERVALS = [0.1, 0.25, 0.5]  # Interval photo steps below 1 second
+# Interval photos where less than threshold of the pixels changed are not stored, None to store them all.
+# "reference" leaves a tiny .ref file in their place, "skip" only a line in timing.csv.
+CHANGE_DETECTION = dict(threshold=0.01, pixel_threshold=12)
+UNCHANGED_FRAMES = "reference"
+# The video made of an interval series by assembler.py, on every core, at a lower priority than the GUI.
+TIMELAPSE_VIDEO = dict(width=1280, framerate=25, deflicker=9)
+ASSEMBLY_POLL_FREQUENCY = 1000  # How often the progress of the video is shown, in ms.
+# Photos and videos are staged on tmpfs and written to the SD card in batches, None to write them directly.
+STORAGE_STAGING = "/dev/shm/bench_staging"
+STORAGE_QUOTA = 8 * 1024 ** 3  # Bytes of photos and videos kept, the oldest are removed first
+STORAGE_MIN_FREE = 512 * 1024 ** 2  # Bytes always left free on the SD card
+STORAGE_PENDING = 64 * 1024 ** 2  # Bytes waiting in tmpfs, above this the files are written directly
+STAGE_VIDEOS = False  # Record the video segments on tmpfs, needs room for two segments
+STORAGE_PUBLISH_FREQUENCY = 2000  # How often the storage queue is published, in ms.
+# The camera is set up once in this sensor mode (see camera_session.MODES) and never switched.
+CAMERA_MODE = "video"
+VIDEO_PORT_STILLS = False  # Take every still from the video port, the fastest, even when not recording
+LOCK_INTERVAL_EXPOSURE = True  # Fix the exposure and white balance for each interval series
+# The camera keeps the last PRETRIGGER_SECONDS of video in memory, saved when recording starts, 0 to
+# switch it off.  While it is on the camera is always recording, so stills come from the video port.
+PRETRIGGER_SECONDS = 10
+VIDEO_SEGMENT_SECONDS = 300  # Videos are split into files this long, each remuxed to MP4
+VIDEO_BITRATE = 17000000
+PREVIEW_SIZE = (320, 192)  # Live preview from the video port, a multiple of 32 x 16
+PREVIEW_FPS = 15
+GALLERY_SIZE = (450, 380)  # The gallery of earlier photos in the Camera tab
+GALLERY_CACHE = 120  # Thumbnails kept as PhotoImages, about 60 kB each
+GALLERY_POLL_FREQUENCY = 50  # How often the gallery looks for loaded thumbnails, in ms.
+TREND_SPAN = 3600  # Seconds shown in the Environment tab trend charts.
+
+# Relay GPIOS, all the relays are driven from this table.
+RELAY_CHANNELS = [RelayChannel("lights", 4, "Light"),  # On the relay board
+                  RelayChannel("fan", 22, "Fan"),  # On the relay board
+                  RelayChannel("solder_iron", 6, "Soldering iron"),  # External relay
+                  RelayChannel("hot_air", 26, "Hot air gun"),  # External relay
+                  RelayChannel("ext_plug_one", 17, "External Plug1"),  # External relay plug 1
+                  RelayChannel("ext_plug_two", 27, "External Plug2")]  # External relay plug 2
+# Several relays switched with one button, and one call to pigpiod.
+RELAY_SCENES = {"soldering": {"lights": True, "fan": True, "solder_iron": True}}
+RELAY_RECONCILE_FREQUENCY = 30000  # How often the relay outputs are read back, in ms.
+# Relays switched off automatically, seconds after they were switched on.
+RELAY_AUTO_OFF = {"solder_iron": 30 * 60, "hot_air": 10 * 60}
+
+# The still photo pipeline and the video recorder, set up in the background
+Camera = collections.namedtuple("Camera", ["session", "pipeline", "recorder"])
+# The sensors, the MCP3008 and the acquisition thread, set up in the background
+Environment = collections.namedtuple("Environment", ["sensors", "adc", "acquisition"])
 
 
 class BenchComputer(Frame):
@@ -63,7 +156,12 @@ class BenchComputer(Frame):
                       self.on_closing)  # This will create a pop-up to confirm ending the program, and
         # if there is confirmation it will call the on_closing method
         # to tidy up before closing.
+        # Log messages go to a file and a ring in memory, flushLog shows them in the log panel
+        self.eventLog = EventLog(LOG_LOCATION)
+        self.log = self.eventLog.logger
+
         # Bench control, Tab 1, variables
+        PROFILE.mark("Tk window created")
         self.lightOnImage = PhotoImage(file="icons/light-on.png")
         self.lightOffImage = PhotoImage(file="icons/light-off.png")
         self.fanOnImage = PhotoImage(file="icons/ac-on.png")
@@ -76,56 +174,74 @@ class BenchComputer(Frame):
         self.hairdryerOffImage = PhotoImage(file="icons/hairdryer-off.png")
 
         # Camera, Tab 2 variables
-        # Don't enable the camera if an actual camera is not connected to the RPi
-        self.camera = picamera.PiCamera()
+        # The camera is opened in the background once the window is up, or when it is first used
+        self.cameraSubsystem = Subsystem("camera", self.openCamera, PROFILE, on_error=self.subsystemFailed)
+        self.cameraTabBuilt = False  # The Camera tab is built when it is first selected
+        self.livePreview = None  # Created the first time the live preview is switched on
+        self.livePhoto = None  # The one PhotoImage the live preview frames are loaded into
+        self.livePreviewRefresh = None
+        self.liveStatsShown = 0
+        self.gallery = None  # Created the first time the gallery is shown
+        self.thumbnailLoader = None
+        self.gallerySeries = None  # The interval series whose frames the gallery shows
+        self.galleryOpening = None  # Key of the photo being loaded to be shown from the gallery
+        self.galleryRefresh = None
         self.last_photo = None  # declaring without defining.
+        self.lastPhotoPath = None
         self.isVideoRecording = FALSE
-        self.isTakingIntervalPhotos = FALSE
-        self.intervalStillButtonPressed = FALSE
-        self.intervalImageCounter = 0
+        self.timelapse = None  # The TimelapseEngine while taking interval photos
+        self.storage = StorageWriter([IMAGE_FILE_LOCATION, VIDEO_FILE_LOCATION],
+                                     staging=STORAGE_STAGING if os.path.isdir(os.path.dirname(STORAGE_STAGING))
+                                     else None,
+                                     quota=STORAGE_QUOTA, min_free=STORAGE_MIN_FREE, max_pending=STORAGE_PENDING,
+                                     on_evict=self.storageEvicted, on_error=self.storageFailed)
+        self.overQuotaLogged = False
+        self.lowSpaceLogged = False
+        # Every photo and video with the environment when it was taken
+        self.catalog = CaptureIndex(CATALOG_LOCATION, [IMAGE_FILE_LOCATION, VIDEO_FILE_LOCATION],
+                                    on_error=self.catalogFailed)
         self.photoInterval = 5  # interval in seconds.
         self.directory_interval = None
-        self.file_name_interval = None
-        self.intervalCamera = PhotoImage(file="icons/multiple-shots.png")
-        self.videoCamera = PhotoImage(file="icons/video-camera.png")
-        self.add = PhotoImage(file="icons/add.png")
-        self.remove = PhotoImage(file="icons/minus.png")
-        self.stillCamera = PhotoImage(file="icons/photo-camera.png")
+        self.assembly = None  # The assembler.py process making a video of an interval series
+        self.assemblyDirectory = None
 
         # Environment, Tab 3 variables
-        self.pi = pigpio.pi()
-        # Don't setup the DHT sensor unless a sensor is actually connected
-        self.sensor = DHT22.sensor(self.pi, DHT_SENSOR_PIN)
-        self.clock = PhotoImage(file="icons/clock.png")
-        self.humidity = PhotoImage(file="icons/humidity.png")
-        self.thermometer = PhotoImage(file="icons/thermometer.png")
-        self.light = PhotoImage(file="icons/lightbulb.png")
-
-        # Setup relay GPIOS
-        self.fan_gpio = 22  # On the relay board
-        self.lights_gpio = 4  # On the relay board
-        self.solder_iron_gpio = 6  # External relay
-        self.hot_air_gpio = 26  # External relay
-        self.ext_plug_one_gpio = 17  # External relay plug 1
-        self.ext_plug_two_gpio = 27  # External relay plug 2
-        self.pi.set_mode(self.hot_air_gpio, pigpio.OUTPUT)  # Make output
-        self.pi.set_mode(self.solder_iron_gpio, pigpio.OUTPUT)  # Make output
-        self.pi.set_mode(self.fan_gpio, pigpio.OUTPUT)  # Make output
-        self.pi.set_mode(self.lights_gpio, pigpio.OUTPUT)  # Make output
-        self.pi.set_mode(self.ext_plug_one_gpio, pigpio.OUTPUT)  # Make output
-        self.pi.set_mode(self.ext_plug_two_gpio, pigpio.OUTPUT)  # Make output
-        self.pi.write(self.hot_air_gpio, 0)  # Set to LOW
-        self.pi.write(self.solder_iron_gpio, 0)  # Set to LOW
-        self.pi.write(self.fan_gpio, 0)  # Set to LOW
-        self.pi.write(self.lights_gpio, 0)  # Set to LOW
-        self.pi.write(self.ext_plug_one_gpio, 0)  # Set to LOW
-        self.pi.write(self.ext_plug_two_gpio, 0)  # Set to LOW
+        with PROFILE.phase("connect to pigpiod"):
+            self.pi = pigpio.pi()
+        self.telemetry = telemetry.TelemetryLog(TELEMETRY_LOCATION)
+        # The sensors and the MCP3008 are set up in the background once the window is up
+        self.environmentSubsystem = Subsystem("environment", self.startEnvironment, PROFILE,
+                                              on_error=self.subsystemFailed)
+        self.environmentTabBuilt = False  # The Environment tab is built when it is first selected
+        self.lastReading = None
+        self.stallMonitor = StallMonitor(root)
+        self.history = TimeSeriesStore()  # Fixed size history of the readings
+
+        # Setup relay GPIOS, all switched off
+        self.relays = RelayBank(self.pi, RELAY_CHANNELS, RELAY_SCENES, on_change=self.relayChanged)
+        # Auto-off and other relay timers, all driven by a single root.after
+        self.relayScheduler = relay_scheduler.RelayScheduler(self.relays, root.after, root.after_cancel,
+                                                             on_fire=self.relayTimerFired)
+        self.relayTimersRefresh = None
+
+        # The control API runs on its own thread, state and commands go through the bridge
+        self.controlBridge = StateBridge()
+        self.controlServer = ControlServer(self.controlBridge, CONTROL_HOST, CONTROL_PORT)
+
+        # Prometheus metrics, the bench works without them if the port is taken
+        self.registerMetrics()
+        try:
+            self.metricsServer = metrics.MetricsServer(metrics.REGISTRY, METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            self.metricsServer = None
+            self.log.warning("Metrics not served on port {}: {}".format(METRICS_PORT, e))
 
         self.pack(fill=BOTH, expand=True)
         self.root = root
         self.root.title(PROGRAM_NAME)
         self.root.iconphoto(False, PhotoImage(file='icons/aiot.png'))
-        self.initUI()
+        with PROFILE.phase("build window and Instruments tab"):
+            self.initUI()
 
     def initUI(self):
         self.root.update()  # I call update in order to draw the root window so that I can take its dimensions
@@ -165,13 +281,15 @@ class BenchComputer(Frame):
                             width=self.root.winfo_width() -180,
                             style="large.TNotebook")
         frame1 = Frame()
-        frame2 = Frame()
-        frame3 = Frame()
+        self.cameraFrame = Frame()
+        self.environmentFrame = Frame()
 
         notebook.add(frame1, text="Instruments")
-        notebook.add(frame2, text="Camera")
-        notebook.add(frame3, text="Environment")
+        notebook.add(self.cameraFrame, text="Camera")
+        notebook.add(self.environmentFrame, text="Environment")
         notebook.pack(pady=5, side=LEFT)
+        self.notebook = notebook
+        notebook.bind("<<NotebookTabChanged>>", self.tabChanged)
 
         # Create the log text area
         log_label = Label(self, text="Log")
@@ -184,6 +302,7 @@ class BenchComputer(Frame):
                                 height=self.root.winfo_height(),
                                 width=180)
         self.log_textBox.pack(side=RIGHT)
+        self.logLines = 0  # Lines in log_textBox
 
         # Styles
         buttonStyle = Style()
@@ -219,6 +338,10 @@ class BenchComputer(Frame):
                                      font=('Helvetica', '30'),
                                      padding=(0, 10, 0, 0),
                                      justify=LEFT)
+        intervalLabelStyle.configure("EnrironmentSensor.TLabel",
+                                     font=('Helvetica', '12'),
+                                     padding=(0, 2, 0, 0),
+                                     justify=LEFT)
 
         cameraInfoLabelStyle = Style()
         cameraInfoLabelStyle.configure("cameraInfoLabel.TLabel",
@@ -240,359 +363,1011 @@ class BenchComputer(Frame):
 
         self.lights1_button = Button(frame1,
                                      text="Lights 1",
-                                     command=self.lightsToggle,
+                                     command=lambda: self.toggleRelay("lights"),
                                      image=self.lightOffImage,
                                      style="Normal.TButton")
         self.lights1_button.grid(row=0,
                                  column=0, sticky=W+E+N+S, padx=5, pady = 5)
         self.extractor_button = Button(frame1,
                                        text="Extractor",
-                                       command=self.toggleFan,
+                                       command=lambda: self.toggleRelay("fan"),
                                        image=self.fanOffImage,
                                        style="Normal.TButton")
         self.extractor_button.grid(row=0,
                                    column=1, sticky=W+E+N+S, padx=5, pady = 5)
         self.solder_button = Button(frame1,
                                     text="solder",
-                                    command=self.bigRelay1,
+                                    command=lambda: self.toggleRelay("solder_iron"),
                                     image=self.ironOffImage,
                                     style="Normal.TButton")
         self.solder_button.grid(row=0,
                                 column=2, sticky=W+E+N+S, padx=5, pady = 5)
         self.hotairgun_button = Button(frame1,
                                        text="Hot air gun",
-                                       command=self.bigRelay2,
+                                       command=lambda: self.toggleRelay("hot_air"),
                                        image=self.hairdryerOffImage,
                                        style="Normal.TButton")
         self.hotairgun_button.grid(row=1,
                                    column=0, sticky=W+E+N+S, padx=5, pady = 5)
         self.plug_one_button = Button(frame1,
                                  text="GPIO 17",
-                                 command   = self.extplugone,
+                                 command   = lambda: self.toggleRelay("ext_plug_one"),
                                  image=self.gpioOFFImage,
                                  style="Normal.TButton")
         self.plug_one_button.grid(row=1,
                              column=1, sticky=W+E+N+S, padx=5, pady = 5)
         self.plug_two_button = Button(frame1,
                                  text="GPIO 27",
-                                 command   = self.extplugtwo,
+                                 command   = lambda: self.toggleRelay("ext_plug_two"),
                                  image=self.gpioOFFImage,
                                  style="Normal.TButton")
         self.plug_two_button.grid(row=1,
                              column=2, sticky=W+E+N+S, padx=5, pady = 5)
+        allOffButton = Button(frame1,
+                              text="All off",
+                              command=self.relays.all_off,
+                              style="Normal.TButton")
+        allOffButton.grid(row=2,
+                          column=0, sticky=W+E+N+S, padx=5, pady = 5)
+        solderingSceneButton = Button(frame1,
+                                      text="Soldering",
+                                      command=lambda: self.relays.scene("soldering"),
+                                      style="Normal.TButton")
+        solderingSceneButton.grid(row=2,
+                                  column=1, sticky=W+E+N+S, padx=5, pady = 5)
+
+        # Button and on/off images of every relay
+        self.relayButtons = {"lights": (self.lights1_button, self.lightOnImage, self.lightOffImage),
+                             "fan": (self.extractor_button, self.fanOnImage, self.fanOffImage),
+                             "solder_iron": (self.solder_button, self.ironOnImage, self.ironOffImage),
+                             "hot_air": (self.hotairgun_button, self.hairdryerOnImage, self.hairdryerOffImage),
+                             "ext_plug_one": (self.plug_one_button, self.gpioONImage, self.gpioOFFImage),
+                             "ext_plug_two": (self.plug_two_button, self.gpioONImage, self.gpioOFFImage)}
+
+    def tabChanged(self, event):
+        # The Camera and Environment tabs are only built when they are first shown
+        selected = self.notebook.select()
+        if selected == str(self.cameraFrame):
+            self.buildCameraTab()
+        elif selected == str(self.environmentFrame):
+            self.buildEnvironmentTab()
+
+    def buildCameraTab(self):
+        if self.cameraTabBuilt:
+            return
+        self.cameraTabBuilt = True
+
+        with PROFILE.phase("build Camera tab"):
+            self.intervalCamera = PhotoImage(file="icons/multiple-shots.png")
+            self.videoCamera = PhotoImage(file="icons/video-camera.png")
+            self.add = PhotoImage(file="icons/add.png")
+            self.remove = PhotoImage(file="icons/minus.png")
+            self.stillCamera = PhotoImage(file="icons/photo-camera.png")
+
+            self.cameraFrameLeft = Frame(self.cameraFrame,
+                                         height=self.root.winfo_height(),
+                                         width=150,
+                                         relief=SUNKEN)
+
+            self.cameraFrameLeft.pack(pady=1,
+                                      side=LEFT)
+
+            self.cameraFrameRight = Frame(self.cameraFrame,
+                                          height=self.root.winfo_height(),
+                                          width=450,
+                                          relief=SUNKEN)  # This frame will contain the image preview
+            self.cameraFrameRight.pack(pady=1,
+                                       side=RIGHT)
+            self.photoPreview = Label(self.cameraFrameRight)
+            self.photoPreview.grid(row=0, column=0)
+
+            stillPhotoButton = Button(self.cameraFrameLeft,
+                                      text="Still",
+                                      command=self.take_still,
+                                      image=self.stillCamera,
+                                      style="Normal.TButton")
+
+            stillPhotoButton.grid(row=0,
+                                  column=0,
+                                  rowspan=1)
+
+            intervalPhotoButton = Button(self.cameraFrameLeft,
+                                         text="Interval",
+                                         command=self.startIntervalStill,
+                                         image=self.intervalCamera,
+                                         style="Normal.TButton")
+
+            intervalPhotoButton.grid(row=1,
+                                     column=0,
+                                     rowspan=1)
+
+            videoButton = Button(self.cameraFrameLeft,
+                                 text="Video",
+                                 command=self.toggleVideo,
+                                 image=self.videoCamera,
+                                 style="Normal.TButton")
+
+            videoButton.grid(row=4,
+                             column=0,
+                             rowspan=2)
+
+            eventButton = Button(self.cameraFrameLeft,
+                                 text="Save last {}s".format(PRETRIGGER_SECONDS),
+                                 command=self.saveVideoEvent,
+                                 style="Normal.TButton")
+
+            if PRETRIGGER_SECONDS:
+                eventButton.grid(row=6,
+                                 column=0)
+
+            self.assemblyButton = Button(self.cameraFrameLeft,
+                                         text="Make video",
+                                         command=self.toggleTimelapseVideo,
+                                         style="Normal.TButton")
+
+            self.assemblyButton.grid(row=7,
+                                     column=0)
+
+            self.assemblyStatus = Label(self.cameraFrameLeft,
+                                        text="",
+                                        style="cameraInfoLabel.TLabel")
+
+            self.assemblyStatus.grid(row=7,
+                                     column=1,
+                                     columnspan=3)
+
+            self.intervalText = Label(self.cameraFrameLeft,
+                                      text="Interval: {}s\n".format(self.photoInterval),
+                                      style="IntervalLabel.TLabel")
+
+            increaseInterval = Button(self.cameraFrameLeft,
+                                      text="Increase",
+                                      command=self.increase_photo_interval,
+                                      image=self.add,
+                                      style="Normal.TButton")
 
-        # Create the UI in the Camera tab (frame2)
-        self.cameraFrameLeft = Frame(frame2,
-                                     height=self.root.winfo_height(),
-                                     width=150,
-                                     relief=SUNKEN)
-
-        self.cameraFrameLeft.pack(pady=1,
-                                  side=LEFT)
-
-        self.cameraFrameRight = Frame(frame2,
-                                      height=self.root.winfo_height(),
-                                      width=450,
-                                      relief=SUNKEN)  # This frame will contain the image preview
-        self.cameraFrameRight.pack(pady=1,
-                                   side=RIGHT)
-
-        stillPhotoButton = Button(self.cameraFrameLeft,
-                                  text="Still",
-                                  command=self.take_still,
-                                  image=self.stillCamera,
-                                  style="Normal.TButton")
-
-        stillPhotoButton.grid(row=0,
-                              column=0,
-                              rowspan=1)
-
-        intervalPhotoButton = Button(self.cameraFrameLeft,
-                                     text="Interval",
-                                     command=self.startIntervalStill,
-                                     image=self.intervalCamera,
+            decreaseInterval = Button(self.cameraFrameLeft,
+                                      text="Decrease",
+                                      command=self.decrease_photo_interval,
+                                      image=self.remove,
+                                      style="Normal.TButton")
+
+            self.intervalText.grid(row=0,
+                                   column=1,
+                                   columnspan=2,
+                                   rowspan=1)
+
+            increaseInterval.grid(row=1,
+                                  column=2)
+
+            decreaseInterval.grid(row=1,
+                                  column=3)
+
+            self.liveButton = Button(self.cameraFrameLeft,
+                                     text="Live",
+                                     command=self.toggleLivePreview,
                                      style="Normal.TButton")
 
-        intervalPhotoButton.grid(row=1,
+            self.liveButton.grid(row=2,
                                  column=0,
                                  rowspan=1)
 
-        videoButton = Button(self.cameraFrameLeft,
-                             text="Video",
-                             command=self.toggleVideo,
-                             image=self.videoCamera,
-                             style="Normal.TButton")
-
-        videoButton.grid(row=4,
-                         column=0,
-                         rowspan=2)
-
-        self.intervalText = Label(self.cameraFrameLeft,
-                                  text="Interval: {}s\n".format(self.photoInterval),
-                                  style="IntervalLabel.TLabel")
-
-        increaseInterval = Button(self.cameraFrameLeft,
-                                  text="Increase",
-                                  command=self.increase_photo_interval,
-                                  image=self.add,
-                                  style="Normal.TButton")
-
-        decreaseInterval = Button(self.cameraFrameLeft,
-                                  text="Decrease",
-                                  command=self.decrease_photo_interval,
-                                  image=self.remove,
-                                  style="Normal.TButton")
-
-        self.intervalText.grid(row=0,
-                               column=1,
-                               columnspan=2,
-                               rowspan=1)
-
-        increaseInterval.grid(row=1,
-                              column=2)
-
-        decreaseInterval.grid(row=1,
-                              column=3)
-
-        self.cameraStatus = Label(self.cameraFrameLeft,
-                                  text="NOT RECORDING",
-                                  style="cameraInfoLabel.TLabel")
+            self.galleryButton = Button(self.cameraFrameLeft,
+                                        text="Gallery",
+                                        command=self.toggleGallery,
+                                        style="Normal.TButton")
+
+            self.galleryButton.grid(row=3,
+                                    column=0,
+                                    rowspan=1)
+
+            self.liveStatus = Label(self.cameraFrameLeft,
+                                    text="",
+                                    style="cameraInfoLabel.TLabel")
+
+            self.liveStatus.grid(row=2,
+                                 column=1,
+                                 columnspan=3)
+
+            self.cameraStatus = Label(self.cameraFrameLeft,
+                                      text="NOT RECORDING",
+                                      style="cameraInfoLabel.TLabel")
                                   
 
-        self.cameraStatus.grid(row=4,
-                               column=2,
-                               columnspan=2)
-
-        # Create the UI in the Environment tab (frame3)
-        temperatureLabel = Label(frame3, image=self.thermometer)
-        humidityLabel = Label(frame3, image=self.humidity)
-        timedateLabel = Label(frame3, image=self.clock)
-        lightlevelLabel = Label(frame3, image=self.light)
-
-        temperatureLabel.grid(row=0, column=0)
-        humidityLabel.grid(row=1, column=0)
-        lightlevelLabel.grid(row=2, column=0)
-        timedateLabel.grid(row=3, column=0)
-
-        self.temperatureLabel = Label(frame3, text="-", style="Enrironment.TLabel")
-        self.temperatureLabel.grid(row=0, column=1)
-        self.temperatureUnitLabel = Label(frame3, text="\u00b0C", style="Enrironment.TLabel")
-        self.temperatureUnitLabel.grid(row=0, column=2)
+            self.cameraStatus.grid(row=4,
+                                   column=2,
+                                   columnspan=2)
+
+    def buildEnvironmentTab(self):
+        if self.environmentTabBuilt:
+            return
+        self.environmentTabBuilt = True
+
+        with PROFILE.phase("build Environment tab"):
+            self.clock = PhotoImage(file="icons/clock.png")
+            self.humidity = PhotoImage(file="icons/humidity.png")
+            self.thermometer = PhotoImage(file="icons/thermometer.png")
+            self.light = PhotoImage(file="icons/lightbulb.png")
+
+            temperatureLabel = Label(self.environmentFrame, image=self.thermometer)
+            humidityLabel = Label(self.environmentFrame, image=self.humidity)
+            timedateLabel = Label(self.environmentFrame, image=self.clock)
+            lightlevelLabel = Label(self.environmentFrame, image=self.light)
+
+            temperatureLabel.grid(row=0, column=0)
+            humidityLabel.grid(row=1, column=0)
+            lightlevelLabel.grid(row=2, column=0)
+            timedateLabel.grid(row=3, column=0)
+
+            self.temperatureLabel = Label(self.environmentFrame, text="-", style="Enrironment.TLabel")
+            self.temperatureLabel.grid(row=0, column=1)
+            self.temperatureUnitLabel = Label(self.environmentFrame, text="\u00b0C", style="Enrironment.TLabel")
+            self.temperatureUnitLabel.grid(row=0, column=2)
         
-        self.humidityLabel = Label(frame3, text="-", style="Enrironment.TLabel")
-        self.humidityLabel.grid(row=1, column=1)
-        self.humidityUnitLabel = Label(frame3, text="%", style="Enrironment.TLabel")
-        self.humidityUnitLabel.grid(row=1, column=2)
+            self.humidityLabel = Label(self.environmentFrame, text="-", style="Enrironment.TLabel")
+            self.humidityLabel.grid(row=1, column=1)
+            self.humidityUnitLabel = Label(self.environmentFrame, text="%", style="Enrironment.TLabel")
+            self.humidityUnitLabel.grid(row=1, column=2)
         
-        self.lightlevelLabel = Label(frame3,text="-", style="Enrironment.TLabel")
-        self.lightlevelLabel.grid(row=2, column=1)
-        self.lightlevelUnitLabel = Label(frame3, text="%", style="Enrironment.TLabel")
-        self.lightlevelUnitLabel.grid(row=2, column=2)
+            self.lightlevelLabel = Label(self.environmentFrame,text="-", style="Enrironment.TLabel")
+            self.lightlevelLabel.grid(row=2, column=1)
+            self.lightlevelUnitLabel = Label(self.environmentFrame, text="%", style="Enrironment.TLabel")
+            self.lightlevelUnitLabel.grid(row=2, column=2)
+
+            # Trend charts of the last TREND_SPAN seconds, only new segments are drawn
+            sensorName = DHT_SENSORS[0][0]
+            self.trends = [Sparkline(self.environmentFrame, self.history[sensorName + ".temperature"],
+                                     span=TREND_SPAN, low=10, high=40, color="#dd0202"),
+                           Sparkline(self.environmentFrame, self.history[sensorName + ".humidity"],
+                                     span=TREND_SPAN, low=0, high=100),
+                           Sparkline(self.environmentFrame, self.history["light"],
+                                     span=TREND_SPAN, low=0, high=100, color="#30903C")]
+            for row, trend in enumerate(self.trends):
+                trend.grid(row=row, column=3, padx=10)
         
-        self.environmentTimeLabel = Label(frame3, text=datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
-                                          style="EnrironmentTime.TLabel")
-        self.environmentTimeLabel.grid(row=3, column=1, columnspan=5)
-
-     
+            self.environmentTimeLabel = Label(self.environmentFrame, text=datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
+                                              style="EnrironmentTime.TLabel")
+            self.environmentTimeLabel.grid(row=3, column=1, columnspan=5)
+
+            # One line for every DHT22 sensor on the bench
+            self.sensorLabels = []
+            for i, (name, gpio) in enumerate(DHT_SENSORS):
+                sensorLabel = Label(self.environmentFrame, text="{}: -".format(name), style="EnrironmentSensor.TLabel")
+                sensorLabel.grid(row=4 + i, column=0, columnspan=6, sticky=W)
+                self.sensorLabels.append(sensorLabel)
+
+        if self.lastReading is not None:
+            self.showEnvironment(self.lastReading)
+
+    # Subsystems, set up in the background or on first use
+    def openCamera(self):
+        global ImageTk
+        import picamera
+        from PIL import ImageTk
+        from camera_session import CameraSession
+        from capture import CapturePipeline
+        from recorder import Remuxer, VideoRecorder
+
+        # The mode and the rotation are set once here, no capture waits for the camera to switch
+        session = CameraSession(picamera.PiCamera(), CAMERA_MODE, rotation=90, video_stills=VIDEO_PORT_STILLS)
+        session.open()
+        camera = session.camera
+
+        # Photos are taken, saved and scaled down on a worker thread
+        capturePipeline = CapturePipeline(session, storage=self.storage)
+        capturePipeline.start()
+
+        # Videos are recorded in segments, remuxed to MP4 in the background
+        remuxer = Remuxer(camera.framerate, on_done=self.videoSaved)
+        remuxer.start()
+        staging = self.storage.staging if STAGE_VIDEOS else None
+        recorder = VideoRecorder(session, staging or VIDEO_FILE_LOCATION, pretrigger=PRETRIGGER_SECONDS,
+                                 segment=VIDEO_SEGMENT_SECONDS, bitrate=VIDEO_BITRATE, remuxer=remuxer)
+        recorder.arm()
+        return Camera(session, capturePipeline, recorder)
+
+    def cameraReady(self):
+        # The Tk handlers don't wait for the camera to be opened, they are pressed again once it is.
+        if self.cameraSubsystem.ready:
+            return True
+        self.log.warning("The camera is not ready yet")
+        self.cameraSubsystem.prefetch()
+        return False
+
+    @property
+    def cameraSession(self):
+        return self.cameraSubsystem.get().session
+
+    @property
+    def capturePipeline(self):
+        return self.cameraSubsystem.get().pipeline  # Waits for the camera if it is still being opened
+
+    @property
+    def videoRecorder(self):
+        return self.cameraSubsystem.get().recorder
+
+    @property
+    def camera(self):
+        return self.capturePipeline.camera
+
+    def startEnvironment(self):
+        from dht_group import SensorGroup
+        from adc import ADCSampler, LightCalibration
+
+        # Don't setup the DHT sensors unless the sensors are actually connected
+        sensors = SensorGroup(self.pi)
+        for name, gpio in DHT_SENSORS:
+            sensors.add(name, gpio)
+        # The MCP3008 is opened once and sampled continuously in the background.
+        # Dont forget to first install the gpiozero module.
+        adc = ADCSampler(**ADC_PINS)
+        # The sensors are read on a background thread, never on the Tk thread.
+        acquisition = AcquisitionEngine(sensors, adc, interval=DHT_FREQUENCY / 1000.,
+                                        light_channel=LDR_CHANNEL,
+                                        calibration=LightCalibration(LDR_CALIBRATION))
+        adc.start()
+        acquisition.start()
+        return Environment(sensors, adc, acquisition)
+
+    def subsystemFailed(self, name, error):
+        # Called on the thread which tried to set the subsystem up, the log is thread safe
+        self.log.warning("Could not start the {}: {}".format(name, error))
 
     # Environment - Tab 3 - methods
     def getDHTreadings(self):
-        # Here is how to implement the sensor so that SUDO is not required
-        # http://www.rototron.info/dht22-tutorial-for-raspberry-pi/
-        # This works ok with Python 3
-
-        self.sensor.trigger()
-        sleep(.2)  # Necessary on faster Raspberry Pi's BUT I WILL NEED TO FIND A NON-BLOCKING WAY TO DELAY
-        # SLEEP SHOULD NOT BE USED IN A GUI APPLICATION!!!
+        # The sensor and the MCP3008 are read by the acquisition engine on its own thread.
+        # Here we only pick up the newest reading, this never blocks the GUI.
+        environment = self.environmentSubsystem.value
+        if environment is not None:
+            reading = environment.acquisition.latest()
+            if reading is not None:
+                self.showReading(reading)
+
+        self.root.after(READING_POLL_FREQUENCY, self.getDHTreadings)
+
+    def showReading(self, reading):
+        self.history.append_reading(reading)
+        self.telemetry.environment(reading, LDR_CHANNEL)
+        self.controlBridge.publish("environment", dict(reading._asdict(),
+                                                       sensors=[s._asdict() for s in reading.sensors]))
+        self.lastReading = reading
+        if self.environmentTabBuilt:
+            self.showEnvironment(reading)
+
+    def showEnvironment(self, reading):
+        for trend in self.trends:
+            trend.refresh()
 
         # To convert Celsius to Farenheit, use this formula: (°C × 9/5) + 32 = °F
-        temperature = self.sensor.temperature()
-        humidity = self.sensor.humidity()
-        ldr = MCP3008(channel=0, clock_pin=18, mosi_pin=24, miso_pin=23, select_pin=25) 
-        light = round((100-(ldr.value*100)),2) # Dont forget to first install the gpiozero module and then...
-                                               # ...add "from gpiozero import MCP3008" in the initial imports...
-
-        self.temperatureLabel.config(text="{:3.2f}".format(temperature / 1.))
-        self.humidityLabel.config(text="{:3.2f}".format(humidity / 1.))
-        self.lightlevelLabel.config(text="{:3.2f}".format(light / 1.))
-        self.environmentTimeLabel.config(text=datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
-        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))  # Prints out to the terminal
-        print("{:3.2f}, {:3.2f}".format(temperature / 1., humidity / 1.))  # Prints out to the terminal
-
-        self.root.after(DHT_FREQUENCY, self.getDHTreadings)
+        timestamp = datetime.datetime.fromtimestamp(reading.timestamp).strftime("%Y-%m-%d %H:%M")
+
+        if reading.temperature is not None:
+            self.temperatureLabel.config(text="{:3.2f}".format(reading.temperature / 1.))
+            self.humidityLabel.config(text="{:3.2f}".format(reading.humidity / 1.))
+        if reading.light is not None:
+            self.lightlevelLabel.config(text="{:3.2f}".format(reading.light / 1.))
+        self.environmentTimeLabel.config(text=timestamp)
+        print(timestamp)  # Prints out to the terminal
+
+        for sensorLabel, state in zip(self.sensorLabels, reading.sensors):
+            if state.temperature is None:
+                values = "-"
+            else:
+                values = "{:3.1f}\u00b0C {:3.1f}% {:.0f}s ago".format(
+                    state.temperature, state.humidity, state.staleness)
+            sensorLabel.config(text="{}: {}  [{}]  errors CS {} SM {} MM {}  resets {}".format(
+                state.name, values, state.status, state.bad_checksum, state.short_message,
+                state.missing_message, state.sensor_resets))
+            print("{}: {}, {}".format(state.name, values, state.status))  # Prints out to the terminal
 
     # Camera - Tab 2 - methods
     def startIntervalStill(self):
-        if self.intervalStillButtonPressed == FALSE:
-            self.intervalStillButtonPressed = TRUE
-            self.log_textBox.insert(0.0, "Pressed interval photo button. Interval button pressed is TRUE.\n")
-            self.cameraStatus.config(text="Taking interval still images...")
-            self.takeIntervalStill()
-        else:
-            self.intervalStillButtonPressed = FALSE
-            self.log_textBox.insert(0.0, "Pressed interval photo button. Interval button pressed is FALSE.\n")
-            self.cameraStatus.config(text="")
-
-    def takeIntervalStill(self):
-        # This method works like this:
-        # Say the interval is set to 5 seconds
-        # First, the method is called and the first photo is taken, and shown in the frame.
-        # Second, this method is scheduled to be called again using the tkinter
-        # root "after" method, at the set interval, unless the user has cancelled the
-        # interval photo function by pressing the button again.
-        if self.isTakingIntervalPhotos == FALSE and self.intervalStillButtonPressed == TRUE:
+        # Interval photos are taken by the TimelapseEngine on its own thread. Frame n is due
+        # at start + n * interval, so processing time does not add up to drift.
+        if self.timelapse is None:
+            if not self.cameraReady():
+                return
+            from timelapse import TimelapseEngine
             self.directory_interval = '{}/Interval_{}'.format(IMAGE_FILE_LOCATION,
                                                               datetime.datetime.now().strftime("%B_%d_%y_%H_%M_%S"))
-            # self.directory_interval       = '../photos/Interval_{}'.format(datetime.datetime.now().strftime("%B_%d_%y_%H_%M_%S"))
-            if not os.path.exists(self.directory_interval):
-                os.makedirs(self.directory_interval)
-                self.file_name_interval = '{}/{}.jpg'.format(self.directory_interval, self.intervalImageCounter)
-                self.intervalImageCounter += 1
-                self.log_textBox.insert(0.0, "Taking an image every {} seconds, storing at location {}.\n".format(
-                    self.photoInterval, self.directory_interval))
-                self.isTakingIntervalPhotos = TRUE
-                self.root.after(self.photoInterval, self.takeIntervalStill)
-            else:
-                self.log_textBox.insert(0.0,
-                                        "Ended recording interval photos. Total {} taken, stored at location {}.\n".format(
-                                            self.intervalImageCounter, self.interval))
-                self.intervalImageCounter = 0
-
-        if self.isTakingIntervalPhotos == TRUE and self.intervalStillButtonPressed == TRUE:
-            self.intervalImageCounter += 1
-            self.file_name_interval = '{}/{}.jpg'.format(self.directory_interval, self.intervalImageCounter)
-            self.camera.rotation = 90
-            self.camera.capture(self.file_name_interval)
-            self.log_textBox.insert(0.0, "Captured interval image {}\n".format(self.file_name_interval))
-            image = Image.open(self.file_name_interval)
-            image = image.resize((350, 210), Image.ANTIALIAS)
-            self.last_photo = ImageTk.PhotoImage(image)
-            Label(self.cameraFrameRight, image=self.last_photo).grid(row=0, column=0)
-            self.root.after(self.photoInterval * 1000, self.takeIntervalStill)
+            changeDetector = None
+            if CHANGE_DETECTION is not None:
+                try:
+                    from change_detect import ChangeDetector
+                    changeDetector = ChangeDetector(**CHANGE_DETECTION)
+                except ImportError as e:
+                    self.log.warning("Storing every interval image, change detection needs numpy: {}".format(e))
+            self.timelapse = TimelapseEngine(self.cameraSession, self.directory_interval, self.photoInterval,
+                                             on_saved=self.intervalImageSaved,
+                                             change_detector=changeDetector, unchanged=UNCHANGED_FRAMES,
+                                             storage=self.storage, lock_exposure=LOCK_INTERVAL_EXPOSURE)
+            self.timelapse.start()
+            self.log.info("Taking an image every {} seconds, storing at location {}.".format(
+                self.photoInterval, self.directory_interval))
+            self.cameraStatus.config(text="Taking interval still images...")
+            self.telemetry.camera(telemetry.INTERVAL_START)
+            self.publishCamera("interval start")
+        elif not self.timelapse.stopping:
+            # Don't wait here for the last frames to be saved, pollCaptures reports the end.
+            self.timelapse.stop(timeout=0)
+            self.timelapse.stopping = True
+            self.cameraStatus.config(text="Saving interval still images...")
+
+    def intervalImageSaved(self, frame, path):
+        # Called on the timelapse writer thread, the telemetry log and the catalog are thread safe.
+        self.telemetry.camera(telemetry.INTERVAL_FRAME, frame)
+        self.catalog.add(path, "interval", self.lastReading)
+
+    def showIntervalPreview(self):
+        timelapse = self.timelapse
+        preview = timelapse.latest_preview()
+        if preview is not None:
+            frame, thumbnail = preview
+            self.last_photo = ImageTk.PhotoImage(thumbnail)
+            if not self.liveRunning():
+                self.photoPreview.config(image=self.last_photo)
+            self.log.info("Captured interval image {} ({} skipped)".format(
+                frame, timelapse.skipped))
+
+        if timelapse.stopping and not timelapse.is_alive():
+            self.timelapse = None
+            self.log.info("Ended recording interval photos. Total {} taken, {} skipped, {:.2f} fps, "
+                          "mean lateness {:.0f} ms, stored at location {}.".format(
+                              timelapse.written, timelapse.skipped, timelapse.fps(),
+                              timelapse.mean_lateness() * 1000, timelapse.directory))
+            detector = timelapse.change_detector
+            if detector is not None:
+                self.log.info("{} unchanged images not stored, {:.1f} MB saved ({:.0f}%), "
+                              "{:.1f} ms per image to check.".format(
+                                  detector.skipped, detector.bytes_saved / 1e6, detector.saved_fraction() * 100,
+                                  detector.mean_check_time() * 1000))
+            if timelapse.failed:
+                self.log.warning("{} interval photos could not be saved: {}".format(timelapse.failed,
+                                                                                    timelapse.error))
+            elif timelapse.error is not None:
+                self.log.warning("Interval photos stopped by an error: {}".format(timelapse.error))
+            self.cameraStatus.config(text="")
+            self.telemetry.camera(telemetry.INTERVAL_STOP, timelapse.written)
+            self.publishCamera("interval stop")
+
+    def lastIntervalSeries(self):
+        if self.directory_interval is not None:
+            return self.directory_interval
+        try:
+            series = [name for name in os.listdir(IMAGE_FILE_LOCATION) if name.startswith("Interval_")]
+        except OSError:
+            return None
+        if not series:
+            return None
+        return max((os.path.join(IMAGE_FILE_LOCATION, name) for name in series), key=os.path.getmtime)
+
+    def toggleTimelapseVideo(self):
+        # The video of the last interval series is made by assembler.py in a process of its own, which
+        # uses a pool of processes.  Stopped, it starts again from the last finished part.
+        if self.assembly is not None:
+            self.assembly.terminate()
+            self.assemblyButton.config(text="Stopping...")
+            return
+
+        directory = self.lastIntervalSeries()
+        if directory is None:
+            self.log.warning("No interval series to make a video of")
+            return
+        if self.timelapse is not None and self.timelapse.directory == directory:
+            self.log.warning("Interval photos are still being taken, stop them before making the video")
+            return
+
+        progress = assembler.read_progress(directory)
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "assembler.py"),
+                   directory] + ["{}={}".format(name, value) for name, value in TIMELAPSE_VIDEO.items()]
+        with open(os.path.join(directory, "timelapse.log"), "w") as output:
+            self.assembly = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT,
+                                             preexec_fn=lambda: os.nice(5))
+        self.assemblyDirectory = directory
+        self.assemblyButton.config(text="Stop video")
+        self.log.info("{} the video of {}".format("Resuming" if progress else "Making", directory))
+        self.root.after(ASSEMBLY_POLL_FREQUENCY, self.pollTimelapseVideo)
+
+    def pollTimelapseVideo(self):
+        progress = assembler.read_progress(self.assemblyDirectory)
+        if progress is not None and progress.get("total"):
+            self.assemblyStatus.config(text="Video {}/{} frames  {:.1f} fps".format(
+                progress["done"], progress["total"], progress["fps"]))
+
+        returncode = self.assembly.poll()
+        if returncode is None:
+            self.root.after(ASSEMBLY_POLL_FREQUENCY, self.pollTimelapseVideo)
+            return
+
+        self.assembly = None
+        self.assemblyButton.config(text="Make video")
+        with open(os.path.join(self.assemblyDirectory, "timelapse.log")) as output:
+            lines = output.read().strip().splitlines()
+        result = lines[-1] if lines else "exit code {}".format(returncode)
+        if returncode == 0:
+            path = os.path.join(self.assemblyDirectory, assembler.OUTPUT_FILE)
+            self.log.info("Timelapse video {}".format(result))
+            self.assemblyStatus.config(text="")
+            self.storage.track(path)
+            self.catalog.add(path, "video")
+            self.publishCamera("timelapse video")
+        else:
+            self.log.warning("Timelapse video stopped: {}".format(result))
+            self.assemblyStatus.config(text="Video stopped, press to resume")
 
     def toggleVideo(self):
         if self.isVideoRecording == FALSE:
+            if not self.cameraReady():
+                return
             self.isVideoRecording = TRUE
-            file_name = '{}/{}.h264'.format(VIDEO_FILE_LOCATION, datetime.datetime.now().strftime("%B_%d_%y_%H_%M_%S"))
-            self.log_textBox.insert(0.0, "Video is recording: {}\n".format(file_name))
-            self.camera.rotation = 90
-            self.camera.start_recording(file_name)
+            name = self.videoRecorder.start()
+            self.log.info("Video is recording: {}/{}_*, with the {} seconds before".format(
+                VIDEO_FILE_LOCATION, name, PRETRIGGER_SECONDS))
+            self.telemetry.camera(telemetry.VIDEO_START)
+            self.publishCamera("video start")
             self.cameraStatus.config(text="RECORDING...");
         else:
             self.isVideoRecording = FALSE
-            self.log_textBox.insert(0.0, "Video is stopped\n")
-            self.camera.stop_recording()
+            self.log.info("Video is stopped")
+            self.videoRecorder.stop()
+            self.telemetry.camera(telemetry.VIDEO_STOP)
+            self.publishCamera("video stop")
             self.cameraStatus.config(text="NOT RECORDING");
 
+    def saveVideoEvent(self, event="event"):
+        # Save the last seconds of video without recording
+        if not self.cameraReady():
+            return None
+        path = self.videoRecorder.save_event(event)
+        if path is None:
+            self.log.warning("No video to save, the camera is recording or not keeping the last seconds")
+        else:
+            self.log.info("Saving the last {} seconds of video to {}".format(PRETRIGGER_SECONDS, path))
+            self.publishCamera(event)
+        return path
+
+    def videoSaved(self, path):
+        # Called on the remuxer thread with every finished video file
+        if STAGE_VIDEOS and self.storage.staging is not None:
+            finalPath = os.path.join(VIDEO_FILE_LOCATION, os.path.basename(path))
+            self.storage.add(path, finalPath)
+        else:
+            finalPath = path
+            self.storage.track(path)
+        width, height = self.camera.resolution
+        self.catalog.add(finalPath, "video", self.lastReading, width=width, height=height)
+        self.log.info("Video saved: {}".format(os.path.basename(path)))
+
     def increase_photo_interval(self):
-        self.photoInterval += 1
-        self.log_textBox.insert(0.0, "Interval: {}s\n".format(self.photoInterval))
+        if self.photoInterval < 1:
+            self.photoInterval = ([step for step in SUBSECOND_INTERVALS if step > self.photoInterval] + [1])[0]
+        else:
+            self.photoInterval += 1
+        self.log.info("Interval: {}s".format(self.photoInterval))
         self.intervalText.config(text="Interval: {}s\n".format(self.photoInterval), style="IntervalLabel.TLabel")
 
     def decrease_photo_interval(self):
         if self.photoInterval > 1:
             self.photoInterval -= 1
-        self.log_textBox.insert(0.0, "Interval: {}s\n".format(self.photoInterval))
+        else:
+            self.photoInterval = ([step for step in SUBSECOND_INTERVALS if step < self.photoInterval]
+                                  or [SUBSECOND_INTERVALS[0]])[-1]
+        self.log.info("Interval: {}s".format(self.photoInterval))
         self.intervalText.config(text="Interval: {}s\n".format(self.photoInterval), style="IntervalLabel.TLabel")
 
     def take_still(self):
-        self.log_textBox.insert(0.0, "Capturing image...\n")
+        if not self.cameraReady():
+            return
+        self.log.info("Capturing image...")
         file_name = '{}/{}.jpg'.format(IMAGE_FILE_LOCATION, datetime.datetime.now().strftime("%B_%d_%y_%H_%M_%S"))
-        self.camera.rotation = 90
-        self.camera.capture(file_name)
-        self.log_textBox.insert(0.0, "Captured image {}\n".format(file_name))
-
-        image = Image.open(file_name)
-        image = image.resize((360, 216), Image.ANTIALIAS)
-        self.last_photo = ImageTk.PhotoImage(image)
-        Label(self.cameraFrameRight, image=self.last_photo).grid(row=0, column=0)
-
-    # Bench control - Tab 1 - methods
-    def bigRelay1(self):
-        # The following works with the Keyestudio 4 Channel Relay HAT
-        if self.pi.read(self.solder_iron_gpio) == 0:
-            relay_value = "ON"
-            self.solder_button.config(image=self.ironOnImage, style="Selected.TButton")
-            self.pi.write(self.solder_iron_gpio, 1)
-        else:
-            relay_value = "OFF"
-            self.solder_button.config(image=self.ironOffImage, style="Normal.TButton")
-            self.pi.write(self.solder_iron_gpio, 0)
-        self.log_textBox.insert(0.0, "Soldering iron is {}\n".format(relay_value))        
-
-    def bigRelay2(self):
-        # The following works with the Keyestudio 4 Channel Relay HAT
-        if self.pi.read(self.hot_air_gpio) == 0:
-            relay_value = "ON"
-            self.hotairgun_button.config(image=self.hairdryerOnImage, style="Selected.TButton")
-            self.pi.write(self.hot_air_gpio, 1)
+        # The capture runs on the pipeline thread, pollCaptures shows the result.
+        if not self.capturePipeline.capture(file_name, (360, 216)):
+            self.log.warning("Camera busy, image not taken")
+
+    def pollCaptures(self):
+        # Until the camera has been opened there is nothing to show, don't open it from here
+        camera = self.cameraSubsystem.value
+        capturePipeline = camera.pipeline if camera is not None else None
+        for result in capturePipeline.results() if capturePipeline is not None else ():
+            if result.error is not None:
+                self.log.warning("Capture of {} failed: {}".format(result.path, result.error))
+                continue
+
+            # PhotoImage must be created on the Tk thread, the scaling is already done.
+            self.last_photo = ImageTk.PhotoImage(result.thumbnail)
+            if not self.liveRunning():
+                self.photoPreview.config(image=self.last_photo)
+            latency = capturePipeline.shown(result)
+
+            self.log.info("Captured image {}".format(result.path))
+            self.log.info("Shutter to preview {:.0f} ms (capture {:.0f} ms, {} port)".format(
+                latency * 1000, (result.captured - result.requested) * 1000, result.port))
+            self.telemetry.camera(telemetry.STILL)
+            self.lastPhotoPath = result.path
+            self.catalog.add(result.path, "still", self.lastReading)
+            self.publishCamera("still")
+
+        if self.timelapse is not None:
+            self.showIntervalPreview()
+
+        self.root.after(CAPTURE_POLL_FREQUENCY, self.pollCaptures)
+
+    def storageEvicted(self, path, size):
+        # Called on a storage worker thread, the log is thread safe
+        self.log.warning("Disk quota: removed {} ({:.1f} MB)".format(path, size / 1e6))
+        self.catalog.remove(path)
+
+    def storageFailed(self, path, error):
+        self.log.warning("Could not save {}: {}".format(path, error))
+
+    def catalogFailed(self, error):
+        # Called on the catalog thread, the log is thread safe
+        self.log.warning("Could not update the catalog: {}".format(error))
+
+    def publishStorage(self):
+        stats = self.storage.stats()
+        self.controlBridge.publish("storage", stats)
+        if stats["over_quota"] and not self.overQuotaLogged:
+            self.log.warning("Disk full: nothing old left to remove to stay within the quota")
+        self.overQuotaLogged = stats["over_quota"]
+        if stats["low_space"] and not self.lowSpaceLogged:
+            self.log.warning("Disk almost full of other files, removing old photos and videos would not help")
+        self.lowSpaceLogged = stats["low_space"]
+        self.root.after(STORAGE_PUBLISH_FREQUENCY, self.publishStorage)
+
+    def liveRunning(self):
+        return self.livePreview is not None and self.livePreview.running
+
+    def toggleLivePreview(self):
+        if self.liveRunning():
+            self.livePreview.stop()
+            if self.livePreviewRefresh is not None:
+                self.root.after_cancel(self.livePreviewRefresh)
+                self.livePreviewRefresh = None
+            fps, frameTime, cpu = self.livePreview.stats()
+            self.log.info("Live preview stopped: {:.1f} fps, {:.1f} ms per frame, {} dropped, CPU {:.0f}%".format(
+                fps, frameTime, self.livePreview.dropped, cpu))
+            self.liveButton.config(text="Live")
+            self.liveStatus.config(text="")
+            self.photoPreview.config(image=self.last_photo if self.last_photo is not None else "")
+            self.publishCamera("live stop")
+            return
+
+        if self.galleryShown():
+            self.closeGallery()
+        if self.livePreview is None:
+            if not self.cameraReady():
+                return
+            self.livePreview = LivePreview(self.camera, PREVIEW_SIZE, PREVIEW_FPS,
+                                           camera_lock=self.cameraSession.lock)
+            width, height = self.livePreview.size
+            self.livePhoto = PhotoImage(width=width, height=height)
+        try:
+            self.livePreview.start()
+        except Exception as e:
+            self.log.warning("Could not start the live preview: {}".format(e))
+            return
+        self.photoPreview.config(image=self.livePhoto)
+        self.liveButton.config(text="Stop live")
+        self.log.info("Live preview at {} fps".format(PREVIEW_FPS))
+        self.publishCamera("live start")
+        self.liveStatsShown = time.monotonic()
+        self.livePreviewRefresh = self.root.after(1000 // PREVIEW_FPS, self.showLivePreview)
+
+    def showLivePreview(self):
+        # Only the newest frame is shown, the frames the GUI was too slow for are dropped
+        self.livePreview.show(self.livePhoto)
+        if time.monotonic() - self.liveStatsShown >= 1:
+            self.liveStatsShown = time.monotonic()
+            fps, frameTime, cpu = self.livePreview.stats()
+            self.liveStatus.config(text="{:.1f} fps  {:.1f} ms/frame  CPU {:.0f}%".format(fps, frameTime, cpu))
+        self.livePreviewRefresh = self.root.after(1000 // PREVIEW_FPS, self.showLivePreview)
+
+    def galleryShown(self):
+        return self.gallery is not None and self.gallery.winfo_ismapped()
+
+    def toggleGallery(self):
+        if self.galleryShown():
+            self.closeGallery()
+            return
+
+        if self.liveRunning():
+            self.toggleLivePreview()
+        if self.gallery is None:
+            self.thumbnailLoader = ThumbnailLoader(catalog_path=CATALOG_LOCATION)
+            self.gallery = Gallery(self.cameraFrameRight, self.thumbnailLoader, ThumbnailCache(GALLERY_CACHE),
+                                   width=GALLERY_SIZE[0], height=GALLERY_SIZE[1], on_open=self.openGalleryItem)
+        self.photoPreview.grid_remove()
+        self.gallery.grid(row=0, column=0)
+        self.gallerySeries = None
+        self.gallery.setItems(self.galleryItems())
+        self.galleryButton.config(text="Close gallery")
+        self.galleryRefresh = self.root.after(GALLERY_POLL_FREQUENCY, self.pollGallery)
+
+    def closeGallery(self):
+        if self.galleryRefresh is not None:
+            self.root.after_cancel(self.galleryRefresh)
+            self.galleryRefresh = None
+        self.thumbnailLoader.want(())
+        self.gallery.grid_remove()
+        self.photoPreview.grid(row=0, column=0)
+        self.galleryButton.config(text="Gallery")
+
+    def galleryItems(self, series=None):
+        # The stills and interval series newest first, or the frames of one series.
+        try:
+            rows = catalog.browse(CATALOG_LOCATION, series)
+        except Exception as e:
+            self.log.warning("Could not read the catalog: {}".format(e))
+            rows = []
+        items = [GalleryItem(None, "Back", None)] if series is not None else []
+        for taken, path, series, frames in rows:
+            when = datetime.datetime.fromtimestamp(taken).strftime("%d %b %H:%M:%S")
+            if frames > 1:
+                when = "Interval {} ({})".format(when, frames)
+            items.append(GalleryItem(path, when, series))
+        return items
+
+    def openGalleryItem(self, item):
+        if item.path is None:
+            self.gallerySeries = None
+            self.gallery.setItems(self.galleryItems())
+        elif item.series is not None and self.gallerySeries is None:
+            self.gallerySeries = item.series
+            self.gallery.setItems(self.galleryItems(item.series))
         else:
-            relay_value = "OFF"
-            self.hotairgun_button.config(image=self.hairdryerOffImage, style="Normal.TButton")
-            self.pi.write(self.hot_air_gpio, 0)
-        self.log_textBox.insert(0.0, "Hot air gun is {}\n".format(relay_value))
-        
-    def toggleFan(self):
-        print("toggleFan")
-        # This works for the Keyestudio relay HAT
-        if self.pi.read(self.fan_gpio) == 0:
-            relay_value = "ON"
-            self.extractor_button.config(image=self.fanOnImage, style="Selected.TButton")
-            self.pi.write(self.fan_gpio, 1)
-        else:
-            relay_value = "OFF"
-            self.extractor_button.configure(image=self.fanOffImage, style="Normal.TButton")
-            self.pi.write(self.fan_gpio, 0)
-
-        self.log_textBox.insert(0.0, "Fan is {}\n".format(relay_value))        
-
-    def lightsToggle(self):
-        print("lightsToggle")
-        # This works for the Keyestudio relay HAT
-        if self.pi.read(self.lights_gpio) == 0:
-            relay_value = "ON"
-            self.lights1_button.config(image=self.lightOnImage, style="Selected.TButton")
-            self.pi.write(self.lights_gpio, 1)
-        else:
-            relay_value = "OFF"
-            self.lights1_button.configure(image=self.lightOffImage, style="Normal.TButton")
-            self.pi.write(self.lights_gpio, 0)
-
-        self.log_textBox.insert(0.0, "Light is {}\n".format(relay_value))        
+            # Show the photo in the preview, loaded by the gallery's workers
+            self.galleryOpening = self.thumbnailLoader.request(item.path, (360, 216))
+
+    def pollGallery(self):
+        for key, image in self.thumbnailLoader.results():
+            if key != self.galleryOpening:
+                self.gallery.loaded(key, image)
+            elif image is None:
+                self.log.warning("Could not open {}".format(key[0]))
+            else:
+                from PIL import ImageTk
+
+                self.galleryOpening = None
+                self.last_photo = ImageTk.PhotoImage(image)
+                self.photoPreview.config(image=self.last_photo)
+                self.closeGallery()
+                return
+        self.galleryRefresh = self.root.after(GALLERY_POLL_FREQUENCY, self.pollGallery)
+
+    def publishCamera(self, event=None):
+        self.controlBridge.publish("camera", {"event": event,
+                                              "recording": bool(self.isVideoRecording),
+                                              "interval": self.timelapse is not None,
+                                              "live": self.liveRunning(),
+                                              "photo_interval": self.photoInterval,
+                                              "last_photo": self.lastPhotoPath,
+                                              "session": self.cameraSubsystem.value.session.stats()
+                                              if self.cameraSubsystem.ready else None})
 
-    def extplugone(self):
-        # The following works with the Keyestudio 4 Channel Relay HAT
-        if self.pi.read(self.ext_plug_one_gpio) == 0:
+    # Bench control - Tab 1 - methods
+    def toggleRelay(self, name):
+        # The relay bank knows the state of every relay, no need to read it back from the hardware.
+        self.relays.toggle(name)
+
+    def relayChanged(self, name, state):
+        # Called by the relay bank for every relay that changes
+        button, onImage, offImage = self.relayButtons[name]
+        if state:
             relay_value = "ON"
-            self.plug_one_button.config(image=self.gpioONImage, style="Selected.TButton")
-            self.pi.write(self.ext_plug_one_gpio, 1)
+            button.config(image=onImage, style="Selected.TButton")
         else:
             relay_value = "OFF"
-            self.plug_one_button.config(image=self.gpioOFFImage, style="Normal.TButton")
-            self.pi.write(self.ext_plug_one_gpio, 0)
-        self.log_textBox.insert(0.0, "External Plug1 is {}\n".format(relay_value))
-
-    def extplugtwo(self):
-        # The following works with the Keyestudio 4 Channel Relay HAT
-        if self.pi.read(self.ext_plug_two_gpio) == 0:
-            relay_value = "ON"
-            self.plug_two_button.config(image=self.gpioONImage, style="Selected.TButton")
-            self.pi.write(self.ext_plug_two_gpio, 1)
+            button.config(image=offImage, style="Normal.TButton")
+        channel = self.relays.channels[name]
+        self.telemetry.relay(channel.gpio, state)
+        self.log.info("{} is {}".format(channel.label, relay_value))
+        self.controlBridge.publish("relays", self.relays.states())
+
+        if state and name in RELAY_AUTO_OFF:
+            self.relayScheduler.auto_off(name, RELAY_AUTO_OFF[name])
+        elif not state:
+            self.relayScheduler.cancel_all(name, relay_scheduler.AUTO_OFF)
+        self.showRelayTimers()
+
+    def relayTimerFired(self, timer):
+        self.log.info("{} timer: {} switched {}".format(
+            timer.kind, self.relays.channels[timer.name].label, "ON" if timer.state else "OFF"))
+        self.showRelayTimers()
+
+    def showRelayTimers(self):
+        # Show the next pending timer of every relay on its button, counting down once a second
+        if self.relayTimersRefresh is not None:
+            self.root.after_cancel(self.relayTimersRefresh)
+            self.relayTimersRefresh = None
+
+        for name, (button, onImage, offImage) in self.relayButtons.items():
+            timers = self.relayScheduler.pending(name)
+            if timers:
+                minutes, seconds = divmod(int(timers[0].remaining()), 60)
+                button.config(text="{} {}:{:02d}".format(timers[0].kind, minutes, seconds), compound=BOTTOM)
+            else:
+                button.config(compound=NONE)
+
+        if self.relayScheduler.pending():
+            self.relayTimersRefresh = self.root.after(1000, self.showRelayTimers)
+
+    def reconcileRelays(self):
+        # Catch relays changed from outside the program
+        for name in self.relays.reconcile():
+            self.log.warning("{} was changed outside the bench computer".format(
+                self.relays.channels[name].label))
+        self.root.after(RELAY_RECONCILE_FREQUENCY, self.reconcileRelays)
+
+    def pollCommands(self):
+        # Commands from the control API, run here on the Tk thread
+        for action, args, future in self.controlBridge.commands():
+            try:
+                future.set_result(self.runCommand(action, args))
+            except Exception as e:
+                future.set_exception(e)
+        self.root.after(COMMAND_POLL_FREQUENCY, self.pollCommands)
+
+    def runCommand(self, action, args):
+        if action in ("still", "interval", "video", "event"):
+            if not self.cameraReady():
+                raise ValueError("the camera is not ready yet")
+            self.buildCameraTab()  # The camera status and preview are shown there
+        if action == "still":
+            self.take_still()
+        elif action == "interval":
+            self.startIntervalStill()
+        elif action == "video":
+            self.toggleVideo()
+        elif action == "event":
+            return {"path": self.saveVideoEvent(args.get("name") or "event")}
         else:
-            relay_value = "OFF"
-            self.plug_two_button.config(image=self.gpioOFFImage, style="Normal.TButton")
-            self.pi.write(self.ext_plug_two_gpio, 0)
-        self.log_textBox.insert(0.0, "External Plug2 is {}\n".format(relay_value))
+            return relay_command(self.relays, action, args)
+        return {"recording": bool(self.isVideoRecording), "interval": self.timelapse is not None}
+
+    def flushLog(self):
+        # Add the new log lines in one insert, newest on top, and trim the panel to LOG_LINES.
+        lines = self.eventLog.take(LOG_LINES)
+        if lines:
+            lines.reverse()
+            self.log_textBox.insert("1.0", "\n".join(lines) + "\n")
+            self.logLines += len(lines)
+            if self.logLines > LOG_LINES:
+                self.log_textBox.delete("{}.0".format(LOG_LINES + 1), END)
+                self.logLines = LOG_LINES
+        self.root.after(LOG_FLUSH_FREQUENCY, self.flushLog)
+
+    def registerMetrics(self):
+        # Values the subsystems already keep, read only when the metrics are scraped
+        registry = metrics.REGISTRY
+
+        # The subsystems may not be set up yet, reading a metric must not set them up
+        def sensors():
+            environment = self.environmentSubsystem.value
+            return environment.sensors.snapshot() if environment is not None else []
+
+        def dht22_errors():
+            return [((state.name, kind), value) for state in sensors()
+                    for kind, value in (("bad_checksum", state.bad_checksum),
+                                        ("short_message", state.short_message),
+                                        ("missing_message", state.missing_message),
+                                        ("sensor_reset", state.sensor_resets))]
+
+        registry.function("bench_dht22_errors_total", "DHT22 errors by sensor and kind.", "counter",
+                          dht22_errors, ["sensor", "kind"])
+        registry.function("bench_dht22_staleness_seconds", "Age of the last good DHT22 reading.", "gauge",
+                          lambda: [((state.name,), state.staleness) for state in sensors()],
+                          ["sensor"])
+        registry.function("bench_dht22_recovery_seconds_total", "Time spent power cycling the DHT22.", "counter",
+                          lambda: [((state.name,), state.recovery_time) for state in sensors()],
+                          ["sensor"])
+        registry.function("bench_adc_sweeps_total", "MCP3008 sweeps.", "counter",
+                          lambda: self.environmentSubsystem.value.adc.sweeps
+                          if self.environmentSubsystem.ready else 0)
+        registry.function("bench_relay_state", "1 if the relay is on.", "gauge",
+                          lambda: [((name,), int(state)) for name, state in self.relays.states().items()],
+                          ["relay"])
+        registry.function("bench_relay_writes_total", "Calls to pigpiod which switched relays.", "counter",
+                          lambda: self.relays.writes)
+        registry.function("bench_relay_timers_pending", "Relay timers waiting to fire.", "gauge",
+                          lambda: len(self.relayScheduler.pending()))
+        registry.function("bench_captures_total", "Still photos taken.", "counter",
+                          lambda: self.cameraSubsystem.value.pipeline.captures if self.cameraSubsystem.ready else 0)
+        registry.function("bench_storage_pending_files", "Files waiting to be written to the SD card.", "gauge",
+                          lambda: self.storage.pending)
+        registry.function("bench_storage_pending_bytes", "Bytes waiting to be written to the SD card.", "gauge",
+                          lambda: self.storage.pending_bytes)
+        registry.function("bench_storage_used_bytes", "Bytes of photos and videos on the SD card.", "gauge",
+                          lambda: self.storage.used)
+        registry.function("bench_timelapse_skipped_frames", "Frames skipped by the running timelapse.", "gauge",
+                          lambda: self.timelapse.skipped if self.timelapse is not None else 0)
+        registry.function("bench_main_loop_worst_stall_seconds", "Longest time the Tk main loop was blocked.",
+                          "gauge", lambda: self.stallMonitor.worst_stall)
+        registry.function("bench_main_loop_mean_stall_seconds", "Mean time the Tk main loop was blocked.",
+                          "gauge", lambda: self.stallMonitor.mean_stall())
+        registry.function("bench_control_subscribers", "WebSocket clients of the control API.", "gauge",
+                          lambda: self.controlBridge.subscribers)
+        registry.function("bench_log_dropped_total", "Log lines dropped before reaching the log panel.", "counter",
+                          lambda: self.eventLog.ring.dropped)
+
+    def start(self):
+        # Only what the Instruments tab needs, the rest starts once the window is shown
+        self.stallMonitor.start()
+        self.root.after(LOG_FLUSH_FREQUENCY, self.flushLog)
+        self.root.after(COMMAND_POLL_FREQUENCY, self.pollCommands)
+        self.root.after(RELAY_RECONCILE_FREQUENCY, self.reconcileRelays)
+        self.root.after_idle(self.windowShown)
+
+    def windowShown(self):
+        elapsed = PROFILE.mark("Instruments tab interactive")
+        self.log.info("Ready in {:.0f} ms".format(elapsed * 1000))
+
+        # The sensors and the camera are set up on their own threads
+        self.environmentSubsystem.prefetch()
+        self.cameraSubsystem.prefetch()
+        self.storage.start()
+        self.catalog.start()
+        # Only the directories changed since the last start are listed
+        self.catalog.rescan(lambda t: telemetry.environment_at(TELEMETRY_LOCATION, t))
+        self.root.after(STORAGE_PUBLISH_FREQUENCY, self.publishStorage)
+        self.controlBridge.publish("relays", self.relays.states())
+        self.publishCamera()
+        self.controlServer.start()
+        if self.metricsServer is not None:
+            self.metricsServer.start()
+        self.root.after(CAPTURE_POLL_FREQUENCY, self.pollCaptures)
+        self.root.after(READING_POLL_FREQUENCY, self.getDHTreadings)  # This will show the readings as they arrive
+        if os.environ.get("BENCH_STARTUP_PROFILE"):
+            self.root.after(100, self.printStartupProfile)
+
+    def printStartupProfile(self):
+        # Once every subsystem has started, or failed to
+        if not (self.environmentSubsystem.done.is_set() and self.cameraSubsystem.done.is_set()):
+            self.root.after(100, self.printStartupProfile)
+            return
+        PROFILE.mark("all subsystems started")
+        print("\n".join(PROFILE.report()))
 
     def on_closing(self):
-        if messagebox.askokcancel("Quit", "Do you want to quit?"):            
-            self.root.destroy()
+        if messagebox.askokcancel("Quit", "Do you want to quit?"):
+            self.shutdown()
+
+    def shutdown(self):
+        # Stop everything and close the window, without asking
+        self.stallMonitor.stop()
+        environment = self.environmentSubsystem.value
+        if environment is not None:
+            environment.acquisition.stop(timeout=1)
+            environment.sensors.cancel()
+            environment.adc.stop(timeout=1)
+        if self.timelapse is not None:
+            self.timelapse.stop(timeout=2)
+        if self.liveRunning():
+            self.livePreview.stop()
+        if self.thumbnailLoader is not None:
+            self.thumbnailLoader.stop()
+        if self.assembly is not None:
+            self.assembly.terminate()  # Resumed when Make video is pressed again
+        if self.cameraSubsystem.ready:
+            camera = self.cameraSubsystem.value
+            camera.recorder.close()
+            camera.recorder.remuxer.stop(timeout=5)
+            camera.pipeline.stop(timeout=2)
+        self.storage.stop(timeout=5)  # Write what is still in tmpfs to the SD card
+        self.catalog.stop(timeout=2)
+        self.controlServer.stop(timeout=1)
+        if self.metricsServer is not None:
+            self.metricsServer.stop(timeout=1)
+        self.relayScheduler.stop()
+        self.telemetry.close()
+        self.eventLog.close()
+        self.root.destroy()
 
 def main():
     root = Tk()
     root.attributes('-zoom', True)
     ex = BenchComputer(root)
-    root.after(DHT_FREQUENCY, ex.getDHTreadings)  # This will trigger the first sensor reading
+    ex.start()
     root.mainloop()
 
 
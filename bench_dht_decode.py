@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# bench_dht_decode.py
+
+"""
+Replay recorded DHT22 traces through the per edge decoder (DHT22.sensor._cb)
+and the bulk decoder (DHT22.sensor._cb_bulk) and compare their throughput
+and correctness.  No hardware or pigpio daemon is needed.
+
+   python bench_dht_decode.py [COUNT | TRACE_FILE]
+
+With no argument 5000 synthesized traces are used.
+"""
+
+import sys
+import time
+
+import simulation
+
+simulation.install()  # DHT22 imports pigpio, the replay below needs no daemon.
+
+import DHT22
+import dht_trace
+
+class _pi:
+   """Just enough of pigpio.pi for DHT22.sensor to run without a daemon."""
+
+   def set_pull_up_down(self, gpio, pud):
+      pass
+
+   def set_watchdog(self, gpio, timeout):
+      pass
+
+   def set_mode(self, gpio, mode):
+      pass
+
+   def write(self, gpio, level):
+      pass
+
+   def callback(self, gpio, edge, func):
+      return _callback()
+
+class _callback:
+   def cancel(self):
+      pass
+
+def replay(traces, bulk):
+   """
+   Feed every trace through a sensor, return (seconds, results).
+   """
+   s = DHT22.sensor(_pi(), 4, bulk=bulk)
+   cb = s._cb_bulk if bulk else s._cb
+
+   results = []
+   elapsed = 0.0
+   for t in traces:
+      # More than 250 ms since the last message, as after a real trigger.
+      s.high_tick = (t.edges[0][1] - 1000000) & 0xffffffff
+      s.result = None
+
+      start = time.perf_counter()
+      for level, tick in t.edges:
+         cb(4, level, tick)
+      elapsed += time.perf_counter() - start
+
+      results.append(s.result)
+
+   s.cancel()
+   return elapsed, results
+
+def check(traces, results):
+   """Return the number of results which do not match the trace."""
+   wrong = 0
+   for t, r in zip(traces, results):
+      if r is None or r.status != t.status:
+         wrong += 1
+      elif t.status == DHT22.OK and (abs(r.humidity - t.humidity) > 0.05 or
+                                     abs(r.temperature - t.temperature) > 0.05):
+         wrong += 1
+   return wrong
+
+if __name__ == "__main__":
+
+   if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+      traces = dht_trace.load(sys.argv[1])
+   else:
+      traces = dht_trace.random_traces(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
+
+   edges = sum(len(t.edges) for t in traces)
+
+   print("{} traces, {} edges".format(len(traces), edges))
+
+   for name, bulk in (("per edge", False), ("bulk", True)):
+      elapsed, results = replay(traces, bulk)
+      print("{:9s} {:8.0f} readings/s {:10.0f} edges/s {:6.1f} us/reading {} wrong".format(
+         name, len(traces) / elapsed, edges / elapsed,
+         elapsed / len(traces) * 1e6, check(traces, results)))
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+bench_relays.py
+
+1. WHAT IT DOES
+Times the relay code against a fake pigpio connection, no Raspberry Pi or
+pigpiod needed.  Every call to the fake pigpio costs a simulated socket
+round trip, so the results show how many round trips each approach makes.
+
+Compares the old way (read the gpio then write it, one gpio at a time)
+with RelayBank (shadow state, one call per toggle, bank writes for several
+relays).
+
+    python3 bench_relays.py [ROUND_TRIP_MS]
+'''
+
+import sys
+import time
+
+import simulation
+
+simulation.install()  # relays imports pigpio, the runs below use FakePi.
+
+import relays
+
+OUTPUT = 1
+
+CHANNELS = [relays.RelayChannel("lights", 4, "Light"),
+            relays.RelayChannel("fan", 22, "Fan"),
+            relays.RelayChannel("solder_iron", 6, "Soldering iron"),
+            relays.RelayChannel("hot_air", 26, "Hot air gun"),
+            relays.RelayChannel("ext_plug_one", 17, "External Plug1"),
+            relays.RelayChannel("ext_plug_two", 27, "External Plug2")]
+
+
+class FakePi:
+    """The pigpio.pi() calls used by the relays, each one waits round_trip seconds."""
+
+    def __init__(self, round_trip):
+        self.round_trip = round_trip
+        self.levels = 0
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        end = time.perf_counter() + self.round_trip
+        while time.perf_counter() < end:
+            pass
+
+    def set_mode(self, gpio, mode):
+        self._call()
+
+    def read(self, gpio):
+        self._call()
+        return (self.levels >> gpio) & 1
+
+    def write(self, gpio, level):
+        self._call()
+        if level:
+            self.levels |= 1 << gpio
+        else:
+            self.levels &= ~(1 << gpio)
+
+    def read_bank_1(self):
+        self._call()
+        return self.levels
+
+    def set_bank_1(self, bits):
+        self._call()
+        self.levels |= bits
+
+    def clear_bank_1(self, bits):
+        self._call()
+        self.levels &= ~bits
+
+
+def old_init(pi):
+    for c in CHANNELS:
+        pi.set_mode(c.gpio, OUTPUT)
+    for c in CHANNELS:
+        pi.write(c.gpio, 0)
+
+
+def old_toggle(pi, gpio):
+    if pi.read(gpio) == 0:
+        pi.write(gpio, 1)
+    else:
+        pi.write(gpio, 0)
+
+
+def old_all_off(pi):
+    for c in CHANNELS:
+        if pi.read(c.gpio):
+            pi.write(c.gpio, 0)
+
+
+def old_soldering(pi):
+    for name in ("lights", "fan", "solder_iron"):
+        gpio = [c.gpio for c in CHANNELS if c.name == name][0]
+        if pi.read(gpio) == 0:
+            pi.write(gpio, 1)
+
+
+def measure(name, func, pi, repeat):
+    pi.calls = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - start
+    print("{:28s} {:8.3f} ms {:6.1f} calls".format(name, elapsed / repeat * 1000, pi.calls / repeat))
+
+
+if __name__ == "__main__":
+
+    round_trip = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.0002
+    repeat = 200
+
+    print("Simulated pigpiod round trip {:.2f} ms, per operation:".format(round_trip * 1000))
+
+    pi = FakePi(round_trip)
+    measure("old: init", lambda: old_init(pi), pi, repeat)
+    measure("old: toggle", lambda: old_toggle(pi, 6), pi, repeat)
+    measure("old: scene + all off", lambda: (old_soldering(pi), old_all_off(pi)), pi, repeat)
+
+    pi = FakePi(round_trip)
+    measure("RelayBank: init", lambda: relays.RelayBank(pi, CHANNELS), pi, repeat)
+    bank = relays.RelayBank(pi, CHANNELS, {"soldering": {"lights": True, "fan": True, "solder_iron": True}})
+    measure("RelayBank: toggle", lambda: bank.toggle("solder_iron"), pi, repeat)
+    measure("RelayBank: scene + all off", lambda: (bank.scene("soldering"), bank.all_off()), pi, repeat)
+    measure("RelayBank: reconcile", bank.reconcile, pi, repeat)
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+bench_suite.py
+
+1. WHAT IT DOES
+Runs the whole bench computer GUI on the simulated hardware of
+simulation.py and measures:
+
+* main loop stall, while idle, toggling relays, taking photos and taking
+  interval photos
+* relay toggle latency, from the button press to the button showing it
+* DHT22 read latency, from trigger to decoded reading
+* capture to preview latency, from the shutter button to the thumbnail
+* shutter latency of the camera, by port (see camera_session.py)
+* that the live preview shows the frames of the camera, decoded by Tk
+
+Needs a display, on a headless machine run it under Xvfb:
+
+    xvfb-run -a python3 bench_suite.py [SECONDS]
+
+SECONDS is the length of each phase, 3 by default.  Photos, logs and
+telemetry are written to a temporary directory.
+'''
+
+import collections
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import simulation
+
+simulation.install()  # Before the program imports pigpio, picamera and gpiozero.
+
+from tkinter import Tk
+
+import DHT22
+import bench_computer_keystudio_relay as app
+
+BENCH_DHT_GPIO = 16  # A second simulated DHT22, read as fast as it allows
+BENCH_DHT_PERIOD = 0.3  # Seconds between its readings, it needs 250 ms of quiet between messages.
+
+
+def sensor_reads(pi, results, statuses, stop):
+    # Runs on its own thread for the whole benchmark, like a second acquisition thread.
+    sensor = DHT22.sensor(pi, BENCH_DHT_GPIO)
+    while not stop.wait(BENCH_DHT_PERIOD):
+        start = time.perf_counter()
+        reading = sensor.read()
+        statuses[reading.status] += 1
+        if reading.status == DHT22.OK:
+            results["DHT22 read"].append(time.perf_counter() - start)
+    sensor.cancel()
+
+
+def scenario(root, ex, phase, results, stalls, checks):
+    """Generator of the benchmark steps, yields the ms to wait before the next step."""
+
+    def stall(name):
+        monitor = ex.stallMonitor
+        stalls[name] = (monitor.mean_stall(), monitor.worst_stall, monitor.samples)
+        monitor.reset()
+
+    yield 1000  # Let the window settle.
+    ex.stallMonitor.reset()
+
+    yield int(phase * 1000)
+    stall("idle")
+
+    names = list(ex.relays.channels)
+    end = time.monotonic() + phase
+    i = 0
+    while time.monotonic() < end:
+        start = time.perf_counter()
+        ex.toggleRelay(names[i % len(names)])
+        root.update_idletasks()  # Redraw the button
+        results["relay toggle"].append(time.perf_counter() - start)
+        i += 1
+        yield 50
+    ex.relays.all_off()
+    stall("relays")
+
+    ex.buildCameraTab()
+    end = time.monotonic() + phase
+    while time.monotonic() < end:
+        ex.capturePipeline.last_latency = None
+        ex.take_still()
+        timeout = time.monotonic() + 5
+        while ex.capturePipeline.last_latency is None and time.monotonic() < timeout:
+            yield 5
+        if ex.capturePipeline.last_latency is not None:
+            results["capture to preview"].append(ex.capturePipeline.last_latency)
+        yield 100
+    stall("captures")
+
+    # Every row of a simulated rgb frame starts with the bytes n, n + 1, n + 2.
+    ex.toggleLivePreview()
+    yield int(phase * 1000)
+    shown = ex.livePreview.shown if ex.liveRunning() else 0
+    pixel = ex.livePhoto.get(0, 0) if shown else None
+    if isinstance(pixel, str):
+        pixel = tuple(int(v) for v in pixel.split())
+    if ex.liveRunning():
+        ex.toggleLivePreview()
+    decoded = pixel is not None and (pixel[1] - pixel[0]) % 256 == 1 and (pixel[2] - pixel[0]) % 256 == 2
+    checks["live preview"] = "{} frames shown, first pixel {}, {}".format(
+        shown, pixel, "ok" if shown and decoded else "FAILED")
+    stall("live preview")
+
+    ex.photoInterval = 0.25
+    ex.startIntervalStill()
+    yield int(phase * 1000)
+    ex.startIntervalStill()
+    while ex.timelapse is not None:
+        yield 50
+    stall("interval photos")
+
+
+def run(phase):
+    directory = tempfile.mkdtemp(prefix="bench_suite_")
+    app.IMAGE_FILE_LOCATION = os.path.join(directory, "photos")
+    app.VIDEO_FILE_LOCATION = os.path.join(directory, "videos")
+    app.TELEMETRY_LOCATION = os.path.join(directory, "telemetry")
+    app.LOG_LOCATION = os.path.join(directory, "logs")
+    app.CATALOG_LOCATION = os.path.join(directory, "catalog.db")
+    os.makedirs(app.IMAGE_FILE_LOCATION)
+    os.makedirs(app.VIDEO_FILE_LOCATION)
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # For the icons
+    root = Tk()
+    root.geometry("1024x600")
+    ex = app.BenchComputer(root)
+    ex.start()
+
+    results = collections.defaultdict(list)
+    stalls = collections.OrderedDict()
+    statuses = collections.Counter()
+    checks = collections.OrderedDict()
+
+    stop = threading.Event()
+    reader = threading.Thread(target=sensor_reads, args=(ex.pi, results, statuses, stop), daemon=True)
+    reader.start()
+
+    steps = scenario(root, ex, phase, results, stalls, checks)
+
+    def step():
+        try:
+            root.after(next(steps), step)
+        except StopIteration:
+            root.quit()
+
+    root.after(0, step)
+    root.mainloop()
+
+    stop.set()
+    reader.join()
+    if ex.cameraSubsystem.ready:
+        for port, times in ex.cameraSession.shutter.items():
+            results["shutter ({} port)".format(port)] = list(times)
+    ex.shutdown()
+    return results, stalls, statuses, checks, directory
+
+
+def report(results, stalls, statuses, checks):
+    print("Main loop stall          mean ms   worst ms   samples")
+    for name, (mean, worst, samples) in stalls.items():
+        print("  {:20s} {:9.2f} {:10.2f} {:9d}".format(name, mean * 1000, worst * 1000, samples))
+
+    print()
+    print("Latency                  count   mean ms  median ms  p95 ms   max ms")
+    for name in ["relay toggle", "DHT22 read", "capture to preview"] + sorted(
+            name for name in results if name.startswith("shutter")):
+        values = sorted(results[name])
+        if not values:
+            print("  {:20s} {:7d}".format(name, 0))
+            continue
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        print("  {:20s} {:7d} {:9.2f} {:10.2f} {:7.2f} {:8.2f}".format(
+            name, len(values), statistics.mean(values) * 1000, statistics.median(values) * 1000,
+            p95 * 1000, values[-1] * 1000))
+
+    print()
+    print("DHT22 read status: {}".format(", ".join("{} {}".format(s, n) for s, n in statuses.items())))
+    for name, outcome in checks.items():
+        print("{}: {}".format(name.capitalize(), outcome))
+
+
+if __name__ == "__main__":
+
+    phase = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+
+    if not os.environ.get("DISPLAY"):
+        sys.exit("No display, run it under Xvfb: xvfb-run -a python3 bench_suite.py")
+
+    results, stalls, statuses, checks, directory = run(phase)
+
+    report(results, stalls, statuses, checks)
+    print("Output written to {}".format(directory))
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+camera_session.py
+
+1. WHAT IT DOES
+The one place the camera is set up, so a photo never waits for the camera
+to be reconfigured.
+
+open() sets the sensor mode, resolution, frame rate and rotation once,
+and they are never touched again: the sensor keeps running in that mode
+and the exposure and white balance keep adapting in the background.  A
+still is taken from the still port, which has the same resolution as the
+sensor mode so there is no mode switch, or from the video port while the
+camera is recording (or always, with video_stills), which takes one frame
+of what the sensor is already streaming.
+
+lock_exposure() fixes the shutter speed, gains and white balance at their
+current values, so the frames of an interval series all have the same
+exposure, until unlock_exposure().
+
+The time of every capture is kept by mode and port, see stats() and the
+bench_camera_shutter_seconds histogram.
+'''
+
+import collections
+import threading
+import time
+
+import metrics
+
+# A sensor mode of the camera (the numbers are those of the v2 camera module).
+CameraMode = collections.namedtuple("CameraMode", ["resolution", "framerate", "sensor_mode"])
+
+MODES = {
+    "video": CameraMode((1920, 1080), 30, 1),  # Full HD, from the middle of the sensor
+    "binned": CameraMode((1640, 1232), 30, 4),  # The whole field of view, 2 x 2 binned
+    "full": CameraMode((3280, 2464), 15, 3),  # Full resolution, videos are scaled down by the GPU
+}
+
+# The largest video the h264 encoder takes, larger modes are resized to fit.
+MAX_VIDEO_SIZE = (1920, 1080)
+
+SHUTTER_SECONDS = metrics.REGISTRY.histogram("bench_camera_shutter_seconds",
+                                             "Time for the camera to take a still, by mode and port.",
+                                             ["mode", "port"])
+
+
+class CameraSession:
+    """
+    The camera, set up in the sensor mode called mode (see MODES).  Hold
+    lock while using the camera, and share it with every other user of
+    the camera.  settle is the time the automatic exposure needs after
+    open() before it can be locked.
+    """
+
+    def __init__(self, camera, mode="video", rotation=90, video_stills=False, settle=2.0):
+        if mode not in MODES:
+            raise ValueError("Unknown camera mode {!r}, one of {}".format(mode, ", ".join(MODES)))
+        self.camera = camera
+        self.mode_name = mode
+        self.mode = MODES[mode]
+        self.rotation = rotation
+        self.video_stills = video_stills
+        self.settle = settle
+
+        self.lock = threading.Lock()
+        self.opened = None
+        self.exposure_locked = False
+        self.exposure = None  # (shutter speed in µs, analog gain, digital gain, awb gains) while locked
+        self.shutter = collections.defaultdict(lambda: collections.deque(maxlen=256))  # port -> seconds
+
+    def open(self):
+        """Set the camera up.  Call before anything records from it."""
+        with self.lock:
+            self.camera.sensor_mode = self.mode.sensor_mode
+            self.camera.resolution = self.mode.resolution
+            self.camera.framerate = self.mode.framerate
+            self.camera.rotation = self.rotation
+        self.opened = time.monotonic()
+
+    @property
+    def video_resize(self):
+        """The size videos are recorded at, None for the resolution of the mode."""
+        width, height = self.mode.resolution
+        if width <= MAX_VIDEO_SIZE[0] and height <= MAX_VIDEO_SIZE[1]:
+            return None
+        scale = min(MAX_VIDEO_SIZE[0] / width, MAX_VIDEO_SIZE[1] / height)
+        return int(width * scale) // 32 * 32, int(height * scale) // 16 * 16
+
+    def port(self):
+        """The port the next still is taken from."""
+        return "video" if self.video_stills or getattr(self.camera, "recording", False) else "still"
+
+    def capture(self, output, **options):
+        """Take a JPEG still into output, with lock held.  Return the port it was taken from."""
+        port = self.port()
+        start = time.monotonic()
+        self.camera.capture(output, format="jpeg", use_video_port=port == "video", **options)
+        elapsed = time.monotonic() - start
+        self.shutter[port].append(elapsed)
+        SHUTTER_SECONDS.labels(self.mode_name, port).observe(elapsed)
+        return port
+
+    def capture_continuous(self, output):
+        """JPEG stills from the video port, as fast as they come, take lock around each one."""
+        return self.camera.capture_continuous(output, format="jpeg", use_video_port=True)
+
+    def lock_exposure(self):
+        """
+        Fix the exposure and white balance at what the camera has settled
+        on, waiting for it to settle after open().
+        """
+        if self.opened is not None:
+            time.sleep(max(0, self.opened + self.settle - time.monotonic()))
+        with self.lock:
+            camera = self.camera
+            camera.shutter_speed = camera.exposure_speed
+            camera.exposure_mode = "off"  # Freezes the analog and digital gains
+            gains = camera.awb_gains
+            camera.awb_mode = "off"
+            camera.awb_gains = gains
+            self.exposure = (camera.shutter_speed, float(camera.analog_gain), float(camera.digital_gain),
+                             tuple(float(gain) for gain in gains))
+            self.exposure_locked = True
+        return self.exposure
+
+    def unlock_exposure(self):
+        with self.lock:
+            self.camera.shutter_speed = 0  # Automatic
+            self.camera.exposure_mode = "auto"
+            self.camera.awb_mode = "auto"
+            self.exposure_locked = False
+            self.exposure = None
+
+    def stats(self):
+        """The mode, the exposure and the mean and worst capture time of each port, in ms."""
+        shutter = {}
+        for port, times in list(self.shutter.items()):
+            times = list(times)
+            if times:
+                shutter[port] = {"captures": len(times), "mean_ms": round(sum(times) / len(times) * 1000, 1),
+                                 "worst_ms": round(max(times) * 1000, 1)}
+        return {"mode": self.mode_name, "resolution": list(self.mode.resolution),
+                "framerate": self.mode.framerate, "exposure_locked": self.exposure_locked,
+                "shutter": shutter}
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+capture.py
+
+1. WHAT IT DOES
+Takes still photos on a worker thread so the touchscreen never freezes.
+
+The camera captures into an in-memory JPEG.  The full JPEG is written to
+the SD card while, at the same time, the preview thumbnail is decoded from
+the same bytes (using the JPEG draft mode, which decodes at a reduced
+scale).  Only the finished thumbnail is handed to the GUI, which turns it
+into an ImageTk.PhotoImage on the Tk thread.  With a storage.StorageWriter
+the JPEG is only staged here and reaches the SD card later.
+
+The camera is used through a camera_session.CameraSession, which is set
+up once, so a capture never waits for the camera to be reconfigured.
+'''
+
+import collections
+import concurrent.futures
+import io
+import queue
+import threading
+import time
+
+from PIL import Image
+
+import metrics
+
+# The result of one capture.  thumbnail is a PIL Image (None if the capture
+# failed, then error holds the exception).  requested, captured, written and
+# finished are time.monotonic() values, requested is the moment the shutter
+# button was pressed.  port is the camera port the photo was taken from.
+CaptureResult = collections.namedtuple(
+    "CaptureResult",
+    ["tag", "path", "thumbnail", "error", "requested", "captured", "written", "finished", "port"])
+
+CAPTURE_SECONDS = metrics.REGISTRY.histogram("bench_capture_seconds", "Time from shutter button to captured photo.")
+PREVIEW_SECONDS = metrics.REGISTRY.histogram("bench_capture_preview_seconds",
+                                             "Time from shutter button to the preview on screen.")
+FAILURES = metrics.REGISTRY.counter("bench_capture_failures_total", "Still captures which failed.")
+
+
+class CapturePipeline(threading.Thread):
+    """
+    Worker thread which owns all still captures.
+
+    Call capture() from the GUI, collect the results with results() from a
+    root.after() poll.
+    """
+
+    def __init__(self, session, maxsize=8, storage=None):
+        threading.Thread.__init__(self, name="CapturePipeline", daemon=True)
+
+        self.session = session
+        self.camera = session.camera
+        self.storage = storage
+        self.lock = session.lock  # Held while the camera is capturing, shared with the other users.
+
+        self.requests = queue.Queue(maxsize=maxsize)
+        self.done = queue.Queue()
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.captures = 0
+        self.last_latency = None  # Shutter to preview of the last capture, in seconds.
+        self.worst_latency = 0.0
+
+    def capture(self, path, size, tag=None):
+        """
+        Ask for a photo to be written to path with a thumbnail of size.
+
+        Returns False, without blocking, if too many captures are waiting.
+        """
+        try:
+            self.requests.put_nowait((tag, path, size, time.monotonic()))
+            return True
+        except queue.Full:
+            return False
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            self.done.put(self._capture(*request))
+
+    def _capture(self, tag, path, size, requested):
+        try:
+            stream = io.BytesIO()
+            with self.lock:
+                port = self.session.capture(stream)
+            captured = time.monotonic()
+            CAPTURE_SECONDS.observe(captured - requested)
+            data = stream.getvalue()
+
+            written = self.writer.submit(self._write, path, data)
+            thumbnail = self._thumbnail(data, size)
+            written = written.result()
+
+            self.captures += 1
+            return CaptureResult(tag, path, thumbnail, None, requested, captured,
+                                 written, time.monotonic(), port)
+        except Exception as e:
+            FAILURES.inc()
+            return CaptureResult(tag, path, None, e, requested, None, None, time.monotonic(), None)
+
+    def _write(self, path, data):
+        if self.storage is not None:
+            self.storage.write(path, data)
+            return time.monotonic()
+        with open(path, "wb") as f:
+            f.write(data)
+        return time.monotonic()
+
+    def _thumbnail(self, data, size):
+        image = Image.open(io.BytesIO(data))
+        image.draft("RGB", size)  # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8.
+        return image.resize(size, Image.LANCZOS)
+
+    def results(self):
+        """Return the finished captures, never blocks."""
+        finished = []
+        while True:
+            try:
+                finished.append(self.done.get_nowait())
+            except queue.Empty:
+                return finished
+
+    def shown(self, result):
+        """
+        Record that result has been shown on screen, return the shutter to
+        preview latency in seconds.
+        """
+        latency = time.monotonic() - result.requested
+        PREVIEW_SECONDS.observe(latency)
+        self.last_latency = latency
+        if latency > self.worst_latency:
+            self.worst_latency = latency
+        return latency
+
+    def stop(self, timeout=None):
+        self.requests.put(None)
+        if self.is_alive():
+            self.join(timeout)
+        self.writer.shutdown()
@@ -0,0 +1,410 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+catalog.py
+
+1. WHAT IT DOES
+An SQLite catalog of every photo and video, with the environment at the
+moment it was taken, so questions like "the photos of last Tuesday when
+the humidity was above 70%" are one indexed query:
+
+    python3 catalog.py find ../catalog.db since=2021-03-16 until=2021-03-17 humidity_min=70
+
+Captures are added from any thread and written by one thread of the
+catalog, in batches of one transaction each.  The database is in WAL
+mode, so queries never wait for the writer.  Each row holds the path,
+size, dimensions and a small JPEG thumbnail of the photo, and the first
+DHT22 and the light level of the reading at capture time (all the DHT22s
+as JSON).
+
+rescan() adds the files which are not in the catalog yet, like those
+taken before it existed.  A directory is only listed again if it has
+changed since the last scan, so the finished interval series are skipped.
+'''
+
+import io
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+
+BATCH_SECONDS = metrics.REGISTRY.histogram("bench_catalog_batch_seconds", "Time to write one batch to the catalog.")
+ROWS = metrics.REGISTRY.counter("bench_catalog_rows_total", "Captures added to the catalog.")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    directory TEXT NOT NULL,
+    kind TEXT NOT NULL,             -- still, interval or video
+    series TEXT,                    -- Interval directory of an interval frame
+    taken REAL NOT NULL,            -- time.time()
+    size INTEGER,
+    width INTEGER,
+    height INTEGER,
+    reading_time REAL,              -- When the environment reading was taken
+    temperature REAL,
+    humidity REAL,
+    light REAL,
+    sensors TEXT,                   -- JSON, every DHT22
+    thumbnail BLOB                  -- JPEG
+);
+CREATE INDEX IF NOT EXISTS captures_taken ON captures (taken);
+CREATE INDEX IF NOT EXISTS captures_kind_taken ON captures (kind, taken);
+CREATE INDEX IF NOT EXISTS captures_humidity ON captures (humidity);
+CREATE INDEX IF NOT EXISTS captures_temperature ON captures (temperature);
+CREATE INDEX IF NOT EXISTS captures_directory ON captures (directory);
+CREATE TABLE IF NOT EXISTS directories (
+    directory TEXT PRIMARY KEY,
+    mtime REAL NOT NULL             -- At the last scan
+);
+"""
+
+COLUMNS = ("path", "directory", "kind", "series", "taken", "size", "width", "height",
+           "reading_time", "temperature", "humidity", "light", "sensors", "thumbnail")
+INSERT = "INSERT OR REPLACE INTO captures ({}) VALUES ({})".format(", ".join(COLUMNS), ", ".join("?" * len(COLUMNS)))
+
+# Columns find() can limit with <name>_min and <name>_max.
+RANGES = ("taken", "size", "width", "height", "temperature", "humidity", "light")
+
+PHOTOS = (".jpg", ".jpeg")
+VIDEOS = (".h264", ".mp4")
+
+
+def capture_kind(directory, name):
+    """The kind of the file name in directory, None if it is not a capture."""
+    extension = os.path.splitext(name)[1].lower()
+    if extension in PHOTOS:
+        return "interval" if os.path.basename(directory).startswith("Interval_") else "still"
+    if extension in VIDEOS:
+        return "video"
+    return None
+
+
+class CaptureIndex(threading.Thread):
+    """
+    The catalog in the SQLite file path, of the captures under roots.
+
+    add() waits up to file_wait seconds for a file which is not written yet
+    (see storage.py) before leaving it out.  A batch or a rescan which fails
+    is left out and passed to on_error(error), the next rescan adds its
+    files.
+    """
+
+    def __init__(self, path, roots=(), thumbnail_size=(160, 96), batch_size=64, flush_interval=2.0,
+                 file_wait=30.0, max_pending=4096, on_error=None):
+        threading.Thread.__init__(self, name="CaptureIndex", daemon=True)
+        self.path = path
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.thumbnail_size = thumbnail_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.file_wait = file_wait
+        self.on_error = on_error
+
+        self.items = queue.Queue(maxsize=max_pending)
+        self._waiting = []  # Captures whose file is not there yet
+        self.added = 0
+        self.dropped = 0  # Not added because the queue was full, the next rescan adds them
+        self.scanned = 0  # Files added by rescans
+        self.errors = 0  # Batches and rescans which failed
+        self.error = None  # The last error
+
+    # Used by the program, from any thread
+
+    def add(self, path, kind, reading=None, taken=None, width=None, height=None):
+        """Add a capture.  reading is the acquisition.Reading at capture time, or None."""
+        environment = None
+        if reading is not None:
+            environment = (reading.timestamp, reading.temperature, reading.humidity, reading.light,
+                           json.dumps([{"name": s.name, "temperature": s.temperature, "humidity": s.humidity,
+                                        "status": s.status} for s in reading.sensors]))
+        self._put(("add", (os.path.abspath(path), kind, taken or time.time(), width, height, environment,
+                           time.monotonic())))
+
+    def remove(self, path):
+        self._put(("remove", os.path.abspath(path)))
+
+    def rescan(self, environment_at=None):
+        """
+        Add the files under the roots missing from the catalog, and remove
+        the rows of files which are gone.  environment_at(t) returns the
+        (time, temperature, humidity, light) at time t, or None.
+        """
+        self._put(("rescan", environment_at))
+
+    def _put(self, item):
+        try:
+            self.items.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, timeout=None):
+        """Write what is queued and close the database."""
+        self.items.put(None)
+        if self.is_alive():
+            self.join(timeout)
+
+    # The writer thread
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")  # Safe in WAL mode, syncs only at checkpoints
+        connection.executescript(SCHEMA)
+        return connection
+
+    def run(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            connection = self._connect()
+        except Exception as e:
+            self._failed(e)
+            return
+        try:
+            stopping = False
+            while not stopping:
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self.items.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    if item[0] == "rescan":
+                        self._guarded(self._write, connection, batch)
+                        batch = []
+                        self._guarded(self._rescan, connection, item[1])
+                    else:
+                        batch.append(item)
+                self._guarded(self._write, connection, batch + [("add", args) for args in self._ready(stopping)])
+        finally:
+            connection.close()
+
+    def _guarded(self, function, *args):
+        # The writer thread carries on after an error, only that batch or rescan is lost.
+        try:
+            function(*args)
+        except Exception as e:
+            self._failed(e)
+
+    def _failed(self, error):
+        self.errors += 1
+        self.error = error
+        if self.on_error is not None:
+            self.on_error(error)
+
+    def _ready(self, stopping):
+        # The waiting captures whose file has arrived, or which waited long enough.
+        waiting, self._waiting = self._waiting, []
+        ready = []
+        for args in waiting:
+            if os.path.exists(args[0]) or stopping or time.monotonic() - args[-1] > self.file_wait:
+                ready.append(args)
+            else:
+                self._waiting.append(args)
+        return ready
+
+    def _write(self, connection, batch):
+        if not batch:
+            return
+        start = time.perf_counter()
+        rows = []
+        removed = []
+        for action, args in batch:
+            if action == "remove":
+                removed.append((args,))
+                continue
+            path = args[0]
+            if not os.path.exists(path):
+                if time.monotonic() - args[-1] <= self.file_wait:
+                    self._waiting.append(args)
+                continue
+            try:
+                rows.append(self._row(*args[:-1]))
+            except OSError:
+                continue  # Removed since, to stay within the quota
+
+        with connection:  # One transaction for the whole batch
+            connection.executemany(INSERT, rows)
+            connection.executemany("DELETE FROM captures WHERE path = ?", removed)
+        self.added += len(rows)
+        ROWS.inc(len(rows))
+        BATCH_SECONDS.observe(time.perf_counter() - start)
+
+    def _row(self, path, kind, taken, width, height, environment):
+        directory = os.path.dirname(path)
+        size = os.path.getsize(path)
+        thumbnail = None
+        if kind != "video":
+            width, height, thumbnail = self._thumbnail(path)
+        series = os.path.basename(directory) if kind == "interval" else None
+        reading_time, temperature, humidity, light, sensors = environment or (None,) * 5
+        return (path, directory, kind, series, taken, size, width, height,
+                reading_time, temperature, humidity, light, sensors, thumbnail)
+
+    def _thumbnail(self, path):
+        try:
+            from PIL import Image
+        except ImportError:
+            return None, None, None
+        try:
+            with Image.open(path) as image:
+                width, height = image.size
+                image.draft("RGB", self.thumbnail_size)  # Decoded at 1/2, 1/4 or 1/8 scale
+                image = image.convert("RGB")
+                image.thumbnail(self.thumbnail_size)
+                data = io.BytesIO()
+                image.save(data, format="JPEG", quality=70)
+                return width, height, data.getvalue()
+        except (OSError, ValueError):
+            return None, None, None
+
+    def _rescan(self, connection, environment_at):
+        scanned = dict(connection.execute("SELECT directory, mtime FROM directories"))
+        for root in self.roots:
+            for directory, _, names in os.walk(root):
+                try:
+                    mtime = os.stat(directory).st_mtime  # Before listing, a file added meanwhile is found next time
+                except OSError:
+                    continue
+                if scanned.get(directory) == mtime:
+                    continue
+
+                known = {path for path, in connection.execute(
+                    "SELECT path FROM captures WHERE directory = ?", (directory,))}
+                present = set()
+                rows = []
+                for name in names:
+                    kind = capture_kind(directory, name)
+                    if kind is None:
+                        continue
+                    path = os.path.join(directory, name)
+                    present.add(path)
+                    if path in known:
+                        continue
+                    try:
+                        taken = os.path.getmtime(path)
+                    except OSError:
+                        continue
+                    environment = environment_at(taken) if environment_at is not None else None
+                    rows.append(self._row(path, kind, taken, None, None,
+                                          environment + (None,) if environment else None))
+
+                with connection:
+                    connection.executemany(INSERT, rows)
+                    connection.executemany("DELETE FROM captures WHERE path = ?",
+                                           [(path,) for path in known - present])
+                    connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)", (directory, mtime))
+                self.scanned += len(rows)
+                ROWS.inc(len(rows))
+
+
+def find(path, since=None, until=None, kind=None, series=None, limit=None, **ranges):
+    """
+    Return the captures as dicts, without the thumbnail, oldest first.
+    since and until are time.time() values, ranges are <column>_min and
+    <column>_max of RANGES, for example humidity_min=70.
+    """
+    where, values = [], []
+    if since is not None:
+        where.append("taken >= ?")
+        values.append(since)
+    if until is not None:
+        where.append("taken < ?")
+        values.append(until)
+    if kind is not None:
+        where.append("kind = ?")
+        values.append(kind)
+    if series is not None:
+        where.append("series = ?")
+        values.append(series)
+    for name, value in ranges.items():
+        column, _, bound = name.rpartition("_")
+        if column not in RANGES or bound not in ("min", "max"):
+            raise ValueError("unknown condition {}".format(name))
+        where.append("{} {} ?".format(column, ">=" if bound == "min" else "<="))
+        values.append(value)
+
+    sql = "SELECT {} FROM captures".format(", ".join(COLUMNS[:-1]))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY taken"
+    if limit is not None:
+        sql += " LIMIT {:d}".format(limit)
+
+    connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        connection.row_factory = sqlite3.Row
+        return [dict(row) for row in connection.execute(sql, values)]
+    finally:
+        connection.close()
+
+
+def browse(path, series=None):
+    """
+    Return (taken, path, series, frames) of the stills and the interval
+    series, newest first, or of the frames of one series in order.  A
+    series is given by its first frame.
+    """
+    if series is not None:
+        sql = "SELECT taken, path, series, 1 FROM captures WHERE series = ? ORDER BY taken"
+        values = (series,)
+    else:
+        sql = ("SELECT taken, path, NULL, 1 FROM captures WHERE kind = 'still' "
+               "UNION ALL "
+               "SELECT MIN(taken), MIN(path), series, COUNT(*) FROM captures WHERE kind = 'interval' GROUP BY series "
+               "ORDER BY 1 DESC")
+        values = ()
+    connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        return connection.execute(sql, values).fetchall()
+    finally:
+        connection.close()
+
+
+def thumbnail(path, capture):
+    """Return the JPEG thumbnail of the capture at path capture, or None."""
+    connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        row = connection.execute("SELECT thumbnail FROM captures WHERE path = ?",
+                                 (os.path.abspath(capture),)).fetchone()
+        return row[0] if row else None
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+
+    import datetime
+    import sys
+
+    if len(sys.argv) >= 3 and sys.argv[1] == "find":
+        conditions = dict(arg.split("=", 1) for arg in sys.argv[3:])
+        for name in ("since", "until"):
+            if name in conditions:
+                conditions[name] = datetime.datetime.fromisoformat(conditions[name]).timestamp()
+        for name in list(conditions):
+            if name.endswith(("_min", "_max")):
+                conditions[name] = float(conditions[name])
+        if "limit" in conditions:
+            conditions["limit"] = int(conditions["limit"])
+        for capture in find(sys.argv[2], **conditions):
+            print("{}  {:8s}  {:>5s}°C {:>5s}%  {}".format(
+                datetime.datetime.fromtimestamp(capture["taken"]).strftime("%Y-%m-%d %H:%M:%S"), capture["kind"],
+                "-" if capture["temperature"] is None else "{:.1f}".format(capture["temperature"]),
+                "-" if capture["humidity"] is None else "{:.1f}".format(capture["humidity"]),
+                capture["path"]))
+    else:
+        print("usage: catalog.py find DATABASE [since=DATE] [until=DATE] [kind=still|interval|video] "
+              "[humidity_min=70] [temperature_max=30] ...")
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+change_detect.py
+
+1. WHAT IT DOES
+Tells whether an interval photo has changed from the last stored one, so
+an overnight timelapse of a bench where nothing happens doesn't fill the
+SD card with identical photos.
+
+Only the luminance of the JPEG is decoded, at 1/8 scale by the JPEG
+decoder itself (draft mode), then compared with NumPy to the luminance
+of the last frame which was stored.  A frame has changed when more than
+threshold of its pixels differ by more than pixel_threshold levels; the
+pixel threshold keeps sensor noise from counting as change.  Comparing
+to the last stored frame, not the previous one, means a slow change (the
+light of a sunrise) is stored once it adds up.
+
+Needs numpy and PIL.
+'''
+
+import io
+import time
+
+import numpy
+from PIL import Image
+
+import metrics
+
+CHECK_SECONDS = metrics.REGISTRY.histogram("bench_change_check_seconds",
+                                           "Time to check an interval photo for change.")
+UNCHANGED = metrics.REGISTRY.counter("bench_change_unchanged_frames_total",
+                                     "Interval photos not stored because nothing changed.")
+BYTES_SAVED = metrics.REGISTRY.counter("bench_change_bytes_saved_total",
+                                       "Bytes of interval photos not written to the SD card.")
+
+
+class ChangeDetector:
+    """
+    changed(data) is called with the JPEG of each frame, in order, from one
+    thread.  Call stored(size) after the frame has been written, or
+    unchanged(size, reference_size) after it has been skipped.
+    """
+
+    def __init__(self, threshold=0.01, pixel_threshold=12, size=(80, 60)):
+        self.threshold = threshold  # Fraction of the pixels which must change
+        self.pixel_threshold = pixel_threshold  # Luminance levels, 0 to 255
+        self.size = size
+
+        self.reference = None  # Luminance of the last stored frame, int16
+        self._frame = None  # Buffers reused for every frame
+        self._difference = None
+        self._mask = None
+
+        self.checked = 0
+        self.skipped = 0
+        self.bytes_stored = 0
+        self.bytes_saved = 0
+        self.check_time = 0.0
+        self.last_score = None  # Fraction of the pixels which changed, of the last frame
+
+    def _luminance(self, data):
+        image = Image.open(io.BytesIO(data))
+        image.draft("L", self.size)  # Decode only the Y channel, scaled down by the decoder
+        image = image.convert("L")
+        if image.size != self.size:
+            image = image.resize(self.size, Image.BILINEAR)
+        return numpy.asarray(image)
+
+    def changed(self, data):
+        """Return True if the frame differs enough from the last stored one to be stored."""
+        start = time.perf_counter()
+        luminance = self._luminance(data)
+        if self._frame is None or self._frame.shape != luminance.shape:
+            self._frame = numpy.empty(luminance.shape, numpy.int16)
+            self._difference = numpy.empty(luminance.shape, numpy.int16)
+            self._mask = numpy.empty(luminance.shape, bool)
+            self.reference = None
+        self._frame[...] = luminance
+
+        if self.reference is None:
+            changed, self.last_score = True, 1.0
+        else:
+            numpy.subtract(self._frame, self.reference, out=self._difference)
+            numpy.abs(self._difference, out=self._difference)
+            numpy.greater(self._difference, self.pixel_threshold, out=self._mask)
+            self.last_score = numpy.count_nonzero(self._mask) / self._mask.size
+            changed = self.last_score > self.threshold
+
+        if changed:
+            # The new reference, swap the buffers rather than copying.
+            if self.reference is None:
+                self.reference = numpy.empty_like(self._frame)
+            self.reference, self._frame = self._frame, self.reference
+
+        elapsed = time.perf_counter() - start
+        self.checked += 1
+        self.check_time += elapsed
+        CHECK_SECONDS.observe(elapsed)
+        return changed
+
+    def stored(self, size):
+        self.bytes_stored += size
+
+    def unchanged(self, size, reference_size=0):
+        self.skipped += 1
+        self.bytes_saved += size - reference_size
+        UNCHANGED.inc()
+        BYTES_SAVED.inc(size - reference_size)
+
+    def mean_check_time(self):
+        """Return the mean time to check a frame, in seconds."""
+        return self.check_time / self.checked if self.checked else 0.0
+
+    def saved_fraction(self):
+        """Return the fraction of the bytes which were not written."""
+        total = self.bytes_stored + self.bytes_saved
+        return self.bytes_saved / total if total else 0.0
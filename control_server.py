@@ -0,0 +1,370 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+control_server.py
+
+1. WHAT IT DOES
+A small HTTP and WebSocket server for operating the bench from another
+computer, using only the standard library.
+
+The server runs an asyncio event loop on a thread of its own and never
+touches Tk.  It shares state with the GUI through a StateBridge:
+
+* the GUI publishes every change (relays, environment, camera, storage)
+  to the bridge, from any thread, and the bridge pushes it to all the
+  WebSocket subscribers at once;
+* commands from the clients are queued on the bridge and run by the GUI
+  on the Tk thread, the HTTP reply waits for the result.
+
+    GET  /state                 all of the latest state
+    GET  /relays, /environment, /camera, /storage
+    POST /relays/<name>         {"state": true} or {"state": false}, no body toggles
+    POST /relays/all_off
+    POST /scenes/<name>
+    POST /camera/still, /camera/interval, /camera/video
+    POST /camera/event          {"name": "smoke"}, saves the last seconds of video
+    GET  /ws                    WebSocket, the state then every change as JSON text
+'''
+
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import json
+import queue
+import struct
+import threading
+import time
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC11B85"
+TOPICS = ("relays", "environment", "camera", "storage")
+MAX_BODY = 8192  # Bytes of a request body or a WebSocket frame, a command is a few dozen
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class StateBridge:
+    """
+    The state shared by the GUI and the server.
+
+    publish() may be called from any thread.  commands() is called by the GUI
+    to collect the queued commands, each one a (action, args, future).
+    """
+
+    def __init__(self, queue_size=64):
+        self.lock = threading.Lock()
+        self.state = {topic: None for topic in TOPICS}
+        self.version = 0
+        self.queue_size = queue_size  # Messages waiting for one subscriber
+
+        self._commands = queue.Queue()
+        self._loop = None
+        self._subscribers = set()  # asyncio.Queue of each subscriber, only used on the loop
+        self.published = 0
+        self.dropped = 0  # Messages dropped because a subscriber was too slow
+
+    def publish(self, topic, data):
+        """Record the new state of topic and push it to the subscribers."""
+        with self.lock:
+            self.state[topic] = data
+            self.version += 1
+            self.published += 1
+            # Encode once for all the subscribers.
+            message = json.dumps({"topic": topic, "version": self.version, "time": time.time(), "data": data})
+            loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._fanout, message)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.state, version=self.version)
+
+    def request(self, action, **args):
+        """Queue a command for the GUI, return a concurrent.futures.Future of its result."""
+        future = concurrent.futures.Future()
+        self._commands.put((action, args, future))
+        return future
+
+    def commands(self):
+        """Return the queued commands, never blocks."""
+        commands = []
+        while True:
+            try:
+                commands.append(self._commands.get_nowait())
+            except queue.Empty:
+                return commands
+
+    # Used by the server, on its loop.
+
+    def attach(self, loop):
+        with self.lock:
+            self._loop = loop
+
+    def subscribe(self):
+        q = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        self._subscribers.discard(q)
+
+    def _fanout(self, message):
+        for q in self._subscribers:
+            if q.full():  # A slow client loses its oldest message rather than holding everyone up.
+                q.get_nowait()
+                self.dropped += 1
+            q.put_nowait(message)
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+
+def relay_command(relays, action, args):
+    """Run a relay command on a relays.RelayBank, return the relay states."""
+    if action == "relay":
+        if args.get("state") is None:
+            relays.toggle(args["name"])
+        else:
+            relays.set(args["name"], bool(args["state"]))
+    elif action == "scene":
+        relays.scene(args["name"])
+    elif action == "all_off":
+        relays.all_off()
+    else:
+        raise ValueError("unknown command {}".format(action))
+    return relays.states()
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message or STATUS_TEXT[status])
+        self.status = status
+
+
+class ControlServer(threading.Thread):
+    """
+    The asyncio server, on its own thread.  command_timeout is how long an
+    HTTP request waits for the GUI to run its command.
+    """
+
+    def __init__(self, bridge, host="127.0.0.1", port=8080, command_timeout=2.0):
+        threading.Thread.__init__(self, name="ControlServer", daemon=True)
+        self.bridge = bridge
+        self.host = host
+        self.port = port
+        self.command_timeout = command_timeout
+
+        self.loop = None
+        self.server = None
+        self.ready = threading.Event()
+        self.error = None
+        self.requests = 0
+        self.connections = 0
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self._client, self.host, self.port, backlog=128))
+            self.port = self.server.sockets[0].getsockname()[1]  # In case port was 0
+            self.bridge.attach(self.loop)
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+
+        try:
+            self.loop.run_forever()
+        finally:
+            self.bridge.attach(None)
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+
+    def stop(self, timeout=None):
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.is_alive():
+            self.join(timeout)
+
+    # HTTP
+
+    async def _client(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                method, path, headers = self._parse(head)
+                self.requests += 1
+                try:
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    status = 400
+                else:
+                    status = 413 if length > MAX_BODY else None
+                if status is not None:
+                    # Where the body ends is not known, or it is not read: the connection is closed.
+                    self._respond(writer, status, {"error": STATUS_TEXT[status]}, False)
+                    await writer.drain()
+                    return
+                body = await reader.readexactly(length) if length else b""
+
+                if path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                    await self._websocket(reader, writer, headers)
+                    return
+
+                try:
+                    status, reply = 200, await self._route(method, path, body)
+                except HTTPError as e:
+                    status, reply = e.status, {"error": str(e)}
+                except Exception as e:
+                    status, reply = 500, {"error": repr(e)}
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self._respond(writer, status, reply, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _parse(self, head):
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, path, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise ConnectionError("bad request line")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        return method, path.split("?", 1)[0].rstrip("/") or "/", headers
+
+    def _respond(self, writer, status, reply, keep_alive):
+        body = json.dumps(reply).encode()
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                     "Connection: {}\r\n\r\n".format(status, STATUS_TEXT.get(status, ""), len(body),
+                                                     "keep-alive" if keep_alive else "close").encode() + body)
+
+    async def _route(self, method, path, body):
+        parts = path.strip("/").split("/")
+
+        if method == "GET":
+            if path == "/state":
+                return self.bridge.snapshot()
+            if len(parts) == 1 and parts[0] in TOPICS:
+                return self.bridge.snapshot()[parts[0]]
+            raise HTTPError(404)
+
+        if method != "POST":
+            raise HTTPError(405)
+
+        try:
+            args = json.loads(body.decode()) if body else {}
+        except ValueError:
+            raise HTTPError(400, "body is not JSON")
+
+        if parts == ["relays", "all_off"]:
+            return await self._command("all_off")
+        if len(parts) == 2 and parts[0] == "relays":
+            return await self._command("relay", name=parts[1], state=args.get("state"))
+        if len(parts) == 2 and parts[0] == "scenes":
+            return await self._command("scene", name=parts[1])
+        if parts == ["camera", "event"]:
+            return await self._command("event", name=args.get("name"))
+        if len(parts) == 2 and parts[0] == "camera" and parts[1] in ("still", "interval", "video"):
+            return await self._command(parts[1])
+        raise HTTPError(404)
+
+    async def _command(self, action, **args):
+        future = self.bridge.request(action, **args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.command_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPError(504, "the bench did not answer")
+        except KeyError as e:
+            raise HTTPError(404, "unknown {}".format(e))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+    # WebSocket, RFC 6455
+
+    async def _websocket(self, reader, writer, headers):
+        key = headers.get("sec-websocket-key", "").encode()
+        accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest()).decode()
+        writer.write("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     "Sec-WebSocket-Accept: {}\r\n\r\n".format(accept).encode())
+
+        q = self.bridge.subscribe()
+        sender = asyncio.ensure_future(self._ws_send(writer, q))
+        try:
+            writer.write(encode_frame(json.dumps({"topic": "state", "time": time.time(),
+                                            "data": self.bridge.snapshot()}).encode()))
+            while True:
+                opcode, payload = await read_frame(reader)
+                if opcode == 0x8:  # Close
+                    writer.write(encode_frame(payload[:2], 0x8))
+                    await writer.drain()
+                    return
+                if opcode == 0x9:  # Ping
+                    writer.write(encode_frame(payload, 0xA))
+                # Text from the client is ignored, commands go through HTTP.
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.bridge.unsubscribe(q)
+            sender.cancel()
+
+    async def _ws_send(self, writer, q):
+        try:
+            while True:
+                writer.write(encode_frame((await q.get()).encode()))
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+
+def encode_frame(payload, opcode=0x1):
+    # Frames from the server are never masked.
+    n = len(payload)
+    if n < 126:
+        header = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return header + payload
+
+
+async def read_frame(reader):
+    b1, b2 = await reader.readexactly(2)
+    n = b2 & 0x7f
+    if n == 126:
+        n, = struct.unpack("!H", await reader.readexactly(2))
+    elif n == 127:
+        n, = struct.unpack("!Q", await reader.readexactly(8))
+    if n > MAX_BODY:
+        raise ConnectionError("frame too large")
+    mask = await reader.readexactly(4) if b2 & 0x80 else None
+    payload = await reader.readexactly(n)
+    if mask:
+        payload = bytes(b ^ mask[i & 3] for i, b in enumerate(payload))
+    return b1 & 0x0f, payload
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# dht_group.py
+
+"""
+Several DHT22 sensors sharing one pigpio connection.
+
+A DHT22 hangs if it is triggered much more often than every 2 seconds.
+SensorGroup reads its sensors one after the other with their triggers
+spread evenly over the interval, so each sensor is read as often as its
+minimum interval allows and no two messages overlap.
+"""
+
+import collections
+import threading
+import time
+
+import DHT22
+import metrics
+
+# Shortest time between two triggers of the same sensor.
+MIN_INTERVAL = 3.0
+
+READ_SECONDS = metrics.REGISTRY.histogram(
+   "bench_dht22_read_seconds", "Time from DHT22 trigger to reading.")
+_reads = metrics.REGISTRY.counter(
+   "bench_dht22_reads_total", "DHT22 reads by status.", ["status"])
+READS = {status: _reads.labels(status) for status in (
+   DHT22.OK, DHT22.BAD_CHECKSUM, DHT22.SHORT_MESSAGE, DHT22.MISSING_MESSAGE, DHT22.RECOVERING)}
+
+# State of one sensor in a snapshot.  temperature and humidity are the
+# last good values (None if there has not been one), status is the
+# status of the last read, tov the time.time() of the last good value and
+# staleness the seconds since then (None if there has not been one).
+sensor_state = collections.namedtuple(
+   "sensor_state",
+   ["name", "gpio", "status", "temperature", "humidity", "tov", "staleness", "reads",
+    "bad_checksum", "short_message", "missing_message", "sensor_resets",
+    "recovery_time"])
+
+class _entry:
+   def __init__(self, name, sensor):
+      self.name = name
+      self.sensor = sensor
+      self.due = 0.0
+      self.reads = 0
+      self.status = None
+      self.temperature = None
+      self.humidity = None
+      self.tov = None
+
+class SensorGroup:
+   """
+   A group of DHT22 sensors on one pigpio.pi().
+
+   The group does not run a thread of its own.  Call service() whenever
+   next_due() has passed, it reads every sensor which is due.
+   """
+
+   def __init__(self, pi, interval=MIN_INTERVAL, timeout=0.5, bulk=False):
+      """
+      Instantiate with the pigpio.pi() shared by all the sensors.
+
+      interval is the time between two readings of the same sensor, it
+      is never less than MIN_INTERVAL.  timeout is passed to
+      DHT22.sensor.read().
+      """
+      self.pi = pi
+      self.interval = max(interval, MIN_INTERVAL)
+      self.timeout = timeout
+      self.bulk = bulk
+
+      self.entries = []
+      self.lock = threading.Lock()
+
+   def add(self, name, gpio, LED=None, power=None):
+      """Add a sensor, return its DHT22.sensor."""
+      s = DHT22.sensor(self.pi, gpio, LED=LED, power=power, bulk=self.bulk)
+      with self.lock:
+         self.entries.append(_entry(name, s))
+         self._stagger()
+      return s
+
+   def _stagger(self):
+      # Spread the first triggers evenly over one interval.
+      now = time.monotonic()
+      step = self.interval / len(self.entries)
+      for i, e in enumerate(self.entries):
+         e.due = now + i * step
+
+   def next_due(self):
+      """Return the time.monotonic() at which the next sensor is due."""
+      if not self.entries:
+         return time.monotonic() + self.interval
+      return min(e.due for e in self.entries)
+
+   def service(self):
+      """Read every sensor which is due, earliest first."""
+      now = time.monotonic()
+      due = sorted((e for e in self.entries if e.due <= now), key=lambda e: e.due)
+
+      for e in due:
+         triggered = time.monotonic()
+         result = e.sensor.read(timeout=self.timeout)
+         READ_SECONDS.observe(time.monotonic() - triggered)
+         READS[result.status].inc()
+
+         # Keep to the staggered schedule, but never trigger the same
+         # sensor again sooner than MIN_INTERVAL after this trigger.
+         e.due = max(e.due + self.interval, triggered + MIN_INTERVAL)
+
+         with self.lock:
+            e.reads += 1
+            e.status = result.status
+            if result.status == DHT22.OK:
+               e.temperature = result.temperature
+               e.humidity = result.humidity
+               e.tov = result.tov
+
+   def snapshot(self):
+      """Return a list with the sensor_state of every sensor, in the order added."""
+      now = time.time()
+      with self.lock:
+         return [sensor_state(
+            e.name, e.sensor.gpio, e.status, e.temperature, e.humidity, e.tov,
+            None if e.tov is None else now - e.tov, e.reads,
+            e.sensor.bad_checksum(), e.sensor.short_message(),
+            e.sensor.missing_message(), e.sensor.sensor_resets(),
+            e.sensor.recovery_time())
+            for e in self.entries]
+
+   def cancel(self):
+      """Cancel all the sensors."""
+      for e in self.entries:
+         e.sensor.cancel()
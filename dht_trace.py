@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+# dht_trace.py
+
+"""
+Recorded DHT22 edge traces.
+
+A trace is the list of (level, tick) edges pigpio reports for one DHT22
+message, starting with the rising edge at which the host releases the
+line.  Traces can be recorded from a real sensor, synthesized, saved to
+a file and replayed through DHT22.sensor without any hardware.
+
+File format, one trace per line, blank lines and lines starting with #
+are ignored:
+
+   <status> <humidity> <temperature> <first tick> <level>:<delta> ...
+
+status is the expected DHT22 read status with spaces replaced by
+underscores (ok, bad_checksum, short, missing).  humidity and
+temperature are the expected values or - if status is not ok.  The
+first tick is the absolute tick of the first edge, each following edge
+is given as its level and the microseconds since the previous edge.
+A level of 2 is a watchdog timeout.
+
+   ok 45.3 -3.2 4294960000 1:0 0:30 1:80 0:80 1:50 0:27 ...
+"""
+
+import collections
+import random
+import time
+
+import DHT22
+
+trace = collections.namedtuple(
+   "trace", ["status", "humidity", "temperature", "edges"])
+
+def synthesize(humidity, temperature, tick=0, bits=40, corrupt=False,
+               bad_bit=False, jitter=0, rng=random):
+   """
+   Return a trace for a message holding humidity and temperature.
+
+   bits is the number of data bits the sensor sends, fewer than 40 gives
+   a short or missing message which ends with a watchdog timeout.
+   corrupt flips the checksum, bad_bit stretches one high pulse past
+   the bad bit limit.  jitter adds up to +/- jitter microseconds to
+   every pulse.
+   """
+   h = int(round(humidity * 10))
+   t = int(round(abs(temperature) * 10))
+   if temperature < 0:
+      t |= 0x8000
+
+   data = [h >> 8, h & 255, t >> 8, t & 255]
+   CS = sum(data) & 255
+   if corrupt:
+      CS ^= 0x01
+   data.append(CS)
+
+   values = [(byte >> (7 - i)) & 1 for byte in data for i in range(8)]
+
+   def pulse(length):
+      return max(1, length + rng.randint(-jitter, jitter)) if jitter else length
+
+   lengths = [(1, 0), (0, pulse(30)), (1, pulse(80)), (0, pulse(80))]
+   for i, val in enumerate(values[:bits]):
+      lengths.append((1, pulse(50)))
+      high = 70 if val else 27
+      if bad_bit and i == 20:
+         high = 250
+      lengths.append((0, pulse(high)))
+
+   if bits < 40:
+      lengths.append((2, 200000 - sum(l for _, l in lengths)))
+      if bits < 8:
+         status = DHT22.MISSING_MESSAGE
+      else:
+         status = DHT22.SHORT_MESSAGE
+   else:
+      lengths.append((1, pulse(50)))  # Sensor releases the line.
+      if corrupt or bad_bit:
+         status = DHT22.BAD_CHECKSUM
+      else:
+         status = DHT22.OK
+
+   edges = []
+   for level, length in lengths:
+      tick = (tick + length) & 0xffffffff
+      edges.append((level, tick))
+
+   if status == DHT22.OK:
+      return trace(status, h * 0.1, (t & 0x7fff) * (-0.1 if temperature < 0 else 0.1), edges)
+   return trace(status, None, None, edges)
+
+def random_traces(count, seed=1):
+   """
+   Return count synthesized traces.  Most are good readings, a few are
+   corrupted, short or missing, some are negative temperatures and some
+   straddle the 32 bit tick wrap around.
+   """
+   rng = random.Random(seed)
+   traces = []
+   for _ in range(count):
+      humidity = rng.randint(0, 1000) * 0.1
+      temperature = rng.randint(-400, 800) * 0.1
+      tick = rng.choice([rng.randrange(1 << 32), 0xffffffff - rng.randrange(6000)])
+      kind = rng.random()
+      if kind < 0.90:
+         t = synthesize(humidity, temperature, tick, jitter=8, rng=rng)
+      elif kind < 0.94:
+         t = synthesize(humidity, temperature, tick, corrupt=True, jitter=8, rng=rng)
+      elif kind < 0.96:
+         t = synthesize(humidity, temperature, tick, bad_bit=True, jitter=8, rng=rng)
+      elif kind < 0.98:
+         t = synthesize(humidity, temperature, tick, bits=rng.randint(8, 39), jitter=8, rng=rng)
+      else:
+         t = synthesize(humidity, temperature, tick, bits=rng.randint(0, 7), jitter=8, rng=rng)
+      traces.append(t)
+   return traces
+
+def _value(v):
+   return "-" if v is None else "{:.1f}".format(v)
+
+def format_trace(t):
+   """Return trace t as one line of a trace file."""
+   fields = [t.status.replace(" ", "_"), _value(t.humidity), _value(t.temperature),
+             str(t.edges[0][1])]
+   last = t.edges[0][1]
+   for level, tick in t.edges:
+      fields.append("{}:{}".format(level, (tick - last) & 0xffffffff))
+      last = tick
+   return " ".join(fields)
+
+def parse_trace(line):
+   """Return the trace held in one line of a trace file."""
+   fields = line.split()
+   status = fields[0].replace("_", " ")
+   humidity = None if fields[1] == "-" else float(fields[1])
+   temperature = None if fields[2] == "-" else float(fields[2])
+   tick = int(fields[3])
+   edges = []
+   for field in fields[4:]:
+      level, delta = field.split(":")
+      tick = (tick + int(delta)) & 0xffffffff
+      edges.append((int(level), tick))
+   return trace(status, humidity, temperature, edges)
+
+def save(path, traces):
+   """Write traces to a trace file."""
+   with open(path, "w") as f:
+      f.write("# DHT22 edge traces, see dht_trace.py for the format.\n")
+      for t in traces:
+         f.write(format_trace(t) + "\n")
+
+def load(path):
+   """Return the traces held in a trace file."""
+   traces = []
+   with open(path) as f:
+      for line in f:
+         line = line.strip()
+         if line and not line.startswith("#"):
+            traces.append(parse_trace(line))
+   return traces
+
+def record(pi, gpio, count, interval=3):
+   """
+   Record count traces from a real DHT22 on gpio.
+
+   The expected values are those decoded by DHT22.sensor at the time.
+   """
+   import pigpio
+
+   s = DHT22.sensor(pi, gpio)
+   edges = []
+
+   def cb(gpio, level, tick):
+      edges.append((level, tick))
+
+   recorder = pi.callback(gpio, pigpio.EITHER_EDGE, cb)
+   pi.set_watchdog(gpio, 0)
+
+   traces = []
+   try:
+      for _ in range(count):
+         del edges[:]
+         result = s.read()
+         time.sleep(0.05)  # Let the last edges arrive.
+         # Drop the host trigger edges, the trace starts at the release.
+         start = 0
+         for i, (level, tick) in enumerate(edges):
+            if level == 1:
+               start = i
+               break
+         traces.append(trace(result.status, result.humidity, result.temperature,
+                             edges[start:]))
+         time.sleep(interval)
+   finally:
+      recorder.cancel()
+      s.cancel()
+
+   return traces
+
+if __name__ == "__main__":
+
+   import sys
+
+   # dht_trace.py record GPIO COUNT FILE   record traces from a sensor
+   # dht_trace.py generate COUNT FILE      write synthesized traces
+
+   if len(sys.argv) == 5 and sys.argv[1] == "record":
+      import pigpio
+      pi = pigpio.pi()
+      save(sys.argv[4], record(pi, int(sys.argv[2]), int(sys.argv[3])))
+      pi.stop()
+   elif len(sys.argv) == 4 and sys.argv[1] == "generate":
+      save(sys.argv[3], random_traces(int(sys.argv[2])))
+   else:
+      print("usage: dht_trace.py record GPIO COUNT FILE | generate COUNT FILE")
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+eventlog.py
+
+1. WHAT IT DOES
+The bench computer log, built on the logging module.
+
+Every record goes to a rotating file on the SD card and to a fixed size
+ring in memory.  The ring also keeps the lines that have not been shown
+yet, the GUI takes them in one batch a few times a second instead of
+inserting into the Text widget for every event.  Records can be logged
+from any thread.
+'''
+
+import collections
+import logging
+import logging.handlers
+import os
+
+LOGGER_NAME = "bench"
+
+
+class RingHandler(logging.Handler):
+    """
+    Keeps the last capacity formatted records.  take() returns the records
+    logged since the last call, oldest first.
+    """
+
+    def __init__(self, capacity=1000):
+        logging.Handler.__init__(self)
+        self.lines = collections.deque(maxlen=capacity)
+        self.unseen = collections.deque(maxlen=capacity)
+        self.dropped = 0  # Lines which were pushed out of unseen before being taken
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        # emit() is called with the handler lock held.
+        if len(self.unseen) == self.unseen.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+        self.unseen.append(line)
+
+    def take(self, limit=None):
+        """Return the new lines, at most the last limit of them, never blocks for long."""
+        self.acquire()
+        try:
+            lines = list(self.unseen)
+            self.unseen.clear()
+        finally:
+            self.release()
+        if limit is not None:
+            lines = lines[-limit:]
+        return lines
+
+    def history(self):
+        """Return all the lines in the ring, oldest first."""
+        self.acquire()
+        try:
+            return list(self.lines)
+        finally:
+            self.release()
+
+
+class EventLog:
+    """
+    The "bench" logger with a RotatingFileHandler in directory and a
+    RingHandler for the GUI.
+    """
+
+    def __init__(self, directory, capacity=1000, max_bytes=1024 * 1024, backups=5):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.logger = logging.getLogger(LOGGER_NAME)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+        self.file = logging.handlers.RotatingFileHandler(os.path.join(directory, "bench.log"),
+                                                         maxBytes=max_bytes, backupCount=backups)
+        self.file.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s %(message)s"))
+        self.logger.addHandler(self.file)
+
+        self.ring = RingHandler(capacity)
+        self.ring.setFormatter(logging.Formatter("%(asctime)s %(message)s", "%H:%M:%S"))
+        self.logger.addHandler(self.ring)
+
+    def take(self, limit=None):
+        return self.ring.take(limit)
+
+    def close(self):
+        for handler in (self.file, self.ring):
+            self.logger.removeHandler(handler)
+            handler.close()
@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+gallery.py
+
+1. WHAT IT DOES
+A scrollable gallery of the earlier stills and interval series, for the
+Camera tab and the touchscreen.
+
+The thumbnails are decoded by a small pool of threads: the small JPEG the
+catalog keeps of each photo, or else the photo itself, decoded at 1/2,
+1/4 or 1/8 scale by the JPEG decoder (draft mode).  The PhotoImages are
+created on the Tk thread and kept in an LRU cache of a fixed number of
+thumbnails, so the memory used doesn't grow with the number of photos.
+
+The gallery only has canvas items for the rows on screen, plus one.  When
+it scrolls by less than a row the items are moved; when a row scrolls off
+its items are reused for the row coming in.  Only the thumbnails of the
+rows on screen and of the next screen are decoded, the others queued are
+cancelled, so a fast swipe through thousands of photos doesn't leave the
+pool busy with photos which have already scrolled past.
+'''
+
+import collections
+import concurrent.futures
+import io
+import queue
+import time
+
+from tkinter import Canvas
+
+import catalog
+import metrics
+
+THUMBNAIL_SECONDS = metrics.REGISTRY.histogram("bench_gallery_thumbnail_seconds",
+                                               "Time to load one gallery thumbnail.")
+THUMBNAILS = metrics.REGISTRY.counter("bench_gallery_thumbnails_total", "Gallery thumbnails loaded, by source.",
+                                      ["source"])
+FROM_CATALOG = THUMBNAILS.labels("catalog")
+DECODED = THUMBNAILS.labels("decoded")  # Not in the catalog, decoded from the photo
+
+# One entry of the gallery.  series is the Interval directory of a series or of its frames, path is
+# None for the entry going back to the list of series.
+GalleryItem = collections.namedtuple("GalleryItem", ["path", "label", "series"])
+
+PAD = 8
+LABEL_HEIGHT = 16
+
+
+class ThumbnailCache:
+    """The last capacity thumbnails used, by key."""
+
+    def __init__(self, capacity=120):
+        self.capacity = capacity
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ThumbnailLoader:
+    """
+    Loads PIL images of photos scaled to fit a size, on a pool of workers.
+    request(), want() and results() are called from the Tk thread.  The key
+    of an image is (path, size).
+    """
+
+    def __init__(self, size=(160, 96), workers=2, catalog_path=None):
+        self.size = size
+        self.catalog_path = catalog_path
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="Thumbnail")
+        self._futures = {}  # key -> Future, of the images requested and not collected yet
+        self._done = queue.Queue()
+        self.loaded = 0
+        self.cancelled = 0
+        self.failed = 0
+
+    def request(self, path, size=None):
+        """Queue the image of path at size (the thumbnail size by default), return its key."""
+        key = (path, size or self.size)
+        if key not in self._futures:
+            future = self.executor.submit(self._load, *key)
+            future.add_done_callback(lambda future, key=key: self._done.put((key, future)))
+            self._futures[key] = future
+        return key
+
+    def want(self, keys):
+        """Cancel the requests which are not in keys and have not started."""
+        for key, future in list(self._futures.items()):
+            if key not in keys and future.cancel():
+                del self._futures[key]
+                self.cancelled += 1
+
+    def results(self):
+        """Yield the (key, image) loaded since the last call, image is None if it failed."""
+        while True:
+            try:
+                key, future = self._done.get_nowait()
+            except queue.Empty:
+                return
+            if future.cancelled() or self._futures.get(key) is not future:
+                continue
+            del self._futures[key]
+            if future.exception() is not None:
+                self.failed += 1
+                yield key, None
+            else:
+                self.loaded += 1
+                yield key, future.result()
+
+    def _load(self, path, size):
+        from PIL import Image
+
+        start = time.perf_counter()
+        image = None
+        if size == self.size and self.catalog_path is not None:
+            try:
+                data = catalog.thumbnail(self.catalog_path, path)
+            except Exception:
+                data = None  # No catalog yet
+            if data is not None:
+                image = Image.open(io.BytesIO(data))
+                image.load()
+                FROM_CATALOG.inc()
+        if image is None:
+            image = Image.open(path)
+            image.draft("RGB", size)  # Decoded at 1/2, 1/4 or 1/8 scale
+            image = image.convert("RGB")
+            DECODED.inc()
+        if image.width > size[0] or image.height > size[1]:
+            image.thumbnail(size)
+        THUMBNAIL_SECONDS.observe(time.perf_counter() - start)
+        return image
+
+    def stop(self):
+        for future in self._futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class Gallery(Canvas):
+
+    def __init__(self, master, loader, cache, width=450, height=380, on_open=None, **kw):
+        """
+        A grid of the thumbnails of loader, kept in cache, a ThumbnailCache.
+        on_open(item) is called with the GalleryItem tapped.  Call loaded()
+        with the results of the loader.
+        """
+        Canvas.__init__(self, master, width=width, height=height,
+                        background="black", highlightthickness=0, **kw)
+        self.loader = loader
+        self.cache = cache
+        self.on_open = on_open
+        self.galleryHeight = height
+
+        thumbnailWidth, thumbnailHeight = loader.size
+        self.columns = max(1, width // (thumbnailWidth + PAD))
+        self.cellWidth = width // self.columns
+        self.cellHeight = thumbnailHeight + LABEL_HEIGHT + PAD
+
+        # The canvas items of the rows on screen, plus the one partly scrolled in: (background,
+        # image, label) of each cell.
+        self.rows = height // self.cellHeight + 2
+        self.cells = []
+        for i in range(self.rows * self.columns):
+            background = self.create_rectangle(0, 0, 0, 0, fill="#202020", outline="", tags="cell")
+            image = self.create_image(0, 0, anchor="n", tags="cell")
+            label = self.create_text(0, 0, anchor="s", fill="white", font=("Helvetica", 9), tags="cell")
+            self.cells.append((background, image, label))
+        self.shown = {}  # key -> image item, of the cells on screen
+
+        self.items = []
+        self.offset = 0  # Pixels scrolled from the top
+        self.firstRow = None  # Row of the first row of cells
+        self.direction = 1  # Of the last scroll, the next screen is loaded ahead in this direction
+
+        self.pressY = None
+        self.lastY = None
+        self.lastMotion = None
+        self.velocity = 0.0  # Pixels per second, of the swipe
+        self.dragged = False
+        self.glide = None
+
+        self.bind("<ButtonPress-1>", self.press)
+        self.bind("<B1-Motion>", self.drag)
+        self.bind("<ButtonRelease-1>", self.release)
+        self.bind("<MouseWheel>", lambda event: self.scrollTo(self.offset - event.delta))
+        self.bind("<Button-4>", lambda event: self.scrollTo(self.offset - self.cellHeight // 2))
+        self.bind("<Button-5>", lambda event: self.scrollTo(self.offset + self.cellHeight // 2))
+
+    def setItems(self, items):
+        """Show items, a list of GalleryItem, from the top."""
+        self.items = items
+        self.offset = 0
+        self.firstRow = None
+        self.scrollTo(0)
+
+    def key(self, item):
+        return (item.path, self.loader.size)
+
+    def scrollTo(self, offset):
+        rows = (len(self.items) + self.columns - 1) // self.columns
+        offset = max(0, min(offset, rows * self.cellHeight - self.galleryHeight))
+        if offset != self.offset:
+            self.direction = 1 if offset > self.offset else -1
+        firstRow = int(offset // self.cellHeight)
+        if firstRow == self.firstRow:
+            # Still the same rows, only move them.
+            self.move("cell", 0, self.offset - offset)
+            self.offset = offset
+            return
+        self.offset = offset
+        self.firstRow = firstRow
+        self.layout()
+
+    def layout(self):
+        # Give every cell the item of its row and column, and load what is missing.
+        self.shown = {}
+        for i, (background, image, label) in enumerate(self.cells):
+            row = self.firstRow + i // self.columns
+            column = i % self.columns
+            index = row * self.columns + column
+            if index >= len(self.items):
+                self.itemconfig(background, state="hidden")
+                self.itemconfig(image, state="hidden")
+                self.itemconfig(label, state="hidden")
+                continue
+
+            item = self.items[index]
+            x = column * self.cellWidth
+            y = row * self.cellHeight - self.offset
+            self.coords(background, x + PAD // 2, y + PAD // 2, x + self.cellWidth - PAD // 2,
+                        y + self.cellHeight - PAD // 2)
+            self.coords(image, x + self.cellWidth // 2, y + PAD // 2)
+            self.coords(label, x + self.cellWidth // 2, y + self.cellHeight - PAD // 2)
+            photo = None
+            if item.path is not None:
+                key = self.key(item)
+                photo = self.cache.get(key)
+                self.shown[key] = image
+            self.itemconfig(background, state="normal")
+            self.itemconfig(image, image=photo or "", state="normal")
+            self.itemconfig(label, text=item.label, state="normal")
+        self.load()
+
+    def load(self):
+        # The thumbnails on screen first, then those of the next screen.
+        wanted = set()
+        first = self.firstRow * self.columns
+        cells = len(self.cells)
+        ahead = first + cells if self.direction > 0 else first - cells
+        for index in list(range(first, first + cells)) + list(range(ahead, ahead + cells)):
+            if 0 <= index < len(self.items) and self.items[index].path is not None:
+                key = self.key(self.items[index])
+                wanted.add(key)
+                if key not in self.cache:
+                    self.loader.request(key[0])
+        self.loader.want(wanted)
+
+    def loaded(self, key, image):
+        """Cache the PIL image of key, loaded by the loader.  Call on the Tk thread."""
+        from PIL import ImageTk
+
+        if image is None:
+            return
+        photo = ImageTk.PhotoImage(image)
+        self.cache.put(key, photo)
+        if key in self.shown:
+            self.itemconfig(self.shown[key], image=photo)
+
+    # Touch
+
+    def press(self, event):
+        if self.glide is not None:
+            self.after_cancel(self.glide)
+            self.glide = None
+        self.pressY = self.lastY = event.y
+        self.lastMotion = time.monotonic()
+        self.velocity = 0.0
+        self.dragged = False
+
+    def drag(self, event):
+        if self.lastY is None:
+            return
+        if abs(event.y - self.pressY) > PAD:
+            self.dragged = True
+        now = time.monotonic()
+        dy = self.lastY - event.y
+        self.velocity = dy / max(now - self.lastMotion, 1e-3)
+        self.lastY = event.y
+        self.lastMotion = now
+        self.scrollTo(self.offset + dy)
+
+    def release(self, event):
+        if self.lastY is None:
+            return
+        self.lastY = None
+        if self.dragged:
+            if time.monotonic() - self.lastMotion < 0.1:
+                self.glide = self.after(16, self.coast)
+            return
+        index = int((event.y + self.offset) // self.cellHeight) * self.columns + int(event.x // self.cellWidth)
+        if index < len(self.items) and self.on_open is not None:
+            self.on_open(self.items[index])
+
+    def coast(self):
+        # Keep scrolling after a swipe, slowing down.
+        self.velocity *= 0.92
+        if abs(self.velocity) < 50:
+            self.glide = None
+            return
+        previous = self.offset
+        self.scrollTo(self.offset + self.velocity * 0.016)
+        if self.offset == previous:
+            self.glide = None  # At the top or the bottom
+            return
+        self.glide = self.after(16, self.coast)
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+load_control.py
+
+1. WHAT IT DOES
+Load test of the control API (control_server.py).
+
+Half of the clients subscribe to the WebSocket and measure how long each
+change takes to reach them, the other half keep toggling relays and
+reading the state over HTTP.  By default the server runs here on the
+simulated hardware of simulation.py, with a stand-in for the GUI that
+runs the commands every 50 ms like the Tk loop does.  Give HOST:PORT to
+load a running bench computer instead.
+
+    python3 load_control.py [CLIENTS] [SECONDS] [HOST:PORT]
+'''
+
+import asyncio
+import base64
+import collections
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+import simulation
+
+simulation.install()
+
+import pigpio
+
+import bench_relays
+from acquisition import AcquisitionEngine
+from adc import ADCSampler
+from control_server import ControlServer, StateBridge, read_frame, relay_command
+from dht_group import SensorGroup
+from relays import RelayBank
+
+COMMAND_POLL_FREQUENCY = 0.05  # Like the GUI, in seconds
+
+
+class SimulatedBench(threading.Thread):
+    """The relays and environment readings of the bench, without the GUI."""
+
+    def __init__(self, bridge):
+        threading.Thread.__init__(self, name="SimulatedBench", daemon=True)
+        self.bridge = bridge
+        self.pi = pigpio.pi()
+        self.relays = RelayBank(self.pi, bench_relays.CHANNELS,
+                                on_change=lambda name, state: bridge.publish("relays", self.relays.states()))
+        sensors = SensorGroup(self.pi)
+        sensors.add("Ambient", 3)
+        self.adc = ADCSampler(channels=[0])
+        self.acquisition = AcquisitionEngine(sensors, self.adc, interval=1.0)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        self.adc.start()
+        self.acquisition.start()
+        self.bridge.publish("relays", self.relays.states())
+        while not self._stop_event.wait(COMMAND_POLL_FREQUENCY):
+            for action, args, future in self.bridge.commands():
+                try:
+                    future.set_result(relay_command(self.relays, action, args))
+                except Exception as e:
+                    future.set_exception(e)
+            reading = self.acquisition.latest()
+            if reading is not None:
+                self.bridge.publish("environment", dict(reading._asdict(),
+                                                        sensors=[s._asdict() for s in reading.sensors]))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.acquisition.stop(timeout=1)
+        self.adc.stop(timeout=1)
+
+
+async def http(reader, writer, host, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else b""
+    writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(
+        method, path, host, len(data)).encode() + data)
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    length = 0
+    for line in lines[1:]:
+        if line.lower().startswith("content-length:"):
+            length = int(line.split(":")[1])
+    return status, json.loads((await reader.readexactly(length)).decode())
+
+
+async def http_client(host, port, names, end, results):
+    reader, writer = await asyncio.open_connection(host, port)
+    i = 0
+    while time.monotonic() < end:
+        start = time.perf_counter()
+        if i % 2:
+            status, _ = await http(reader, writer, host, "GET", "/state")
+            results["GET /state"].append(time.perf_counter() - start)
+        else:
+            status, _ = await http(reader, writer, host, "POST", "/relays/" + names[i // 2 % len(names)])
+            results["POST /relays/<name>"].append(time.perf_counter() - start)
+        results["status {}".format(status)].append(1)
+        i += 1
+    writer.close()
+
+
+async def ws_client(host, port, end, results):
+    reader, writer = await asyncio.open_connection(host, port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write("GET /ws HTTP/1.1\r\nHost: {}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                 "Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n".format(host, key).encode())
+    await reader.readuntil(b"\r\n\r\n")
+    while True:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            opcode, payload = await asyncio.wait_for(read_frame(reader), remaining)
+        except asyncio.TimeoutError:
+            break
+        message = json.loads(payload.decode())
+        results["push " + message["topic"]].append(time.time() - message["time"])
+    writer.close()
+
+
+async def load(host, port, clients, seconds, results):
+    names = [c.name for c in bench_relays.CHANNELS]
+    end = time.monotonic() + seconds
+    subscribers = [ws_client(host, port, end + 0.5, results) for _ in range(clients - clients // 2)]
+    commanders = [http_client(host, port, names, end, results) for _ in range(clients // 2)]
+    await asyncio.gather(*(subscribers + commanders))
+
+
+def report(results, seconds):
+    print("                         count      /s   mean ms  median ms  p95 ms   max ms")
+    for name in sorted(results):
+        values = sorted(results[name])
+        if name.startswith("status"):
+            print("  {:22s} {:7d} {:7.0f}".format(name, len(values), len(values) / seconds))
+            continue
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        print("  {:22s} {:7d} {:7.0f} {:9.2f} {:10.2f} {:7.2f} {:8.2f}".format(
+            name, len(values), len(values) / seconds, statistics.mean(values) * 1000,
+            statistics.median(values) * 1000, p95 * 1000, values[-1] * 1000))
+
+
+if __name__ == "__main__":
+
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+
+    server = bench = None
+    if len(sys.argv) > 3:
+        host, port = sys.argv[3].rsplit(":", 1)
+        port = int(port)
+    else:
+        bridge = StateBridge()
+        server = ControlServer(bridge, port=0)
+        server.start()
+        server.ready.wait()
+        if server.error is not None:
+            sys.exit("Control server failed: {}".format(server.error))
+        bench = SimulatedBench(bridge)
+        bench.start()
+        host, port = "127.0.0.1", server.port
+
+    results = collections.defaultdict(list)
+    asyncio.run(load(host, port, clients, seconds, results))
+
+    print("{} clients for {:.0f} s against {}:{}".format(clients, seconds, host, port))
+    report(results, seconds)
+    if server is not None:
+        print("Messages published {}, dropped for slow subscribers {}".format(bridge.published, bridge.dropped))
+        bench.stop()
+        server.stop(timeout=1)
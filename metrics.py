@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+metrics.py
+
+1. WHAT IT DOES
+Counters, gauges and latency histograms for the bench computer, served
+in the Prometheus text format:
+
+    curl http://localhost:9110/metrics
+
+Metrics are created once, when a module is loaded or an object set up,
+and updating one only changes numbers in place: no lock and no new
+objects besides the numbers themselves, so they can be updated from a
+pigpio callback or the Tk thread.  Updates from several threads at
+the same moment can, rarely, lose a count, which is fine for monitoring.
+
+Values which the program already keeps, like the DHT22 error counts, are
+read with a function when the metrics are scraped and cost nothing until
+then.
+'''
+
+import bisect
+import http.server
+import threading
+
+# Seconds, from a fast pigpio call to a slow photo.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Family:
+    """A metric with labels.  labels() is meant to be called at setup, not on every update."""
+
+    def __init__(self, kind, labelnames, make):
+        self.kind = kind
+        self.labelnames = labelnames
+        self.make = make
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self.make()
+        return child
+
+    def samples(self):
+        with self.lock:
+            return list(self.children.items())
+
+
+def _labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value is None:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # name: (help, kind, labelnames, family or function)
+
+    def _add(self, name, help, kind, labelnames, source):
+        with self.lock:
+            if name in self.metrics:
+                raise ValueError("metric {} already registered".format(name))
+            self.metrics[name] = (help, kind, tuple(labelnames), source)
+
+    def _metric(self, name, help, kind, labelnames, make):
+        family = _Family(kind, tuple(labelnames), make)
+        self._add(name, help, kind, labelnames, family)
+        return family if labelnames else family.labels()
+
+    def counter(self, name, help, labelnames=()):
+        """Return a Counter, or a family of them with labels()."""
+        return self._metric(name, help, "counter", labelnames, Counter)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._metric(name, help, "gauge", labelnames, Gauge)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._metric(name, help, "histogram", labelnames, lambda: Histogram(buckets))
+
+    def function(self, name, help, kind, func, labelnames=()):
+        """
+        A counter or gauge read by calling func() at scrape time.  func
+        returns a number, or with labelnames a list of (label values, number).
+        """
+        self._add(name, help, kind, labelnames, func)
+
+    def unregister(self, name):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def expose(self):
+        """Return all the metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+
+        lines = []
+        for name, (help, kind, labelnames, source) in metrics:
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+            if kind == "histogram":
+                for values, histogram in source.samples():
+                    cumulative = 0
+                    for bound, count in zip(histogram.bounds + (float("inf"),), list(histogram.counts)):
+                        cumulative += count
+                        lines.append("{}_bucket{} {}".format(
+                            name, _labels(labelnames, values, 'le="{}"'.format(_number(bound))), cumulative))
+                    lines.append("{}_sum{} {}".format(name, _labels(labelnames, values), _number(histogram.sum)))
+                    lines.append("{}_count{} {}".format(name, _labels(labelnames, values), cumulative))
+                continue
+
+            if isinstance(source, _Family):
+                samples = [(values, child.value) for values, child in source.samples()]
+            else:
+                try:
+                    samples = source() if labelnames else [((), source())]
+                except Exception:
+                    continue  # A broken function must not break the whole scrape.
+            for values, value in samples:
+                lines.append("{}{} {}".format(name, _labels(labelnames, values), _number(value)))
+        return "\n".join(lines) + "\n"
+
+
+# The registry used by all the modules of the program.
+REGISTRY = Registry()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a line on the terminal.
+
+
+class MetricsServer(threading.Thread):
+    """Serves GET /metrics on its own thread."""
+
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=9110):
+        threading.Thread.__init__(self, name="MetricsServer", daemon=True)
+        self.httpd = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+        self.port = self.httpd.server_address[1]
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self, timeout=None):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.is_alive():
+            self.join(timeout)
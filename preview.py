@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+preview.py
+
+1. WHAT IT DOES
+Live preview of the camera in the Camera tab.
+
+The camera records small RGB frames from its video port, on a splitter
+port of their own so stills and videos can still be taken.  The GPU does
+the scaling and the conversion to RGB.  Each frame is copied into one of
+three buffers allocated up front:
+
+* the camera writes into the back buffer,
+* a finished frame is swapped into the ready slot, replacing the one
+  there if the GUI has not taken it yet (the frame is dropped, never
+  queued),
+* the GUI swaps the ready frame into the front buffer and loads it into
+  a single PhotoImage, which is reused for every frame.
+
+The buffers hold a binary PPM, which Tk reads without PIL.
+'''
+
+import threading
+import time
+
+import metrics
+
+# Frames of the preview, by what happened to them.
+FRAMES = metrics.REGISTRY.counter("bench_preview_frames_total", "Live preview frames.", ["outcome"])
+SHOWN = FRAMES.labels("shown")
+DROPPED = FRAMES.labels("dropped")  # Replaced by a newer frame before the GUI took it
+SKIPPED = FRAMES.labels("skipped")  # Above the target fps, not copied at all
+
+
+def frame_size(size):
+    """The size of the frames the camera writes, RGB is padded to 32 x 16 pixels."""
+    width, height = size
+    return (width + 31) // 32 * 32, (height + 15) // 16 * 16
+
+
+class LivePreview:
+    """
+    The camera output of the live preview.  Call start() and stop() from the
+    GUI, and show(photo) from a root.after() loop at the target fps.
+    """
+
+    def __init__(self, camera, size=(320, 192), fps=15, camera_lock=None, splitter_port=2):
+        self.camera = camera
+        self.size = frame_size(size)
+        self.fps = fps
+        self.camera_lock = camera_lock or threading.Lock()
+        self.splitter_port = splitter_port
+
+        width, height = self.size
+        self.header = "P6 {} {} 255\n".format(width, height).encode()
+        self.frame_bytes = width * height * 3
+        self._buffers = [bytearray(self.header) + bytearray(self.frame_bytes) for _ in range(3)]
+        self._back, self._ready, self._front = self._buffers
+        self._offset = 0  # Bytes of the current frame written into the back buffer
+        self._fresh = False  # The ready slot holds a frame the GUI has not taken
+        self._skip = False  # The current frame is above the target fps
+        self._lock = threading.Lock()
+
+        self.running = False
+        self._last_frame = 0.0
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.received = 0
+        self.shown = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.copy_time = 0.0  # Seconds spent copying frames, on the camera thread
+        self.show_time = 0.0  # Seconds spent loading frames into Tk, on the Tk thread
+        self._started = time.monotonic()
+        self._cpu_started = time.process_time()
+
+    def start(self):
+        if self.running:
+            return
+        self._reset_stats()
+        self._offset = 0
+        self._fresh = False
+        with self.camera_lock:
+            self.camera.start_recording(self, format="rgb", resize=self.size, splitter_port=self.splitter_port)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        with self.camera_lock:
+            self.camera.stop_recording(splitter_port=self.splitter_port)
+
+    # The camera output, called by picamera on its own thread.
+
+    def write(self, data):
+        start = time.perf_counter()
+        n = len(data)
+        if self._offset == 0:
+            # Decide once per frame whether it is wanted.
+            now = time.monotonic()
+            self._skip = now - self._last_frame < 1. / self.fps * 0.9
+            if not self._skip:
+                self._last_frame = now
+
+        if not self._skip:
+            position = len(self.header) + self._offset
+            end = min(position + n, len(self._back))
+            self._back[position:end] = memoryview(data)[:end - position]
+
+        self._offset += n
+        if self._offset >= self.frame_bytes:
+            self._offset = 0
+            self.received += 1
+            if self._skip:
+                self.skipped += 1
+                SKIPPED.inc()
+            else:
+                with self._lock:
+                    self._back, self._ready = self._ready, self._back
+                    if self._fresh:
+                        self.dropped += 1
+                        DROPPED.inc()
+                    self._fresh = True
+
+        if not self._skip:
+            self.copy_time += time.perf_counter() - start
+        return n
+
+    def flush(self):
+        pass
+
+    # Used by the GUI, on the Tk thread.
+
+    def show(self, photo):
+        """Load the newest frame into photo, a tkinter.PhotoImage.  Return False if there was none."""
+        with self._lock:
+            if not self._fresh:
+                return False
+            self._front, self._ready = self._ready, self._front
+            self._fresh = False
+
+        start = time.perf_counter()
+        # As bytes: tkinter passes a bytearray to Tk as its repr, not as binary data.
+        photo.configure(data=bytes(self._front), format="PPM")
+        self.show_time += time.perf_counter() - start
+        self.shown += 1
+        SHOWN.inc()
+        return True
+
+    def stats(self):
+        """Achieved fps, mean ms per frame (copy and Tk) and the CPU use of the process in %."""
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        shown = max(self.shown, 1)
+        cpu = (time.process_time() - self._cpu_started) / elapsed * 100
+        return self.shown / elapsed, (self.copy_time + self.show_time) / shown * 1000, cpu
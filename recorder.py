@@ -0,0 +1,323 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+recorder.py
+
+1. WHAT IT DOES
+Video recording in segments, with the seconds before Record was pressed.
+
+When armed, the camera records h264 all the time into a circular buffer
+in memory (picamera.PiCameraCircularIO) of a fixed size, which holds the
+last pretrigger seconds.  Pressing Record switches the recording to a
+file at the next key frame, then writes out the buffer as the first file
+(_000), so the video starts before the button was pressed.  save_event()
+writes out the buffer without recording.  The camera is switched between
+outputs on a thread of the recorder, as a switch waits for the next key
+frame, up to a second.
+
+A recording is split into files of segment seconds, so a long recording
+is a series of files of a known size and a power cut loses only the last
+one.  Each finished file is remuxed from raw h264 into a seekable MP4 by
+ffmpeg, one at a time on a background thread.  ffmpeg copies the stream
+without decoding it, so its memory use doesn't grow with the length of
+the video.  Without ffmpeg the .h264 files are kept.
+'''
+
+import datetime
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+import metrics
+
+SEGMENTS = metrics.REGISTRY.counter("bench_video_files_total", "Video files finished, by kind.", ["kind"])
+REMUX_SECONDS = metrics.REGISTRY.histogram("bench_video_remux_seconds", "Time to remux one video file to MP4.")
+
+
+class Remuxer(threading.Thread):
+    """
+    Remuxes .h264 files to .mp4, one at a time.  on_done(path) is called on
+    this thread with the file to keep: the MP4, or the h264 if it failed.
+    """
+
+    def __init__(self, framerate=30, on_done=None, max_pending=32):
+        threading.Thread.__init__(self, name="Remuxer", daemon=True)
+        self.framerate = framerate
+        self.on_done = on_done
+        self.ffmpeg = shutil.which("ffmpeg")
+        self.files = queue.Queue(maxsize=max_pending)
+        self.remuxed = 0
+        self.failed = 0
+        self.last_error = None
+
+    def add(self, path):
+        """Queue path to be remuxed, never blocks."""
+        try:
+            if self.ffmpeg is not None and self.is_alive():
+                self.files.put_nowait(path)
+                return
+        except queue.Full:
+            pass  # Too far behind, keep the file as it is.
+        self._done(path)
+
+    def run(self):
+        while True:
+            path = self.files.get()
+            if path is None:
+                return
+            self._done(self._remux(path))
+
+    def _remux(self, path):
+        mp4 = os.path.splitext(path)[0] + ".mp4"
+        start = time.perf_counter()
+        try:
+            result = subprocess.run([self.ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+                                     "-framerate", str(self.framerate), "-i", path,
+                                     "-c", "copy", "-movflags", "+faststart", mp4],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    preexec_fn=lambda: os.nice(10))  # Below the GUI and the capture threads
+            error = result.stderr.decode(errors="replace").strip() if result.returncode else None
+        except OSError as e:
+            error = str(e)
+        REMUX_SECONDS.observe(time.perf_counter() - start)
+
+        if error is not None:
+            self.failed += 1
+            self.last_error = error
+            if os.path.exists(mp4):
+                os.remove(mp4)
+            return path
+        os.remove(path)
+        self.remuxed += 1
+        return mp4
+
+    def _done(self, path):
+        if self.on_done is not None:
+            self.on_done(path)
+
+    def stop(self, timeout=None):
+        """Remux what is queued, waiting up to timeout seconds."""
+        if self.is_alive():
+            self.files.put(None)
+            self.join(timeout)
+
+
+class VideoRecorder:
+    """
+    Records video from splitter_port of the camera of session, a
+    camera_session.CameraSession, into directory.  Call arm() once to start
+    keeping the last pretrigger seconds, then start() and stop().  Finished
+    files go to remuxer, a Remuxer, or else to on_file(path).
+
+    start() and stop() only change the state and return, the camera is
+    switched by the VideoSwitch thread, with the lock of the session held.
+    """
+
+    def __init__(self, session, directory, pretrigger=10, segment=300, bitrate=17000000, splitter_port=1,
+                 remuxer=None, on_file=None):
+        self.session = session
+        self.camera = session.camera
+        self.directory = directory
+        self.camera_lock = session.lock
+        self.pretrigger = pretrigger
+        self.segment = segment
+        self.bitrate = bitrate
+        self.splitter_port = splitter_port
+        self.remuxer = remuxer
+        self.on_file = on_file
+
+        self.lock = threading.Lock()
+        self.buffer = None  # The circular buffer while armed
+        self.recording = False
+        self.name = None  # Date and time of the recording, the start of its file names
+        self.path = None  # The file being recorded
+        self.index = 0  # Of the segment being recorded
+        self.started = None
+        self.error = None  # The last error switching the camera
+        self._stop_segments = threading.Event()  # Of the current recording
+        self._saving = None  # Thread saving the buffer when the recording started
+        self._buffer_lock = threading.Lock()  # Held while the buffer is copied or cleared
+        self._output = None  # What the camera records to: a file, the buffer or None, only for VideoSwitch
+        self._switches = queue.Queue()
+        self._switcher = None
+
+    @property
+    def armed(self):
+        return self.buffer is not None
+
+    def _start_recording(self, output):
+        self.camera.start_recording(output, format="h264", resize=self.session.video_resize, bitrate=self.bitrate,
+                                    splitter_port=self.splitter_port,
+                                    intra_period=int(self.camera.framerate))  # A key frame every second
+
+    def arm(self):
+        """Start keeping the last pretrigger seconds of video in memory."""
+        import picamera
+
+        with self.lock:
+            if self.buffer is not None or self.recording or not self.pretrigger:
+                return
+            buffer = picamera.PiCameraCircularIO(self.camera, seconds=self.pretrigger, bitrate=self.bitrate,
+                                                 splitter_port=self.splitter_port)
+            with self.camera_lock:
+                self._start_recording(buffer)
+            self._output = buffer
+            self.buffer = buffer
+
+    def _file(self, suffix):
+        return os.path.join(self.directory, "{}_{}.h264".format(self.name, suffix))
+
+    def start(self):
+        """Start recording, return the date and time the files are named after."""
+        with self.lock:
+            if self.recording:
+                return self.name
+            os.makedirs(self.directory, exist_ok=True)
+            self.name = datetime.datetime.now().strftime("%B_%d_%y_%H_%M_%S")
+            # The seconds before are saved to _000, the recording starts at _001.
+            self.index = 1 if self.buffer is not None else 0
+            self.path = self._file("{:03d}".format(self.index))
+            self.recording = True
+            self.started = time.monotonic()
+            self._stop_segments = threading.Event()
+            self._switch(self._begin, self.path, self._file("000"), self._stop_segments)
+            return self.name
+
+    def stop(self):
+        """Stop recording, and go back to keeping the last seconds if armed."""
+        with self.lock:
+            if not self.recording:
+                return
+            self._stop_segments.set()
+            self.recording = False
+            self._switch(self._end)
+
+    def _split_segments(self, stop):
+        while not stop.wait(self.segment):
+            with self.lock:
+                if stop.is_set():
+                    return
+                self.index += 1
+                self.path = self._file("{:03d}".format(self.index))
+                self._switch(self._switch_to, self.path)
+
+    # The VideoSwitch thread
+
+    def _switch(self, function, *args):
+        # Called with self.lock held, the switches are done in order.
+        self._switches.put((function, args))
+        if self._switcher is None:
+            self._switcher = threading.Thread(target=self._switch_loop, name="VideoSwitch", daemon=True)
+            self._switcher.start()
+
+    def _switch_loop(self):
+        while True:
+            function, args = self._switches.get()
+            try:
+                function(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self._switches.task_done()
+
+    def _switch_to(self, output):
+        """Record to output, a file, the buffer or None to stop, and finish the file before."""
+        previous = self._output
+        if output is previous:
+            return
+        with self.camera_lock:
+            if previous is None:
+                self._start_recording(output)
+            elif output is None:
+                self.camera.stop_recording(splitter_port=self.splitter_port)
+            else:
+                self.camera.split_recording(output, splitter_port=self.splitter_port)
+        self._output = output
+        if isinstance(previous, str):
+            self._finish(previous, "segment")
+
+    def _begin(self, path, before, stop):
+        self._switch_to(path)
+        threading.Thread(target=self._split_segments, args=(stop,), name="VideoSegments", daemon=True).start()
+
+        # If the buffer of the last recording is still being saved nothing has gone into it since.
+        buffer = self.buffer
+        if buffer is not None and (self._saving is None or not self._saving.is_alive()):
+            # The camera now records to the file, nothing more goes into the buffer.  Save it
+            # on a thread, it is seconds of video for the SD card.
+            self._saving = threading.Thread(target=self._save_before, args=(buffer, before),
+                                            name="VideoPretrigger", daemon=True)
+            self._saving.start()
+
+    def _end(self):
+        saving = self._saving
+        if saving is not None and saving.is_alive():
+            # The buffer must be saved before the camera records into it again, until then
+            # the camera goes on recording to the file.
+            threading.Thread(target=self._rearm, args=(saving,), name="VideoRearm", daemon=True).start()
+        else:
+            self._switch_to(self.buffer)
+
+    def _rearm(self, saving):
+        saving.join()
+        with self.lock:
+            self._switch(self._resume)
+
+    def _resume(self):
+        # Unless a new recording has started since, it takes over from the file.
+        with self.lock:
+            resume = not self.recording
+        if resume:
+            self._switch_to(self.buffer)
+
+    def _save_before(self, buffer, path):
+        with self._buffer_lock:
+            buffer.copy_to(path, seconds=self.pretrigger)
+            buffer.clear()
+        self._finish(path, "pretrigger")
+
+    def save_event(self, event="event"):
+        """
+        Write out the last pretrigger seconds on a thread of its own, return
+        the file or None if there is nothing to save.
+        """
+        with self.lock:
+            if self.buffer is None or self.recording:
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            self.name = datetime.datetime.now().strftime("%B_%d_%y_%H_%M_%S")
+            path = self._file("".join(c for c in event if c.isalnum() or c in "-_") or "event")
+            buffer = self.buffer
+        threading.Thread(target=self._save_event, args=(buffer, path), name="VideoEvent", daemon=True).start()
+        return path
+
+    def _save_event(self, buffer, path):
+        with self._buffer_lock:
+            buffer.copy_to(path, seconds=self.pretrigger)
+        self._finish(path, "event")
+
+    def _finish(self, path, kind):
+        try:
+            if os.path.getsize(path) == 0:
+                os.remove(path)
+                return
+        except OSError:
+            return
+        SEGMENTS.labels(kind).inc()
+        if self.remuxer is not None:
+            self.remuxer.add(path)
+        elif self.on_file is not None:
+            self.on_file(path)
+
+    def close(self):
+        """Stop recording and keeping the last seconds, waits for the camera to be switched."""
+        self.stop()
+        with self.lock:
+            self.buffer = None
+            self._switch(self._switch_to, None)
+        self._switches.join()
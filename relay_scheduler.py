@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+relay_scheduler.py
+
+1. WHAT IT DOES
+Switches relays at set times: auto off after N minutes (for the soldering
+iron and the hot air gun), delayed on, and recurring schedules.
+
+All the pending switches are kept in one min-heap ordered by deadline and
+only one timer is ever armed, for the earliest deadline.  The heap keeps
+the position of every entry, so cancelling a timer is O(log n) as well.
+
+The timer is armed with the after(ms, func) and after_cancel(id) functions
+given to the scheduler, root.after and root.after_cancel in the GUI, so the
+relays are always switched on the Tk thread.
+'''
+
+import itertools
+import time
+
+# Kinds of timer
+AUTO_OFF = "auto-off"
+DELAYED_ON = "delayed on"
+RECURRING = "recurring"
+
+
+class RelayTimer:
+    """One pending switch.  period is None unless the timer is recurring."""
+
+    def __init__(self, id, name, state, deadline, kind, period=None):
+        self.id = id
+        self.name = name
+        self.state = state
+        self.deadline = deadline
+        self.kind = kind
+        self.period = period
+        self.position = None  # Index in the heap, None once it has left the heap.
+
+    def remaining(self):
+        """Return the seconds left before the timer fires."""
+        return max(0.0, self.deadline - time.monotonic())
+
+
+class RelayScheduler:
+
+    def __init__(self, relays, after, after_cancel, on_fire=None):
+        """
+        relays is the relays.RelayBank to switch.  on_fire(timer) is called
+        after a timer has switched its relay.
+        """
+        self.relays = relays
+        self.after = after
+        self.after_cancel = after_cancel
+        self.on_fire = on_fire
+
+        self.heap = []
+        self.timers = {}  # id: RelayTimer
+        self.ids = itertools.count(1)
+
+        self.armed_id = None  # after() id of the single timer
+        self.armed_deadline = None
+
+    # The heap
+
+    def _swap(self, i, j):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        heap[i].position = i
+        heap[j].position = j
+
+    def _less(self, i, j):
+        a, b = self.heap[i], self.heap[j]
+        return (a.deadline, a.id) < (b.deadline, b.id)
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if not self._less(i, parent):
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        n = len(self.heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and self._less(child, smallest):
+                    smallest = child
+            if smallest == i:
+                return
+            self._swap(i, smallest)
+            i = smallest
+
+    def _push(self, timer):
+        timer.position = len(self.heap)
+        self.heap.append(timer)
+        self._sift_up(timer.position)
+
+    def _remove(self, timer):
+        i = timer.position
+        last = self.heap.pop()
+        if last is not timer:
+            self.heap[i] = last
+            last.position = i
+            self._sift_up(i)
+            self._sift_down(last.position)
+        timer.position = None
+
+    # Scheduling
+
+    def _add(self, name, state, delay, kind, period=None):
+        if name not in self.relays:
+            raise KeyError(name)
+        timer = RelayTimer(next(self.ids), name, state, time.monotonic() + delay, kind, period)
+        self.timers[timer.id] = timer
+        self._push(timer)
+        self._arm()
+        return timer
+
+    def auto_off(self, name, seconds):
+        """Switch relay name off in seconds, replacing any earlier auto-off of it."""
+        for timer in self.pending(name):
+            if timer.kind == AUTO_OFF:
+                self.cancel(timer.id)
+        return self._add(name, False, seconds, AUTO_OFF)
+
+    def delayed_on(self, name, seconds):
+        """Switch relay name on in seconds."""
+        return self._add(name, True, seconds, DELAYED_ON)
+
+    def recurring(self, name, state, first, period):
+        """Set relay name to state in first seconds, then every period seconds."""
+        return self._add(name, state, first, RECURRING, period)
+
+    def cancel(self, timer_id):
+        """Cancel a timer, return False if it is not pending."""
+        timer = self.timers.pop(timer_id, None)
+        if timer is None:
+            return False
+        self._remove(timer)
+        self._arm()
+        return True
+
+    def cancel_all(self, name, kind=None):
+        """Cancel the timers of relay name, or only those of kind."""
+        for timer in self.pending(name):
+            if kind is None or timer.kind == kind:
+                self.cancel(timer.id)
+
+    def pending(self, name=None):
+        """Return the pending timers, of relay name or all, earliest first."""
+        timers = [t for t in self.timers.values() if name is None or t.name == name]
+        timers.sort(key=lambda t: (t.deadline, t.id))
+        return timers
+
+    def _arm(self):
+        # Make sure the one timer is set for the earliest deadline.
+        deadline = self.heap[0].deadline if self.heap else None
+        if deadline == self.armed_deadline:
+            return
+        if self.armed_id is not None:
+            self.after_cancel(self.armed_id)
+            self.armed_id = None
+        self.armed_deadline = deadline
+        if deadline is not None:
+            delay = max(0, int((deadline - time.monotonic()) * 1000) + 1)
+            self.armed_id = self.after(delay, self._fire)
+
+    def _fire(self):
+        self.armed_id = None
+        self.armed_deadline = None
+        now = time.monotonic()
+
+        while self.heap and self.heap[0].deadline <= now:
+            timer = self.heap[0]
+            self._remove(timer)
+            if timer.period is not None:
+                # Next deadline from the last one, so a recurring timer does not drift.
+                while timer.deadline <= now:
+                    timer.deadline += timer.period
+                self._push(timer)
+            else:
+                del self.timers[timer.id]
+
+            self.relays.set(timer.name, timer.state)
+            if self.on_fire is not None:
+                self.on_fire(timer)
+
+        self._arm()
+
+    def stop(self):
+        """Disarm the timer, the pending switches are forgotten."""
+        if self.armed_id is not None:
+            self.after_cancel(self.armed_id)
+        self.armed_id = None
+        self.armed_deadline = None
+        self.heap = []
+        self.timers = {}
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+relays.py
+
+1. WHAT IT DOES
+Drives all the relays of the bench from one table.
+
+RelayBank keeps a shadow copy of the relay outputs, so a toggle is a single
+write to pigpiod instead of a read followed by a write.  Changes to several
+relays at once (all off, a scene) are applied with one set_bank_1() and/or
+one clear_bank_1() call.  The hardware is only read back by reconcile(),
+which is meant to be called now and then to catch outside changes.
+'''
+
+import collections
+import threading
+import time
+
+import pigpio
+
+import metrics
+
+# One relay.  name is used in the program, label in the log.
+RelayChannel = collections.namedtuple("RelayChannel", ["name", "gpio", "label"])
+
+APPLY_SECONDS = metrics.REGISTRY.histogram("bench_relay_apply_seconds",
+                                           "Time to switch relays, including the calls to pigpiod.")
+
+
+class RelayBank:
+    """
+    A set of relays on gpios 0-31 of one pigpio.pi().
+
+    All relays are switched off when the bank is created.  on_change(name,
+    state) is called for every relay whose state changes.
+    """
+
+    def __init__(self, pi, channels, scenes=None, on_change=None):
+        self.pi = pi
+        self.channels = collections.OrderedDict((c.name, c) for c in channels)
+        self.scenes = scenes or {}
+        self.on_change = on_change
+
+        self.mask = 0  # Bits of all the relay gpios
+        for c in self.channels.values():
+            self.mask |= 1 << c.gpio
+
+        self.lock = threading.Lock()
+        self.writes = 0  # Calls to pigpiod that change outputs
+
+        for c in self.channels.values():
+            pi.set_mode(c.gpio, pigpio.OUTPUT)
+        pi.clear_bank_1(self.mask)  # All off in one call
+        self.shadow = 0  # Output bits as last written
+
+    def __contains__(self, name):
+        return name in self.channels
+
+    def state(self, name):
+        """Return True if the relay is on, from the shadow copy."""
+        return bool(self.shadow & (1 << self.channels[name].gpio))
+
+    def states(self):
+        """Return a dict of name: True/False for all relays."""
+        return collections.OrderedDict((name, self.state(name)) for name in self.channels)
+
+    def set(self, name, state):
+        """Switch one relay on or off."""
+        self.apply({name: state})
+
+    def toggle(self, name):
+        """Toggle one relay, return its new state."""
+        with self.lock:
+            state = not self.state(name)
+            self._apply({name: state})
+        return state
+
+    def all_off(self):
+        self.apply(dict.fromkeys(self.channels, False))
+
+    def scene(self, scene):
+        """Apply a named scene, a dict of name: state given to the constructor."""
+        self.apply(self.scenes[scene])
+
+    def apply(self, changes):
+        """
+        Apply a dict of name: state with at most one set_bank_1() and one
+        clear_bank_1() call.
+        """
+        with self.lock:
+            self._apply(changes)
+
+    def _apply(self, changes):
+        start = time.perf_counter()
+        on = 0
+        off = 0
+        for name, state in changes.items():
+            bit = 1 << self.channels[name].gpio
+            if state:
+                on |= bit
+            else:
+                off |= bit
+
+        # Only write what actually changes.
+        on &= ~self.shadow
+        off &= self.shadow
+
+        if on:
+            self.pi.set_bank_1(on)
+            self.writes += 1
+        if off:
+            self.pi.clear_bank_1(off)
+            self.writes += 1
+
+        self._changed((self.shadow | on) & ~off)
+        APPLY_SECONDS.observe(time.perf_counter() - start)
+
+    def _changed(self, shadow):
+        # Called with the lock held.
+        changed = self.shadow ^ shadow
+        self.shadow = shadow
+        if changed and self.on_change is not None:
+            for c in self.channels.values():
+                if changed & (1 << c.gpio):
+                    self.on_change(c.name, bool(shadow & (1 << c.gpio)))
+
+    def reconcile(self):
+        """
+        Read the outputs back with one read_bank_1() and correct the shadow
+        copy.  Returns the names of the relays which had been changed from
+        outside.
+        """
+        with self.lock:
+            actual = self.pi.read_bank_1() & self.mask
+            changed = actual ^ self.shadow
+            names = [c.name for c in self.channels.values() if changed & (1 << c.gpio)]
+            self._changed(actual)
+        return names
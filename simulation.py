@@ -0,0 +1,523 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+simulation.py
+
+1. WHAT IT DOES
+Fake hardware for running the bench computer on a PC without a Raspberry
+Pi: a simulated pigpio daemon, DHT22 sensors, a PiCamera and the MCP3008.
+
+SimPi behaves like a pigpio.pi() connection.  It keeps the gpio levels,
+runs watchdogs and delivers edge callbacks from a thread of its own, as
+pigpio does.  When a gpio with a SimDHT22 on it is triggered (written low,
+then switched to an input) the sensor's answer is delivered to the
+callbacks as (gpio, level, tick) edges, so DHT22.sensor._cb decodes it
+exactly as it would on the Pi.
+
+install() puts the fake pigpio, picamera, gpiozero and Adafruit_DHT
+modules in sys.modules.  It must be called before any other module of
+the program is imported:
+
+    BENCH_SIMULATION=1 python3 bench_computer_keystudio_relay.py
+'''
+
+import collections
+import heapq
+import io
+import itertools
+import math
+import random
+import sys
+import threading
+import time
+import types
+
+# pigpio constants, with the values of the real module.
+INPUT = 0
+OUTPUT = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+TIMEOUT = 2
+
+
+def tickDiff(t1, t2):
+    """Microseconds from tick t1 to tick t2, like pigpio.tickDiff."""
+    return (t2 - t1) & 0xffffffff
+
+
+class SimDHT22:
+    """
+    A simulated DHT22.  The readings wander slowly around humidity and
+    temperature.  failure_rate is the fraction of messages which come back
+    with a bad checksum or short.
+    """
+
+    def __init__(self, humidity=45.0, temperature=22.0, failure_rate=0.0, jitter=8, seed=None):
+        self.humidity = humidity
+        self.temperature = temperature
+        self.failure_rate = failure_rate
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.messages = 0
+
+    def message(self, tick):
+        """Return the edges of the next message, starting at tick."""
+        import dht_trace  # Imports DHT22 and so pigpio, which must be the simulated one.
+
+        self.messages += 1
+        rng = self.rng
+        self.humidity = min(100.0, max(0.0, self.humidity + rng.uniform(-0.3, 0.3)))
+        self.temperature = min(80.0, max(-40.0, self.temperature + rng.uniform(-0.1, 0.1)))
+
+        if rng.random() < self.failure_rate:
+            if rng.random() < 0.5:
+                t = dht_trace.synthesize(self.humidity, self.temperature, tick, corrupt=True,
+                                         jitter=self.jitter, rng=rng)
+            else:
+                t = dht_trace.synthesize(self.humidity, self.temperature, tick, bits=rng.randint(8, 39),
+                                         jitter=self.jitter, rng=rng)
+        else:
+            t = dht_trace.synthesize(self.humidity, self.temperature, tick, jitter=self.jitter, rng=rng)
+        return t.edges
+
+
+class _Callback:
+
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        self.pi._cancel_callback(self)
+
+
+class SimPi:
+    """
+    The pigpio.pi() calls used by the bench computer.
+
+    Sensors are added with add_dht22().  With auto_dht22 every gpio which is
+    triggered like a DHT22 gets a sensor of its own the first time.
+    round_trip is the simulated time of one call to the daemon, in seconds.
+    """
+
+    def __init__(self, host=None, port=None, auto_dht22=True, round_trip=0.0):
+        self.connected = True
+        self.auto_dht22 = auto_dht22
+        self.round_trip = round_trip
+
+        self.levels = 0
+        self.modes = {}
+        self.sensors = {}  # gpio: SimDHT22
+        self.calls = 0
+
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.watchdogs = {}  # gpio: (timeout in s, generation)
+        self.generations = itertools.count(1)
+
+        self.events = []  # Heap of (due, seq, func, args) run by the callback thread
+        self.seq = itertools.count()
+        self.wakeup = threading.Condition(self.lock)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="SimPiCallbacks", daemon=True)
+        self.thread.start()
+
+    # Daemon calls
+
+    def _call(self):
+        self.calls += 1
+        if self.round_trip:
+            time.sleep(self.round_trip)
+
+    def get_current_tick(self):
+        return int(time.monotonic() * 1000000) & 0xffffffff
+
+    def set_mode(self, gpio, mode):
+        self._call()
+        previous = self.modes.get(gpio)
+        self.modes[gpio] = mode
+        # A DHT22 answers when the host releases the line after holding it low.
+        if mode == INPUT and previous == OUTPUT and not (self.levels >> gpio) & 1:
+            sensor = self.sensors.get(gpio)
+            if sensor is None and self.auto_dht22:
+                sensor = self.sensors[gpio] = SimDHT22(seed=gpio)
+            if sensor is not None:
+                self._respond(gpio, sensor)
+
+    def get_mode(self, gpio):
+        return self.modes.get(gpio, INPUT)
+
+    def set_pull_up_down(self, gpio, pud):
+        self._call()
+
+    def read(self, gpio):
+        self._call()
+        return (self.levels >> gpio) & 1
+
+    def write(self, gpio, level):
+        self._call()
+        self.modes[gpio] = OUTPUT
+        if level:
+            self.levels |= 1 << gpio
+        else:
+            self.levels &= ~(1 << gpio)
+
+    def read_bank_1(self):
+        self._call()
+        return self.levels
+
+    def set_bank_1(self, bits):
+        self._call()
+        self.levels |= bits
+
+    def clear_bank_1(self, bits):
+        self._call()
+        self.levels &= ~bits
+
+    def set_watchdog(self, gpio, timeout):
+        """Send a TIMEOUT to the callbacks of gpio after timeout ms without an edge, 0 cancels."""
+        self._call()
+        with self.lock:
+            if timeout:
+                generation = next(self.generations)
+                self.watchdogs[gpio] = (timeout / 1000., generation)
+                self._schedule(timeout / 1000., self._watchdog, (gpio, generation))
+            else:
+                self.watchdogs.pop(gpio, None)
+
+    def callback(self, gpio, edge=RISING_EDGE, func=None):
+        self._call()
+        cb = _Callback(self, gpio, edge, func)
+        with self.lock:
+            self.callbacks.append(cb)
+        return cb
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
+        self.connected = False
+
+    # Simulation
+
+    def add_dht22(self, gpio, sensor=None):
+        """Put a SimDHT22 on gpio, return it."""
+        self.sensors[gpio] = sensor or SimDHT22(seed=gpio)
+        return self.sensors[gpio]
+
+    def _cancel_callback(self, cb):
+        with self.lock:
+            if cb in self.callbacks:
+                self.callbacks.remove(cb)
+
+    def _schedule(self, delay, func, args):
+        # Called with the lock held.
+        heapq.heappush(self.events, (time.monotonic() + delay, next(self.seq), func, args))
+        self.wakeup.notify()
+
+    def _respond(self, gpio, sensor):
+        edges = sensor.message(self.get_current_tick())
+        # pigpio buffers the edges, deliver the whole message once it has been sent.
+        duration = tickDiff(edges[0][1], edges[-1][1]) / 1000000.
+        with self.lock:
+            self._schedule(duration, self._deliver, (gpio, edges))
+
+    def _deliver(self, gpio, edges):
+        for level, tick in edges:
+            if level == TIMEOUT:
+                continue  # The watchdog sends the real one.
+            self._edge(gpio, level, tick)
+            self.levels = self.levels & ~(1 << gpio) | (level << gpio)
+        with self.lock:
+            watchdog = self.watchdogs.get(gpio)
+            if watchdog is not None:  # An edge restarts the watchdog.
+                generation = next(self.generations)
+                self.watchdogs[gpio] = (watchdog[0], generation)
+                self._schedule(watchdog[0], self._watchdog, (gpio, generation))
+
+    def _watchdog(self, gpio, generation):
+        with self.lock:
+            watchdog = self.watchdogs.get(gpio)
+            if watchdog is None or watchdog[1] != generation:
+                return
+            self._schedule(watchdog[0], self._watchdog, (gpio, generation))
+        self._edge(gpio, TIMEOUT, self.get_current_tick())
+
+    def _edge(self, gpio, level, tick):
+        with self.lock:
+            callbacks = [cb for cb in self.callbacks if cb.gpio == gpio]
+        for cb in callbacks:
+            if level == TIMEOUT or cb.edge == EITHER_EDGE or cb.edge == (RISING_EDGE if level else FALLING_EDGE):
+                cb.func(gpio, level, tick)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.running and (not self.events or self.events[0][0] > time.monotonic()):
+                    self.wakeup.wait(self.events[0][0] - time.monotonic() if self.events else None)
+                if not self.running:
+                    return
+                due, seq, func, args = heapq.heappop(self.events)
+            func(*args)
+
+
+class FakePiCamera:
+    """
+    The picamera.PiCamera calls used by the bench computer.  Photos are real
+    JPEGs of a test pattern, taking still_time (video_time from the video
+    port) seconds each.  Recordings write a frame every 1 / framerate
+    seconds: raw frames of a moving gradient in "rgb" or "yuv", filler of
+    the right bitrate in "h264".
+    """
+
+    def __init__(self, resolution=(1280, 720), framerate=30, still_time=0.3, video_time=None, frames=4):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.still_time = still_time
+        self.video_time = video_time if video_time is not None else 1. / framerate
+        self.rotation = 0
+        self.sensor_mode = 0
+        # The automatic exposure, which settles at these values
+        self.exposure_mode = "auto"
+        self.shutter_speed = 0
+        self.exposure_speed = 16000
+        self.analog_gain = 2.0
+        self.digital_gain = 1.0
+        self.awb_mode = "auto"
+        self.awb_gains = (1.6, 1.4)
+        self.closed = False
+        self.captures = 0
+        self._frames = [self._pattern(i, frames) for i in range(frames)]
+        self._recordings = {}  # splitter_port: _Recording
+
+    @property
+    def recording(self):
+        return bool(self._recordings)
+
+    def _pattern(self, i, count):
+        from PIL import Image
+        width, height = self.resolution
+        image = Image.new("RGB", (64, 36))
+        image.putdata([(int(255 * x / 64), int(255 * y / 36), int(255 * i / count))
+                       for y in range(36) for x in range(64)])
+        stream = io.BytesIO()
+        image.resize((width, height)).save(stream, format="JPEG", quality=85)
+        return stream.getvalue()
+
+    def _frame(self):
+        data = self._frames[self.captures % len(self._frames)]
+        self.captures += 1
+        return data
+
+    def _write(self, output, data):
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                f.write(data)
+        else:
+            output.write(data)
+
+    def capture(self, output, format="jpeg", use_video_port=False, resize=None, **options):
+        time.sleep(self.video_time if use_video_port else self.still_time)
+        self._write(output, self._frame())
+
+    def capture_continuous(self, output, format="jpeg", use_video_port=False, **options):
+        delay = self.video_time if use_video_port else self.still_time
+        while not self.closed:
+            time.sleep(delay)
+            self._write(output, self._frame())
+            yield output
+
+    def start_recording(self, output, format="h264", resize=None, splitter_port=1, bitrate=17000000, **options):
+        if splitter_port in self._recordings:
+            raise RuntimeError("The camera is already recording on port {}".format(splitter_port))
+        recording = _Recording(output, format, resize or self.resolution, bitrate)
+        self._recordings[splitter_port] = recording
+        threading.Thread(target=self._record, args=(recording,),
+                         name="FakePiCamera port {}".format(splitter_port), daemon=True).start()
+
+    def split_recording(self, output, splitter_port=1, **options):
+        self._recordings[splitter_port].switch(output)
+
+    def _record(self, recording):
+        # Padded like the camera: 32 x 16 pixels, rgb is 3 bytes a pixel, yuv 1.5
+        width, height = (recording.size[0] + 31) // 32 * 32, (recording.size[1] + 15) // 16 * 16
+        row = bytes(range(256)) * (width * 3 // 256 + 1)
+        n = 0
+        while not recording.stop.wait(1. / self.framerate):
+            if recording.format == "rgb":
+                frame = row[n % 256:n % 256 + width * 3] * height
+            elif recording.format == "yuv":
+                frame = (row[n % 256:n % 256 + width * 3] * height)[:width * height * 3 // 2]
+            else:
+                frame = H264_START + bytes(max(0, recording.bitrate // 8 // self.framerate - len(H264_START)))
+            recording.write(frame)
+            n += 1
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        time.sleep(timeout)
+
+    def stop_recording(self, splitter_port=1):
+        recording = self._recordings.pop(splitter_port, None)
+        if recording is not None:
+            recording.close()
+
+    def close(self):
+        for port in list(self._recordings):
+            self.stop_recording(port)
+        self.closed = True
+
+
+H264_START = b"\x00\x00\x00\x01\x65"  # Start code and NAL header of an h264 frame
+
+
+class _Recording:
+    """Where one splitter port of FakePiCamera records to, changed by split_recording()."""
+
+    def __init__(self, output, format, size, bitrate):
+        self.format = format
+        self.size = size
+        self.bitrate = bitrate
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.output = self.file = None
+        self.switch(output)
+
+    def switch(self, output):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(output, "wb") if isinstance(output, str) else None
+            self.output = self.file or output
+
+    def write(self, data):
+        with self.lock:
+            self.output.write(data)
+
+    def close(self):
+        self.stop.set()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class FakeCircularIO:
+    """picamera.PiCameraCircularIO, keeps the last size bytes written to it."""
+
+    def __init__(self, camera, size=None, seconds=None, bitrate=17000000, splitter_port=1):
+        self.size = size if size is not None else int(seconds * bitrate / 8)
+        self.lock = threading.Lock()
+        self._chunks = collections.deque()  # (time.monotonic(), bytes)
+        self._bytes = 0
+
+    def write(self, data):
+        with self.lock:
+            self._chunks.append((time.monotonic(), bytes(data)))
+            self._bytes += len(data)
+            while self._bytes > self.size:
+                self._bytes -= len(self._chunks.popleft()[1])
+        return len(data)
+
+    def copy_to(self, output, size=None, seconds=None, limit=None, first_frame=None):
+        with self.lock:
+            chunks = list(self._chunks)
+        if seconds is not None:
+            chunks = [(t, data) for t, data in chunks if t >= time.monotonic() - seconds]
+        f = open(output, "wb") if isinstance(output, str) else output
+        try:
+            for t, data in chunks:
+                f.write(data)
+        finally:
+            if f is not output:
+                f.close()
+
+    def clear(self):
+        with self.lock:
+            self._chunks.clear()
+            self._bytes = 0
+
+
+# Scripts of the simulated MCP3008 channels, channel: func(seconds) -> 0 to 1.
+# The default is a slow wave, like daylight coming and going.
+MCP3008_SCRIPTS = {}
+
+
+def _default_script(t):
+    return 0.5 + 0.4 * math.sin(t / 60.)
+
+
+class ScriptedMCP3008:
+    """
+    gpiozero.MCP3008 following a script.  read_time is the time of one
+    bit-banged read, in seconds.
+    """
+
+    def __init__(self, channel=0, clock_pin=None, mosi_pin=None, miso_pin=None, select_pin=None,
+                 script=None, noise=0.002, read_time=0.0002):
+        self.channel = channel
+        self.script = script or MCP3008_SCRIPTS.get(channel, _default_script)
+        self.noise = noise
+        self.read_time = read_time
+        self.start = time.monotonic()
+        self.reads = 0
+        self.rng = random.Random(channel)
+
+    @property
+    def value(self):
+        self.reads += 1
+        if self.read_time:
+            time.sleep(self.read_time)
+        v = self.script(time.monotonic() - self.start) + self.rng.uniform(-self.noise, self.noise)
+        return min(1.0, max(0.0, v))
+
+    @property
+    def raw_value(self):
+        return int(round(self.value * 1023))
+
+    def close(self):
+        pass
+
+
+def _read_retry(sensor, pin, retries=15, delay_seconds=2):
+    return 45.0, 22.0
+
+
+def install():
+    """Replace the hardware modules with the simulated ones, return them by name."""
+    modules = {}
+
+    pigpio = types.ModuleType("pigpio")
+    for name in ("INPUT", "OUTPUT", "LOW", "HIGH", "PUD_OFF", "PUD_DOWN", "PUD_UP",
+                 "RISING_EDGE", "FALLING_EDGE", "EITHER_EDGE", "TIMEOUT", "tickDiff"):
+        setattr(pigpio, name, globals()[name])
+    pigpio.pi = SimPi
+    modules["pigpio"] = pigpio
+
+    picamera = types.ModuleType("picamera")
+    picamera.PiCamera = FakePiCamera
+    picamera.PiCameraCircularIO = FakeCircularIO
+    picamera.PiVideoFrameType = types.SimpleNamespace(frame=0, key_frame=1, sps_header=2, motion_data=3)
+    modules["picamera"] = picamera
+
+    gpiozero = types.ModuleType("gpiozero")
+    gpiozero.MCP3008 = ScriptedMCP3008
+    modules["gpiozero"] = gpiozero
+
+    adafruit = types.ModuleType("Adafruit_DHT")
+    adafruit.DHT22 = 22
+    adafruit.AM2302 = 22
+    adafruit.read_retry = _read_retry
+    modules["Adafruit_DHT"] = adafruit
+
+    sys.modules.update(modules)
+    return modules
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+sparkline.py
+
+1. WHAT IT DOES
+A small trend chart of a timeseries.TimeSeries on a Tk Canvas.
+
+Only the points appended since the last refresh are drawn, as new line
+segments.  When the chart is full the existing segments are moved left
+and the ones which scrolled off are deleted, so the number of canvas items
+stays fixed.  The whole chart is only redrawn when a value falls outside
+the vertical range.
+'''
+
+import collections
+import time
+
+from tkinter import Canvas
+
+
+class Sparkline(Canvas):
+
+    def __init__(self, master, series, span=3600, low=0.0, high=100.0,
+                 width=300, height=60, color="#3495EB", **kw):
+        """
+        Draw the last span seconds of series.  low and high are the initial
+        vertical range, it grows to fit the values.
+        """
+        Canvas.__init__(self, master, width=width, height=height,
+                        background="white", highlightthickness=0, **kw)
+        self.series = series
+        self.span = span
+        self.low = low
+        self.high = high
+        self.chartWidth = width
+        self.chartHeight = height
+        self.color = color
+
+        self.origin = time.time() - span  # Time at the left edge.
+        self.last = None  # (time, x, y) of the last point drawn.
+        self.segments = collections.deque()  # (canvas item, end time)
+
+        self.redraw()
+
+    def _x(self, t):
+        return (t - self.origin) * self.chartWidth / self.span
+
+    def _y(self, value):
+        return self.chartHeight - 2 - (value - self.low) * (self.chartHeight - 4) / (self.high - self.low)
+
+    def _fits(self, value):
+        if self.low <= value <= self.high:
+            return True
+        margin = (self.high - self.low) * 0.1
+        self.low = min(self.low, value - margin)
+        self.high = max(self.high, value + margin)
+        return False
+
+    def redraw(self):
+        """Draw the whole chart from the series."""
+        self.delete("all")
+        self.segments.clear()
+        self.last = None
+
+        now = time.time()
+        self.origin = now - self.span
+        records = self.series.range(self.origin, max_points=self.chartWidth)
+        for record in records:
+            self._fits(record[1])
+            self._fits(record[3])
+
+        for t, low, mean, high in records:
+            self._draw(t, mean)
+
+    def refresh(self):
+        """Draw the points appended since the last refresh."""
+        since = self.origin if self.last is None else self.last[0]
+        points = self.series.since(since)
+        if self.last is not None and points and points[0][0] <= self.last[0]:
+            points = points[1:]
+
+        for t, value in points:
+            if not self._fits(value):
+                self.redraw()
+                return
+            self._scroll(t)
+            self._draw(t, value)
+
+    def _scroll(self, t):
+        x = self._x(t)
+        if x <= self.chartWidth:
+            return
+
+        shift = x - self.chartWidth
+        self.origin += shift * self.span / self.chartWidth
+        self.move("all", -shift, 0)
+        if self.last is not None:
+            self.last = (self.last[0], self.last[1] - shift, self.last[2])
+
+        while self.segments and self.segments[0][1] < self.origin:
+            self.delete(self.segments.popleft()[0])
+
+    def _draw(self, t, value):
+        x = self._x(t)
+        y = self._y(value)
+        if self.last is not None:
+            item = self.create_line(self.last[1], self.last[2], x, y, fill=self.color, width=2)
+            self.segments.append((item, t))
+        self.last = (t, x, y)
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+startup_profile.py
+
+1. WHAT IT DOES
+Measures where the start up time of the bench computer goes: how long
+each module takes to import and how long each start up phase takes,
+measured from the moment this module was imported.
+
+Import it first, the bench computer prints the report when started with
+
+    BENCH_STARTUP_PROFILE=1 python3 bench_computer_keystudio_relay.py
+
+For a finer breakdown of the imports use python3 -X importtime.
+'''
+
+import builtins
+import collections
+import contextlib
+import sys
+import threading
+import time
+
+START = time.perf_counter()
+
+# One timed step.  start is the seconds from START, depth the nesting of imports.
+Phase = collections.namedtuple("Phase", ["name", "start", "duration", "thread", "depth"])
+
+
+class StartupProfile:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = []
+        self.marks = collections.OrderedDict()  # name: seconds from START
+        self._import = None
+        self._depth = 0
+
+    def elapsed(self):
+        return time.perf_counter() - START
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(name, start, time.perf_counter() - start, 0)
+
+    def mark(self, name):
+        """Record the moment something became ready, return the seconds from START."""
+        elapsed = self.elapsed()
+        with self.lock:
+            self.marks.setdefault(name, elapsed)
+        return elapsed
+
+    def _add(self, name, start, duration, depth):
+        with self.lock:
+            self.phases.append(Phase(name, start - START, duration, threading.current_thread().name, depth))
+
+    # Imports
+
+    def watch_imports(self):
+        """Time every module imported from now until stop_imports()."""
+        if self._import is None:
+            self._import = builtins.__import__
+            builtins.__import__ = self._timed_import
+
+    def stop_imports(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        original = self._import or builtins.__import__
+        if level or name in sys.modules or threading.current_thread() is not threading.main_thread():
+            return original(name, globals, locals, fromlist, level)
+
+        start = time.perf_counter()
+        self._depth += 1
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            self._depth -= 1
+            self._add("import " + name, start, time.perf_counter() - start, self._depth)
+
+    def report(self, slowest=15):
+        """Return the report as a list of lines."""
+        with self.lock:
+            phases = list(self.phases)
+            marks = list(self.marks.items())
+
+        imports = [p for p in phases if p.name.startswith("import ")]
+        lines = ["Startup profile, ms from start"]
+        lines.append("  imports {:8.1f} ms in total, the slowest (including what they import):".format(
+            sum(p.duration for p in imports if p.depth == 0) * 1000))
+        for p in sorted(imports, key=lambda p: -p.duration)[:slowest]:
+            lines.append("    {:8.1f} ms  {}{}".format(p.duration * 1000, "  " * p.depth, p.name))
+
+        lines.append("  phases:")
+        for p in sorted((p for p in phases if not p.name.startswith("import ")), key=lambda p: p.start):
+            lines.append("    at {:8.1f} ms  {:8.1f} ms  {} [{}]".format(
+                p.start * 1000, p.duration * 1000, p.name, p.thread))
+
+        lines.append("  ready:")
+        for name, elapsed in marks:
+            lines.append("    at {:8.1f} ms  {}".format(elapsed * 1000, name))
+        return lines
+
+
+# The profile of this run of the program.
+PROFILE = StartupProfile()
@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+storage.py
+
+1. WHAT IT DOES
+Writes the photos and videos to the SD card on worker threads, so a slow
+card never holds up the camera, and keeps the card from filling up.
+
+write() only copies the data to a staging directory on tmpfs (RAM, so it
+takes about a millisecond) and queues it.  The workers move the queued
+files to the SD card in batches: all the files of a batch are written
+and synced, then renamed into place and their directories synced, so a
+half written photo is never seen.  If more than max_pending bytes are waiting the
+caller writes the file straight to the card itself, nothing is lost and
+the RAM used stays bounded.  Without a staging directory the queued data
+waits in memory instead.
+
+Before each batch the oldest photos and videos under the roots are
+removed until the batch fits in quota bytes and min_free bytes stay free
+on the card.  Only the photos and videos count against the quota, the
+files of a series (timing.csv, the .ref files) are never removed, nor
+anything in a directory held by hold(), like a series being taken.
+'''
+
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import os
+import queue
+import shutil
+import threading
+import time
+
+import metrics
+
+BATCH_SECONDS = metrics.REGISTRY.histogram("bench_storage_batch_seconds",
+                                           "Time to write and sync one batch of files.")
+WRITTEN_BYTES = metrics.REGISTRY.counter("bench_storage_written_bytes_total", "Bytes written to the SD card.")
+WRITTEN_FILES = metrics.REGISTRY.counter("bench_storage_written_files_total", "Files written to the SD card.",
+                                         ["path"])
+QUEUED_FILES = WRITTEN_FILES.labels("queued")
+DIRECT_FILES = WRITTEN_FILES.labels("direct")  # Written by the caller, the queue was full
+EVICTED_BYTES = metrics.REGISTRY.counter("bench_storage_evicted_bytes_total",
+                                         "Bytes of old files removed to stay within the quota.")
+
+# The files counted against the quota and removed to make room.
+MEDIA_EXTENSIONS = (".jpg", ".h264", ".mp4")
+
+# Files left in the staging directory by a crash are saved here, under the first root.
+RECOVERED_DIRECTORY = "recovered"
+
+# One file waiting to be written.  data is None when the file is already in staged.
+Job = collections.namedtuple("Job", ["path", "staged", "data", "size", "future"])
+
+
+class StorageWriter:
+    """
+    roots are the directories whose files count against the quota.
+    on_evict(path, size) and on_error(path, error) are called on the worker
+    threads.
+    """
+
+    def __init__(self, roots, staging=None, quota=None, min_free=0, max_pending=64 << 20,
+                 workers=2, batch_size=8, batch_delay=0.5, on_evict=None, on_error=None):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.staging_root = staging
+        # A directory of this run, whatever else is in staging was left by a crash.
+        self.staging = os.path.join(staging, "run_{}".format(os.getpid())) if staging is not None else None
+        self.quota = quota
+        self.min_free = min_free
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.on_evict = on_evict
+        self.on_error = on_error
+
+        self.lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._names = itertools.count()
+        self._workers = [threading.Thread(target=self._work, name="StorageWriter-{}".format(i), daemon=True)
+                         for i in range(workers)]
+
+        self._quota_lock = threading.Lock()
+        self._files = []  # Heap of (mtime, path, size) of the files under the roots, oldest first
+        self._sizes = {}  # path: (mtime, size) of its entry in the heap, the older entries are stale
+        self._scanned = False
+        self.used = 0  # Bytes under the roots
+
+        self.pending = 0  # Files waiting to be written
+        self.pending_bytes = 0  # Bytes waiting, in staging or in memory
+        self.written = 0
+        self.bytes_written = 0
+        self.direct = 0
+        self.evicted = 0
+        self.errors = 0
+        self.over_quota = False  # Set when there was nothing old left to remove
+        self.low_space = False  # Set when other files leave less than min_free, removing ours would not help
+        self._held = collections.Counter()  # Directories whose files are not removed
+        self._throughput = collections.deque(maxlen=32)  # (time, bytes) of the last batches
+
+    def start(self):
+        if self.staging is not None:
+            os.makedirs(self.staging, exist_ok=True)
+            self._recover()
+        for worker in self._workers:
+            worker.start()
+
+    # Used by the callers
+
+    def write(self, path, data):
+        """
+        Queue data to be written to path, return a concurrent.futures.Future
+        set once it is on the card.  Only blocks to stage the data.
+        """
+        future = concurrent.futures.Future()
+        size = len(data)
+        with self.lock:
+            queued = self.pending_bytes + size <= self.max_pending
+            if queued:
+                self.pending += 1
+                self.pending_bytes += size
+
+        if not queued:
+            self._write_direct(path, data, future)
+            return future
+
+        if self.staging is not None:
+            staged = self.staged_path(os.path.basename(path))
+            try:
+                with open(staged, "wb") as f:
+                    f.write(data)
+                data = None
+            except OSError:
+                staged = None  # tmpfs is full, keep the data in memory.
+        else:
+            staged = None
+        self._jobs.put(Job(path, staged, data, size, future))
+        return future
+
+    def staged_path(self, name):
+        """A new path in the staging directory for name, or None without staging."""
+        if self.staging is None:
+            return None
+        return os.path.join(self.staging, "{:06d}_{}".format(next(self._names), name))
+
+    def add(self, staged, path):
+        """Queue a file already written to staged, like a video, to be moved to path."""
+        future = concurrent.futures.Future()
+        size = os.path.getsize(staged)
+        with self.lock:
+            self.pending += 1
+            self.pending_bytes += size
+        self._jobs.put(Job(path, staged, None, size, future))
+        return future
+
+    def track(self, path):
+        """Count a file written by someone else, like a video recorded straight to the card."""
+        try:
+            self._record(path, os.path.getsize(path))
+        except OSError:
+            return  # Nothing was written.
+        self._make_room(0)
+
+    def hold(self, directory):
+        """Don't remove the files in directory, until release(directory)."""
+        with self._quota_lock:
+            self._held[os.path.abspath(directory)] += 1
+
+    def release(self, directory):
+        with self._quota_lock:
+            self._held[os.path.abspath(directory)] -= 1
+            if self._held[os.path.abspath(directory)] <= 0:
+                del self._held[os.path.abspath(directory)]
+
+    def _write_direct(self, path, data, future):
+        try:
+            self._make_room(len(data))
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+            self._record(path, len(data))
+            self.direct += 1
+            DIRECT_FILES.inc()
+            future.set_result(path)
+        except Exception as e:
+            self._failed(Job(path, None, None, 0, future), e)
+
+    # Workers
+
+    def _work(self):
+        self._scan()
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            batch = [job]
+            deadline = time.monotonic() + self.batch_delay
+            stopping = False
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._jobs.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        self._make_room(sum(job.size for job in batch))
+
+        ready = []
+        for job in batch:
+            try:
+                os.makedirs(os.path.dirname(job.path) or ".", exist_ok=True)
+                part = job.path + ".part"
+                with open(part, "wb") as f:
+                    if job.data is not None:
+                        f.write(job.data)
+                    else:
+                        with open(job.staged, "rb") as staged:
+                            shutil.copyfileobj(staged, f, 1 << 20)
+                    f.flush()
+                    os.fsync(f.fileno())
+                ready.append((job, part))
+            except Exception as e:
+                self._failed(job, e)
+
+        size = 0
+        directories = set()
+        for job, part in ready:
+            try:
+                os.replace(part, job.path)
+                directories.add(os.path.dirname(job.path) or ".")
+                if job.staged is not None:
+                    os.remove(job.staged)
+                self._record(job.path, job.size)
+                size += job.size
+                job.future.set_result(job.path)
+            except Exception as e:
+                self._failed(job, e)
+        # The renames are only safe on the card once their directories are synced.
+        for directory in directories:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+
+        with self.lock:
+            self.pending -= len(batch)
+            self.pending_bytes -= sum(job.size for job in batch)
+            self.written += len(ready)
+            self.bytes_written += size
+            self._throughput.append((time.monotonic(), size))
+        QUEUED_FILES.inc(len(ready))
+        WRITTEN_BYTES.inc(size)
+        BATCH_SECONDS.observe(time.perf_counter() - start)
+
+    def _failed(self, job, error):
+        self.errors += 1
+        job.future.set_exception(error)
+        if self.on_error is not None:
+            self.on_error(job.path, error)
+
+    # Quota
+
+    def _scan(self):
+        with self._quota_lock:
+            if self._scanned:
+                return
+            self._scanned = True
+            for root in self.roots:
+                for directory, _, names in os.walk(root):
+                    for name in names:
+                        if not name.endswith(MEDIA_EXTENSIONS):
+                            continue
+                        path = os.path.join(directory, name)
+                        try:
+                            st = os.stat(path)
+                        except OSError:
+                            continue
+                        if path in self._sizes:
+                            continue  # Already recorded since it was written
+                        self._files.append((st.st_mtime, path, st.st_size))
+                        self._sizes[path] = (st.st_mtime, st.st_size)
+                        self.used += st.st_size
+            heapq.heapify(self._files)
+
+    def _recover(self):
+        # Files staged by an earlier run which crashed, their destination is lost.
+        if not self.roots:
+            return
+        for run in sorted(os.listdir(self.staging_root)):
+            directory = os.path.join(self.staging_root, run)
+            if directory == self.staging or not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                self.add(os.path.join(directory, name), os.path.join(self.roots[0], RECOVERED_DIRECTORY, name))
+
+    def _record(self, path, size):
+        if not path.endswith(MEDIA_EXTENSIONS):
+            return
+        path = os.path.abspath(path)
+        mtime = time.time()
+        with self._quota_lock:
+            # A file written again replaces its old entry, which is left in the heap as stale.
+            old = self._sizes.get(path)
+            if old is not None:
+                self.used -= old[1]
+            self._sizes[path] = (mtime, size)
+            heapq.heappush(self._files, (mtime, path, size))
+            self.used += size
+            if len(self._files) > 2 * len(self._sizes) + 64:
+                self._files = [(mtime, path, size) for path, (mtime, size) in self._sizes.items()]
+                heapq.heapify(self._files)
+
+    def _forget(self, path, size):
+        del self._sizes[path]
+        self.used -= size
+
+    def _free(self):
+        try:
+            return shutil.disk_usage(self.roots[0]).free
+        except (OSError, IndexError):
+            return None
+
+    def _make_room(self, incoming):
+        with self._quota_lock:
+            held = []  # Entries of held directories, put back at the end
+            try:
+                self._evict(incoming, held)
+            finally:
+                for entry in held:
+                    heapq.heappush(self._files, entry)
+
+    def _evict(self, incoming, held):
+        # Called with self._quota_lock held.
+        free = self._free() if self.min_free else None
+        # If other files fill the card, removing all of ours would still not leave min_free.
+        self.low_space = free is not None and free + self.used - incoming < self.min_free
+        while True:
+            over = ((self.quota is not None and self.used + incoming > self.quota) or
+                    (not self.low_space and free is not None and free - incoming < self.min_free))
+            if not over:
+                self.over_quota = False
+                return
+            if not self._files:
+                self.over_quota = True  # Nothing left to remove, write anyway.
+                return
+
+            mtime, path, size = heapq.heappop(self._files)
+            if self._sizes.get(path) != (mtime, size):
+                continue  # The file was written again since
+            if os.path.dirname(path) in self._held:
+                held.append((mtime, path, size))
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                self._forget(path, size)  # Removed by someone else, it takes no space any more
+                continue
+            except OSError as e:
+                self._forget(path, size)  # Not tried again, the card may be read only
+                if self.on_error is not None:
+                    self.on_error(path, e)
+                continue
+            self._forget(path, size)
+            if free is not None:
+                free += size
+            self.evicted += 1
+            EVICTED_BYTES.inc(size)
+            if self.on_evict is not None:
+                self.on_evict(path, size)
+
+            # Remove the directory of an interval series once it is empty.
+            directory = os.path.dirname(path)
+            if directory not in self.roots:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+    def throughput(self, window=10.0):
+        """Return the bytes per second written over the last window seconds."""
+        now = time.monotonic()
+        with self.lock:
+            size = sum(n for t, n in self._throughput if now - t <= window)
+        return size / window
+
+    def stats(self):
+        return {"pending": self.pending, "pending_bytes": self.pending_bytes, "written": self.written,
+                "bytes_written": self.bytes_written, "throughput": self.throughput(), "direct": self.direct,
+                "used": self.used, "quota": self.quota, "evicted": self.evicted, "errors": self.errors,
+                "over_quota": self.over_quota, "low_space": self.low_space}
+
+    def stop(self, timeout=None):
+        """Write what is queued, waiting up to timeout seconds for each worker."""
+        for worker in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join(timeout)
+        if self.staging is not None:
+            try:
+                os.rmdir(self.staging)  # Only if everything was written
+            except OSError:
+                pass
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+subsystem.py
+
+1. WHAT IT DOES
+Sets up a slow part of the bench computer (the camera, the sensors) only
+when it is needed: on first use, or in the background with prefetch()
+once the window is up.  The factory runs only once, whoever asks first.
+'''
+
+import contextlib
+import threading
+
+
+class Subsystem:
+    """
+    factory() returns the set up object.  If it raises, the error is kept
+    and passed to on_error(name, error), get() raises it and tries again
+    the next time.
+    """
+
+    def __init__(self, name, factory, profile=None, on_error=None):
+        self.name = name
+        self.factory = factory
+        self.profile = profile
+        self.on_error = on_error
+
+        self.value = None  # The object, None until it has been set up
+        self.error = None
+        self.done = threading.Event()  # Set when the first attempt has finished, either way
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.value is not None
+
+    def get(self):
+        """Return the object, setting it up now if needed (this may block)."""
+        value = self.value
+        if value is not None:
+            return value
+
+        with self._lock:
+            if self.value is None:
+                phase = self.profile.phase("start " + self.name) if self.profile else contextlib.nullcontext()
+                try:
+                    with phase:
+                        self.value = self.factory()
+                    self.error = None
+                except Exception as e:
+                    self.error = e
+                    if self.on_error is not None:
+                        self.on_error(self.name, e)
+                    raise
+                finally:
+                    self.done.set()
+            return self.value
+
+    def prefetch(self):
+        """Set the object up on a background thread, never blocks."""
+        if self.value is None:
+            threading.Thread(target=self._prefetch, name="Start " + self.name, daemon=True).start()
+
+    def _prefetch(self):
+        try:
+            self.get()
+        except Exception:
+            pass  # Kept in self.error, and reported by on_error.
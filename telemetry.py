@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+telemetry.py
+
+1. WHAT IT DOES
+Append only binary log of everything that happens on the bench: the
+environment readings, relay changes and camera events.
+
+Every event is one fixed size record.  Records are collected in memory and
+written in batches to limit SD card wear.  The log is split into segment
+files which are rotated by size or when the day changes.  Next to every
+segment is a small index holding the time of every INDEX_EVERY'th record,
+so a time range query only reads (through mmap) the pages it needs.
+An environment record holds the time of its reading, which is up to
+MAX_LAG seconds before it was logged, so the times in a segment are only
+in order to within MAX_LAG, and the queries allow for that.
+
+Export to CSV from the command line:
+    python3 telemetry.py export ../telemetry [START [END]] > telemetry.csv
+START and END are ISO dates or times, for example 2021-03-21T14:00.
+'''
+
+import collections
+import csv
+import datetime
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+import DHT22
+
+# time, kind, source, code, value1, value2
+RECORD = struct.Struct("<dBBHff")
+INDEX = struct.Struct("<dI")  # time, record number
+INDEX_EVERY = 256
+MAX_LAG = 60.0  # Seconds a record's time may be before the time it is logged
+
+# Record kinds
+ENVIRONMENT = 1  # source = DHT22 number, code = read status, value1 = temperature, value2 = humidity
+LIGHT = 2        # source = MCP3008 channel, value1 = light level
+RELAY = 3        # source = gpio, code = 1 on, 0 off
+CAMERA = 4       # code = camera event, value1 = frame number or duration
+
+KIND_NAMES = {ENVIRONMENT: "environment", LIGHT: "light", RELAY: "relay", CAMERA: "camera"}
+
+# Camera events
+STILL = 1
+INTERVAL_START = 2
+INTERVAL_FRAME = 3
+INTERVAL_STOP = 4
+VIDEO_START = 5
+VIDEO_STOP = 6
+
+CAMERA_EVENT_NAMES = {STILL: "still", INTERVAL_START: "interval start",
+                      INTERVAL_FRAME: "interval frame", INTERVAL_STOP: "interval stop",
+                      VIDEO_START: "video start", VIDEO_STOP: "video stop"}
+
+STATUS_CODES = {DHT22.OK: 0, DHT22.BAD_CHECKSUM: 1, DHT22.SHORT_MESSAGE: 2,
+                DHT22.MISSING_MESSAGE: 3, DHT22.RECOVERING: 4, None: 255}
+
+Record = collections.namedtuple("Record", ["time", "kind", "source", "code", "value1", "value2"])
+
+NAN = float("nan")
+
+
+class TelemetryLog:
+    """
+    Writer for the telemetry log in directory.
+
+    Records are written when batch records are waiting or at least every
+    flush_interval seconds.  A new segment is started when the current one
+    reaches max_bytes or the day changes.  Safe to use from several threads.
+    """
+
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024, batch=64, flush_interval=30):
+        self.directory = directory
+        self.max_bytes = max_bytes - max_bytes % RECORD.size
+        self.batch = batch
+        self.flush_interval = flush_interval
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.pending = []
+        self.lock = threading.Lock()
+
+        self.segment = None  # Open segment file
+        self.index = None  # and its index file
+        self.segmentDay = None
+        self.segmentRecords = 0
+
+        self.records = 0  # Records written
+        self.writes = 0  # Batches written
+
+        self._stop_event = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="TelemetryLog", daemon=True)
+        self._flusher.start()
+
+    def write(self, kind, source=0, code=0, value1=NAN, value2=NAN, t=None):
+        """Log one record, t defaults to now, and is at most MAX_LAG seconds ago."""
+        now = time.time()
+        t = now if t is None else max(t, now - MAX_LAG)
+        record = RECORD.pack(t, kind, source, code,
+                             NAN if value1 is None else value1,
+                             NAN if value2 is None else value2)
+        with self.lock:
+            self.pending.append((t, record))
+            if len(self.pending) >= self.batch:
+                self._write_pending()
+
+    def environment(self, reading, channel=0):
+        """Log an acquisition.Reading, one record per DHT22 and one for the light level."""
+        for number, state in enumerate(reading.sensors):
+            self.write(ENVIRONMENT, number, STATUS_CODES.get(state.status, 255),
+                       state.temperature, state.humidity, reading.timestamp)
+        if reading.light is not None:
+            self.write(LIGHT, channel, 0, reading.light, t=reading.timestamp)
+
+    def relay(self, gpio, state):
+        """Log a relay change."""
+        self.write(RELAY, gpio, 1 if state else 0)
+
+    def camera(self, event, value=NAN):
+        """Log a camera event."""
+        self.write(CAMERA, 0, event, value)
+
+    def flush(self):
+        """Write all the waiting records."""
+        with self.lock:
+            self._write_pending()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def _write_pending(self):
+        # Called with self.lock held.
+        if not self.pending:
+            return
+
+        chunk = bytearray()
+        for t, record in self.pending:
+            day = datetime.date.fromtimestamp(t)
+            if (self.segment is None or day != self.segmentDay or
+                    (self.segmentRecords + 1) * RECORD.size > self.max_bytes):
+                if chunk:
+                    self.segment.write(chunk)
+                    chunk = bytearray()
+                self._rotate(t, day)
+
+            if self.segmentRecords % INDEX_EVERY == 0:
+                self.index.write(INDEX.pack(t, self.segmentRecords))
+            chunk += record
+            self.segmentRecords += 1
+            self.records += 1
+
+        self.segment.write(chunk)
+        self.segment.flush()
+        self.index.flush()
+        self.writes += 1
+        self.pending = []
+
+    def _rotate(self, t, day):
+        self._close_segment()
+
+        name = os.path.join(self.directory, "telemetry_{}".format(
+            datetime.datetime.fromtimestamp(t).strftime("%Y%m%d_%H%M%S")))
+        n = 0
+        path = name + ".bin"
+        while os.path.exists(path):  # Several segments in one second
+            n += 1
+            path = "{}_{}.bin".format(name, n)
+
+        self.segment = open(path, "ab")
+        self.index = open(path[:-4] + ".idx", "ab")
+        self.segmentDay = day
+        self.segmentRecords = 0
+
+    def _close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+            self.segment = None
+            self.index = None
+
+    def close(self):
+        """Write the waiting records and close the log."""
+        self._stop_event.set()
+        with self.lock:
+            self._write_pending()
+            self._close_segment()
+
+
+def segments(directory):
+    """Return the segment paths in directory, oldest first."""
+    names = [name for name in os.listdir(directory)
+             if name.startswith("telemetry_") and name.endswith(".bin")]
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+
+def _read_index(path):
+    try:
+        with open(path[:-4] + ".idx", "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return [], []
+    data = data[:len(data) - len(data) % INDEX.size]
+    entries = list(INDEX.iter_unpack(data))
+    return [t for t, _ in entries], [n for _, n in entries]
+
+
+def query(directory, start=None, end=None, kinds=None):
+    """
+    Yield the Records logged from start to end (time.time() values, None
+    for no limit), in the order they were logged.  kinds limits the record
+    kinds returned.
+
+    Only the index of each segment is read in full, the records are read
+    through mmap starting at the last index entry more than MAX_LAG before
+    start, and up to the first record more than MAX_LAG after end.
+    """
+    paths = segments(directory)
+    firsts = []
+    for path in paths:
+        times, numbers = _read_index(path)
+        firsts.append((times, numbers))
+
+    for i, path in enumerate(paths):
+        times, numbers = firsts[i]
+        if end is not None and times and times[0] > end + MAX_LAG:
+            break
+        # Skip segments which end before start: the next one starts before start.
+        if (start is not None and i + 1 < len(paths) and firsts[i + 1][0] and
+                firsts[i + 1][0][0] < start - MAX_LAG):
+            continue
+
+        # Every record before an index entry more than MAX_LAG before start was logged before start.
+        first = 0
+        if start is not None:
+            for j in range(len(times) - 1, 0, -1):
+                if times[j] < start - MAX_LAG:
+                    first = numbers[j]
+                    break
+
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            size -= size % RECORD.size
+            if size <= first * RECORD.size:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)[first * RECORD.size:size]
+                records = RECORD.iter_unpack(view)
+                try:
+                    for values in records:
+                        t = values[0]
+                        if start is not None and t < start:
+                            continue
+                        if end is not None and t > end:
+                            if t > end + MAX_LAG:
+                                return
+                            continue
+                        if kinds is None or values[1] in kinds:
+                            yield Record(*values)
+                finally:
+                    # The mmap can only be closed once nothing refers to it.
+                    del records
+                    view.release()
+
+
+def environment_at(directory, t, window=600):
+    """
+    Return (time, temperature, humidity, light) of the first DHT22 and the
+    light level logged closest to t, within window seconds, or None.
+    """
+    best = {}
+    for r in query(directory, t - window, t + window, (ENVIRONMENT, LIGHT)):
+        if r.kind == ENVIRONMENT and (r.source != 0 or r.code != 0 or math.isnan(r.value1)):
+            continue
+        if r.kind not in best or abs(r.time - t) < abs(best[r.kind].time - t):
+            best[r.kind] = r
+    if not best:
+        return None
+    environment, light = best.get(ENVIRONMENT), best.get(LIGHT)
+    return ((environment or light).time,
+            environment.value1 if environment else None,
+            environment.value2 if environment else None,
+            light.value1 if light else None)
+
+
+def export_csv(directory, out, start=None, end=None):
+    """Stream the records from start to end to the file out as CSV."""
+    writer = csv.writer(out)
+    writer.writerow(["time", "kind", "source", "code", "value1", "value2"])
+    for r in query(directory, start, end):
+        if r.kind == CAMERA:
+            code = CAMERA_EVENT_NAMES.get(r.code, r.code)
+        else:
+            code = r.code
+        writer.writerow([datetime.datetime.fromtimestamp(r.time).isoformat(),
+                         KIND_NAMES.get(r.kind, r.kind), r.source, code,
+                         "" if math.isnan(r.value1) else round(r.value1, 3),
+                         "" if math.isnan(r.value2) else round(r.value2, 3)])
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    if len(sys.argv) >= 3 and sys.argv[1] == "export":
+        limits = [datetime.datetime.fromisoformat(a).timestamp() for a in sys.argv[3:5]]
+        limits += [None] * (2 - len(limits))
+        export_csv(sys.argv[2], sys.stdout, limits[0], limits[1])
+    else:
+        print("usage: telemetry.py export DIRECTORY [START [END]]")
@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+timelapse.py
+
+1. WHAT IT DOES
+Interval (timelapse) photography on a worker thread.
+
+Frame n is due at start + n * interval, an absolute deadline, so the time
+spent capturing and saving a frame is never added to the interval and a
+long series does not drift.  For intervals under a second the camera runs
+continuously from the video port and the first frame after each deadline
+is kept.
+
+Frames are saved by a separate writer thread through a bounded queue.  If
+the SD card can't keep up the queue fills and frames are skipped rather
+than piling up in memory.  Every frame's timing is written to timing.csv
+in the series directory.
+
+With a change_detect.ChangeDetector, frames which look the same as the
+last stored one are not stored.  Their number is kept in timing.csv,
+with the name of the stored frame which stands for them, and with
+unchanged="reference" also as a tiny NNNNN.ref file holding that name.
+
+With a storage.StorageWriter the photos are only staged by the writer
+thread and reach the SD card later.
+
+With lock_exposure the exposure and white balance are fixed for the whole
+series (see camera_session.py), so the frames don't flicker as the
+automatic exposure hunts.
+'''
+
+import collections
+import io
+import os
+import queue
+import threading
+import time
+
+from PIL import Image
+
+import metrics
+
+# Intervals shorter than this use continuous capture from the video port.
+CONTINUOUS_INTERVAL = 1.0
+
+# Timing of one saved frame, times are time.monotonic() values.
+FrameTiming = collections.namedtuple(
+    "FrameTiming", ["frame", "number", "deadline", "captured", "written"])
+
+LATENESS_SECONDS = metrics.REGISTRY.histogram("bench_timelapse_lateness_seconds",
+                                              "Time from a frame's deadline to its capture.")
+WRITE_SECONDS = metrics.REGISTRY.histogram("bench_timelapse_write_seconds",
+                                           "Time from capture to the frame being saved.")
+
+
+class TimelapseEngine(threading.Thread):
+    """
+    Take a photo every interval seconds into directory until stop(), with
+    the camera of session, a camera_session.CameraSession.
+
+    on_saved(frame, path) is called from the writer
+    thread after each frame is saved.  change_detector is None, or a
+    ChangeDetector to leave out the frames where nothing changed, either
+    "skip"ped or stored as a "reference".
+    """
+
+    def __init__(self, session, directory, interval, preview_size=(350, 210), max_pending=4, on_saved=None,
+                 change_detector=None, unchanged="reference", storage=None, lock_exposure=False):
+        threading.Thread.__init__(self, name="TimelapseEngine", daemon=True)
+
+        self.session = session
+        self.directory = directory
+        self.interval = interval
+        self.camera_lock = session.lock
+        self.lock_exposure = lock_exposure
+        self.preview_size = preview_size
+        self.on_saved = on_saved
+        self.change_detector = change_detector
+        self.unchanged_mode = unchanged
+        self.storage = storage
+
+        self.pending = queue.Queue(maxsize=max_pending)  # Frames waiting to be written
+        self.preview = queue.Queue(maxsize=1)  # Newest thumbnail for the GUI
+
+        self.frames = 0  # Frames captured
+        self.written = 0  # Frames saved
+        self.unchanged = 0  # Frames not saved because nothing changed
+        self.skipped = 0  # Deadlines missed or frames dropped because the writer was behind
+        self.failed = 0  # Frames which could not be saved, the last error is in error
+        self.timings = collections.deque(maxlen=1000)
+        self.started = None
+        self.stopped = None
+        self.stopping = False  # Set by the owner once stop() has been asked for.
+        self.error = None
+
+        self._stop_event = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, name="TimelapseWriter", daemon=True)
+
+    def run(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        if self.storage is not None:
+            self.storage.hold(self.directory)  # Nothing of the series is removed while it is taken
+        self._writer.start()
+        locked = False
+        try:
+            if self.lock_exposure and not self.session.exposure_locked:
+                self.session.lock_exposure()
+                locked = True
+            self.started = time.monotonic()
+            if self.interval < CONTINUOUS_INTERVAL:
+                self._run_continuous()
+            else:
+                self._run_stills()
+        except Exception as e:
+            self.error = e
+        finally:
+            if locked:
+                self.session.unlock_exposure()
+            self.stopped = time.monotonic()
+            while self._writer.is_alive():
+                try:
+                    self.pending.put(None, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+            self._writer.join()
+            if self.storage is not None:
+                self.storage.release(self.directory)
+
+    def _run_stills(self):
+        number = 0
+        while True:
+            deadline = self.started + number * self.interval
+            if self._stop_event.wait(max(0, deadline - time.monotonic())):
+                return
+
+            # If a whole interval has gone by, those frames are lost.
+            late = int((time.monotonic() - deadline) / self.interval)
+            if late:
+                self.skipped += late
+                number += late
+                deadline = self.started + number * self.interval
+
+            if self.pending.full():  # The writer is behind, drop this frame.
+                self.skipped += 1
+            else:
+                stream = io.BytesIO()
+                with self.camera_lock:
+                    self.session.capture(stream)
+                self._captured(number, deadline, stream.getvalue())
+
+            number += 1
+
+    def _run_continuous(self):
+        number = 0
+        deadline = self.started
+        stream = io.BytesIO()
+        frames = self.session.capture_continuous(stream)
+        try:
+            while not self._stop_event.is_set():
+                # The lock is only held for each frame, so the preview and the
+                # recorder can be started and stopped between frames.
+                with self.camera_lock:
+                    next(frames)
+
+                now = time.monotonic()
+                if now >= deadline:
+                    if self.pending.full():
+                        self.skipped += 1
+                    else:
+                        self._captured(number, deadline, stream.getvalue())
+
+                    # Frames for deadlines which have already passed are lost.
+                    late = int((now - deadline) / self.interval)
+                    self.skipped += late
+                    number += late + 1
+                    deadline = self.started + number * self.interval
+
+                stream.seek(0)
+                stream.truncate()
+        finally:
+            with self.camera_lock:
+                frames.close()
+
+    def _captured(self, number, deadline, data):
+        self.frames += 1
+        LATENESS_SECONDS.observe(max(0.0, time.monotonic() - deadline))
+        self.pending.put((self.frames, number, deadline, time.monotonic(), data))
+
+    def _write_loop(self):
+        try:
+            with open(os.path.join(self.directory, "timing.csv"), "w") as timing:
+                timing.write("frame,number,deadline_s,lateness_ms,write_ms,stored_as\n")
+                stored_as = None  # Name of the last stored frame
+                while True:
+                    item = self.pending.get()
+                    if item is None:
+                        return
+                    try:
+                        stored_as = self._write_frame(timing, item, stored_as)
+                    except Exception as e:
+                        # The frame is lost, the series goes on.
+                        self.error = e
+                        self.failed += 1
+        except Exception as e:
+            self.error = e
+        # Without timing.csv nothing can be saved, take the frames until the end so run() can finish.
+        while self.pending.get() is not None:
+            self.failed += 1
+
+    def _write_frame(self, timing, item, stored_as):
+        """Save one frame, return the name of the last stored frame."""
+        frame, number, deadline, captured, data = item
+
+        detector = self.change_detector
+        changed = detector is None or detector.changed(data) or stored_as is None
+        if changed:
+            stored_as = "{:05d}.jpg".format(frame)
+            path = os.path.join(self.directory, stored_as)
+            if self.storage is not None:
+                self.storage.write(path, data)
+            else:
+                with open(path, "wb") as f:
+                    f.write(data)
+            if detector is not None:
+                detector.stored(len(data))
+        else:
+            reference = b""
+            if self.unchanged_mode == "reference":
+                reference = stored_as.encode() + b"\n"
+                with open(os.path.join(self.directory, "{:05d}.ref".format(frame)), "wb") as f:
+                    f.write(reference)
+            detector.unchanged(len(data), len(reference))
+            self.unchanged += 1
+
+        written = time.monotonic()
+        WRITE_SECONDS.observe(written - captured)
+        if changed:
+            self.written += 1
+            if self.on_saved is not None:
+                self.on_saved(frame, path)
+
+        t = FrameTiming(frame, number, deadline, captured, written)
+        self.timings.append(t)
+        timing.write("{},{},{:.3f},{:.1f},{:.1f},{}\n".format(
+            frame, number, deadline - self.started,
+            (captured - deadline) * 1000, (written - captured) * 1000, stored_as))
+        timing.flush()
+
+        # Only make a thumbnail of a new photo, and if the GUI has taken the last one.
+        if changed and self.preview.empty():
+            image = Image.open(io.BytesIO(data))
+            image.draft("RGB", self.preview_size)
+            self.preview.put((frame, image.resize(self.preview_size, Image.LANCZOS)))
+        return stored_as
+
+    def latest_preview(self):
+        """Return (frame, thumbnail) of a newly saved frame or None, never blocks."""
+        try:
+            return self.preview.get_nowait()
+        except queue.Empty:
+            return None
+
+    def fps(self):
+        """Return the effective frames per second so far."""
+        if self.started is None:
+            return 0.0
+        elapsed = (self.stopped or time.monotonic()) - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.frames / elapsed
+
+    def mean_lateness(self):
+        """Return the mean time from deadline to capture, in seconds."""
+        if not self.timings:
+            return 0.0
+        return sum(t.captured - t.deadline for t in self.timings) / len(self.timings)
+
+    def stop(self, timeout=None):
+        """
+        Stop taking photos and wait up to timeout for the queued ones to be
+        saved.  With timeout=0 it returns at once, is_alive() tells when the
+        engine has finished.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+# coding: utf-8
+
+''' FILE NAME
+timeseries.py
+
+1. WHAT IT DOES
+Fixed size, in memory history of the environment readings.
+
+Each TimeSeries keeps the newest readings at full resolution in a ring
+buffer, plus coarser tiers (1 minute, 15 minutes by default) which hold
+the min, mean and max of every bucket.  All buffers are array.array()s
+allocated up front, so memory use never grows after start up.
+'''
+
+import array
+
+# (bucket length in seconds, number of buckets) of the coarse tiers.
+# 1 minute buckets for 14 days, 15 minute buckets for a year.
+DEFAULT_TIERS = ((60, 14 * 24 * 60), (15 * 60, 365 * 24 * 4))
+
+# Full resolution readings kept, 3 days at one reading every 10 s.
+DEFAULT_CAPACITY = 3 * 24 * 360
+
+
+class Ring:
+    """
+    A ring buffer of records made of parallel arrays.
+
+    fields is a list of (name, array typecode).  Appending to a full ring
+    overwrites the oldest record.
+    """
+
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.names = [name for name, _ in fields]
+        self.arrays = [array.array(typecode, [0]) * capacity for _, typecode in fields]
+        self.head = 0  # Where the next record goes.
+        self.count = 0
+
+    def append(self, *values):
+        head = self.head
+        for a, value in zip(self.arrays, values):
+            a[head] = value
+        self.head = (head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, i):
+        # Index of the i'th oldest record.
+        return (self.head - self.count + i) % self.capacity
+
+    def get(self, i):
+        """Return the i'th oldest record as a tuple, negative i counts from the newest."""
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        j = self._index(i)
+        return tuple(a[j] for a in self.arrays)
+
+    def first_after(self, t):
+        """Return the index of the oldest record whose first field is >= t (binary search)."""
+        times = self.arrays[0]
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[self._index(mid)] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def records(self, start=0):
+        """Yield the records from index start to the newest."""
+        for i in range(start, self.count):
+            j = self._index(i)
+            yield tuple(a[j] for a in self.arrays)
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in self.arrays)
+
+
+class TimeSeries:
+    """
+    History of one value.
+
+    Readings are appended in time order.  Tier 0 holds (time, value), the
+    coarse tiers hold (bucket start, min, mean, max).
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, tiers=DEFAULT_TIERS):
+        self.raw = Ring(capacity, [("time", 'd'), ("value", 'f')])
+        self.tiers = []
+        for step, buckets in tiers:
+            ring = Ring(buckets, [("time", 'd'), ("min", 'f'), ("mean", 'f'), ("max", 'f')])
+            # [bucket start, min, sum, count, max] of the bucket being filled.
+            self.tiers.append((step, ring, [None, 0.0, 0.0, 0, 0.0]))
+
+    def append(self, t, value):
+        """Add a reading.  None values (failed readings) are ignored."""
+        if value is None:
+            return
+
+        self.raw.append(t, value)
+
+        for step, ring, bucket in self.tiers:
+            start = t - t % step
+            if bucket[0] != start:
+                if bucket[0] is not None:
+                    ring.append(bucket[0], bucket[1], bucket[2] / bucket[3], bucket[4])
+                bucket[:] = [start, value, value, 1, value]
+            else:
+                if value < bucket[1]:
+                    bucket[1] = value
+                if value > bucket[4]:
+                    bucket[4] = value
+                bucket[2] += value
+                bucket[3] += 1
+
+    def latest(self):
+        """Return the newest (time, value), or None."""
+        if len(self.raw) == 0:
+            return None
+        return self.raw.get(-1)
+
+    def since(self, t):
+        """Return the full resolution (time, value)s from time t on."""
+        return list(self.raw.records(self.raw.first_after(t)))
+
+    def range(self, start, end=None, max_points=None):
+        """
+        Return (time, min, mean, max) records covering start to end.
+
+        Uses the finest tier which still covers start.  If max_points is
+        given, a coarser tier is used when the finest one would return more
+        records than that.  Full resolution records have min == mean == max.
+        """
+        rings = [ring for ring in [self.raw] + [ring for _, ring, _ in self.tiers] if len(ring)]
+        if not rings:
+            return []
+
+        # If no tier is good enough use the one reaching furthest back.
+        chosen = min(rings, key=lambda ring: ring.get(0)[0])
+        for ring in rings:
+            first = ring.first_after(start)
+            if ring.get(0)[0] <= start and (max_points is None or len(ring) - first <= max_points):
+                chosen = ring
+                break
+
+        result = []
+        for record in chosen.records(chosen.first_after(start)):
+            if end is not None and record[0] > end:
+                break
+            if chosen is self.raw:
+                result.append((record[0], record[1], record[1], record[1]))
+            else:
+                result.append(record)
+        return result
+
+    def nbytes(self):
+        """Return the memory held by the buffers, in bytes."""
+        return self.raw.nbytes() + sum(ring.nbytes() for _, ring, _ in self.tiers)
+
+
+class TimeSeriesStore:
+    """A TimeSeries per named value, created on first use."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, tiers=DEFAULT_TIERS):
+        self.capacity = capacity
+        self.tiers = tiers
+        self.series = {}
+
+    def __getitem__(self, name):
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = TimeSeries(self.capacity, self.tiers)
+        return series
+
+    def __contains__(self, name):
+        return name in self.series
+
+    def append(self, name, t, value):
+        self[name].append(t, value)
+
+    def append_reading(self, reading):
+        """
+        Add an acquisition.Reading.
+
+        The light level is stored as "light".  Each DHT22 gets a
+        "<name>.temperature" and a "<name>.humidity" series holding its
+        good values at the time they were taken.
+        """
+        self.append("light", reading.timestamp, reading.light)
+        for state in reading.sensors:
+            if state.tov is None:
+                continue
+            temperature = self[state.name + ".temperature"]
+            latest = temperature.latest()
+            if latest is not None and latest[0] >= state.tov:
+                continue  # Already stored.
+            temperature.append(state.tov, state.temperature)
+            self.append(state.name + ".humidity", state.tov, state.humidity)
+
+    def nbytes(self):
+        return sum(series.nbytes() for series in self.series.values())